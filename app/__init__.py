@@ -9,7 +9,7 @@ db = SQLAlchemy()
 migrate = Migrate()
 login_manager = LoginManager()
 
-def create_app(config_name='default'):
+def create_app(config_name='default', start_mqtt=True):
     # Initialize app
     app = Flask(__name__)
 
@@ -40,10 +40,56 @@ def create_app(config_name='default'):
     from app.api import api_bp
     app.register_blueprint(api_bp, url_prefix='/api')
 
+    from app.africastalking.ussd import ussd_bp
+    app.register_blueprint(ussd_bp)
+
+    # Store for USSD sessions, shared between workers unless the memory backend is used
+    from app.africastalking.sessions import setup_session_store
+    setup_session_store(app)
+
+    # Per-user snapshots the USSD menus are rendered from
+    from app.africastalking.snapshots import ussd_snapshots
+    ussd_snapshots.init_app(app)
+
+    # Configure the IoT device registry cache
+    from app.iot.device_registry import device_registry
+    device_registry.init_app(app)
+
+    # Configure the per-user notification settings cache
+    from app.iot.user_settings import settings_cache
+    settings_cache.init_app(app)
+
+    # Live event fan-out for dashboards, fed by the ingest path
+    from app.iot.events import setup_event_broker
+    setup_event_broker(app)
+
     # Initialize MQTT client for IoT devices
-    with app.app_context():
-        from app.iot.mqtt_client import setup_mqtt_client
-        setup_mqtt_client()
+    if start_mqtt and app.config.get('MQTT_ENABLED', True):
+        with app.app_context():
+            from app.iot.mqtt_client import setup_mqtt_client
+            setup_mqtt_client()
+
+        # Fire device schedules through the MQTT client, in the one process that opts in
+        if app.config.get('SCHEDULER_ENABLED', False):
+            from app.iot.scheduler import setup_schedule_runner
+            setup_schedule_runner(app)
+
+        # Deliver queued SMS in the background
+        if app.config.get('SMS_SENDER_ENABLED', True):
+            from app.africastalking.outbox import setup_sms_sender
+            setup_sms_sender(app)
+
+    # flask rebuild-rollups, to backfill rollups from existing readings
+    from app.iot.rollups import rebuild_rollups_command
+    app.cli.add_command(rebuild_rollups_command)
+
+    # flask backfill-phone-keys, to index existing users' phone numbers for USSD
+    from app.africastalking.snapshots import backfill_phone_keys_command
+    app.cli.add_command(backfill_phone_keys_command)
+
+    # Prometheus metrics at /metrics, with API and dashboard request timing
+    from app.metrics import setup_metrics
+    setup_metrics(app)
 
     # Register error handlers
     register_error_handlers(app)
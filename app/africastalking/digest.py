@@ -0,0 +1,150 @@
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+from app.africastalking.sms import digest_message, notification_message
+
+logger = logging.getLogger(__name__)
+
+# Notification types delivered during quiet hours
+CRITICAL_TYPES = {'alert'}
+
+def in_quiet_hours(settings, now, utc_offset=0):
+    """
+    Check whether a user's quiet hours cover a time
+
+    Args:
+        settings (UserSettings): Cached user settings
+        now (datetime): Time (UTC)
+        utc_offset (float): Hours added to UTC to get the users' local time
+
+    Returns:
+        bool: True inside quiet hours, which may cross midnight
+    """
+    start, end = settings.quiet_hours_start, settings.quiet_hours_end
+    if not start or not end or start == end:
+        return False
+
+    local = (now + timedelta(hours=utc_offset)).time()
+    return start <= local < end if start < end else local >= start or local < end
+
+def release_digests(now=None, window=60, utc_offset=0, max_age=86400):
+    """
+    Combine the notifications waiting for SMS into one outbox message per user
+
+    A user's notifications are held for window seconds after the oldest one,
+    so a burst of alerts goes out as a single SMS. During the user's quiet
+    hours only critical notifications are sent; the rest wait until quiet
+    hours end. Notifications of users without a phone number stop waiting
+    for SMS.
+
+    Notifications are attached to their digest with a conditional UPDATE,
+    so when several processes release digests at once each notification is
+    carried by one SMS only.
+
+    Args:
+        now (datetime): Current time, defaults to now
+        window (float): Seconds notifications are coalesced
+        utc_offset (float): Hours added to UTC to get the users' local time
+        max_age (float): Notifications older than this are no longer sent
+
+    Returns:
+        tuple: (SMS queued, notifications they carry)
+    """
+    from app.models.notification import Notification
+    from app.africastalking.outbox import queue_sms
+    from app.iot.user_settings import settings_cache
+    from app import db
+
+    now = now or datetime.utcnow()
+    rows = db.session.query(
+        Notification.id, Notification.user_id, Notification.notification_type,
+        Notification.title, Notification.message, Notification.timestamp
+    ).filter_by(
+        sms_message_id=None, send_sms=True, sms_sent=False
+    ).filter(
+        Notification.timestamp >= now - timedelta(seconds=max_age)
+    ).order_by(Notification.timestamp, Notification.id).all()
+
+    if not rows:
+        return 0, 0
+
+    waiting = {}
+    for row in rows:
+        waiting.setdefault(row.user_id, []).append(row)
+
+    users = settings_cache.get_many(waiting)
+    cutoff = now - timedelta(seconds=window)
+    undeliverable = []
+    queued = carried = 0
+
+    for user_id, notifications in waiting.items():
+        user = users.get(user_id)
+        if not user or not user.phone_number:
+            undeliverable.extend(row.id for row in notifications)
+            continue
+
+        # Only critical notifications may be sent during quiet hours
+        if in_quiet_hours(user, now, utc_offset):
+            notifications = [row for row in notifications if row.notification_type in CRITICAL_TYPES]
+
+        # The window opens with the oldest notification that may be sent now
+        if not notifications or notifications[0].timestamp > cutoff:
+            continue
+
+        message = queue_sms([user.phone_number], '')[0]
+        notifications = claim_notifications(message, notifications)
+        if not notifications:
+            db.session.delete(message)
+            continue
+
+        if len(notifications) == 1:
+            message.message = notification_message(notifications[0].notification_type, notifications[0].message)
+        else:
+            message.message = digest_message([(row.notification_type, row.title) for row in notifications])
+        queued += 1
+        carried += len(notifications)
+
+    if undeliverable:
+        db.session.execute(
+            update(Notification).where(Notification.id.in_(undeliverable)).values(send_sms=False)
+        )
+    db.session.commit()
+
+    if queued:
+        logger.info(f"Queued {queued} SMS digests carrying {carried} notifications")
+    return queued, carried
+
+def claim_notifications(message, notifications):
+    """
+    Attach notifications that no other digest carries yet to an outbox message
+
+    Args:
+        message (SMSMessage): Outbox message added to the current session
+        notifications (list): Notification rows with id
+
+    Returns:
+        list: The notifications this message carries
+    """
+    from app.models.notification import Notification
+    from app import db
+
+    db.session.flush()
+    ids = [row.id for row in notifications]
+    claimed = db.session.execute(
+        update(Notification).where(
+            Notification.id.in_(ids),
+            Notification.sms_message_id.is_(None)
+        ).values(sms_message_id=message.id)
+    ).rowcount
+
+    if claimed == len(ids):
+        return notifications
+    if not claimed:
+        return []
+
+    carried = {row[0] for row in db.session.query(Notification.id).filter(
+        Notification.id.in_(ids), Notification.sms_message_id == message.id
+    )}
+    return [row for row in notifications if row.id in carried]
@@ -0,0 +1,395 @@
+import atexit
+import threading
+import time
+import uuid
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+from app.africastalking.sms import format_recipient
+from app.metrics import SMS_MESSAGES, SMS_SEND_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Global SMS sender
+sms_sender = None
+
+# Outbox statuses
+STATUS_PENDING = 'pending'
+STATUS_SENDING = 'sending'   # claimed by a sender, being sent
+STATUS_SENT = 'sent'
+STATUS_FAILED = 'failed'
+
+# AfricasTalking per-recipient status codes
+AT_SUCCESS_CODES = {100, 101, 102}           # Processed, Sent, Queued
+AT_PERMANENT_FAILURE_CODES = {401, 402, 403, 404, 406}  # RiskHold, InvalidSenderId, InvalidPhoneNumber, UnsupportedNumberType, UserInBlacklist
+
+def queue_sms(recipients, message):
+    """
+    Add messages to the SMS outbox
+
+    The rows are added to the current session; they are sent once the caller
+    commits. Call wake_sender() after the commit to send them right away.
+
+    Args:
+        recipients (list): Phone numbers
+        message (str): Message content
+
+    Returns:
+        list: Added SMSMessage rows
+    """
+    from app.models.notification import SMSMessage
+    from app import db
+
+    rows = [SMSMessage(recipient=recipient, message=message) for recipient in recipients if recipient]
+    db.session.add_all(rows)
+    return rows
+
+def wake_sender():
+    """Ask the running SMS sender, if any, to check the outbox now"""
+    if sms_sender:
+        sms_sender.wake()
+
+class RateLimiter:
+    """Token bucket limiting API calls per second"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    def delay(self):
+        """Take a token, returning the seconds to wait before using it"""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+class SMSOutboxSender:
+    """
+    Sends outbox messages in the background
+
+    Each round first turns notifications waiting for SMS into per-user
+    digests (see release_digests), then sends the due outbox messages.
+    Due messages are grouped by text so each distinct text goes out in one
+    multi-recipient API call per max_recipients numbers. Calls are rate
+    limited. Recipients the provider could not reach are retried with
+    exponential backoff until max_attempts; numbers it rejects are failed
+    immediately. Delivered messages mark their notifications sms_sent in
+    one UPDATE per round.
+
+    Each round claims its batch with a conditional UPDATE before calling the
+    API, so senders running in several processes never send the same
+    message twice. Claims left behind by a sender that died mid-round are
+    released after claim_timeout.
+    """
+
+    def __init__(self, app, poll_interval=2.0, batch_size=500, max_recipients=100, rate_limit=5.0,
+                 max_attempts=5, backoff_base=30.0, backoff_max=3600.0, digest_window=60.0,
+                 quiet_hours_offset=0.0, claim_timeout=600.0):
+        """
+        Args:
+            app (Flask): Application used for the sender thread's app context
+            poll_interval (float): Seconds between outbox checks
+            batch_size (int): Maximum messages taken per round
+            max_recipients (int): Maximum recipients per API call
+            rate_limit (float): Maximum API calls per second
+            max_attempts (int): Attempts before a message is failed
+            backoff_base (float): Delay before the first retry, doubled per attempt
+            backoff_max (float): Maximum delay between retries
+            digest_window (float): Seconds a user's notifications are coalesced into one SMS
+            quiet_hours_offset (float): Hours added to UTC to get the local time of quiet hours
+            claim_timeout (float): Seconds after which an unfinished claim is released
+        """
+        self.app = app
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_recipients = max_recipients
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.digest_window = digest_window
+        self.quiet_hours_offset = quiet_hours_offset
+        self.claim_timeout = claim_timeout
+        self.limiter = RateLimiter(rate_limit)
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self.api_calls = 0
+        self.api_errors = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.digests = 0
+        self.coalesced = 0
+
+    def start(self):
+        """Start the sender thread"""
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="sms-sender", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Stop the sender thread; unsent messages stay in the outbox"""
+        self._stop_event.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def wake(self):
+        """Ask the sender to check the outbox now"""
+        self._wake.set()
+
+    def stats(self):
+        """Get sender counters"""
+        with self._lock:
+            return {
+                "api_calls": self.api_calls,
+                "api_errors": self.api_errors,
+                "sent": self.sent,
+                "retried": self.retried,
+                "failed": self.failed,
+                "digests": self.digests,
+                "coalesced": self.coalesced
+            }
+
+    def release(self, now=None):
+        """
+        Queue SMS digests for notifications whose window has passed; must run inside an app context
+
+        Returns:
+            int: Number of SMS queued
+        """
+        from app.africastalking.digest import release_digests
+
+        queued, carried = release_digests(now, self.digest_window, self.quiet_hours_offset)
+        with self._lock:
+            self.digests += queued
+            self.coalesced += carried
+        return queued
+
+    def dispatch(self, now=None):
+        """
+        Send due outbox messages; must run inside an app context
+
+        Args:
+            now (datetime): Current time, defaults to now
+
+        Returns:
+            int: Number of outbox messages processed
+        """
+        from app.models.notification import Notification, SMSMessage
+        from app.africastalking.sms import get_sms_service
+        from app import db
+
+        now = now or datetime.utcnow()
+        rows = self._claim(now)
+        if not rows:
+            return 0
+
+        # text -> number -> rows; the same text to the same number goes out once
+        groups = OrderedDict()
+        for row in rows:
+            groups.setdefault(row.message, OrderedDict()).setdefault(format_recipient(row.recipient), []).append(row)
+
+        service = get_sms_service()
+        updates = []
+        sent_ids = []
+
+        for message, by_number in groups.items():
+            numbers = list(by_number)
+            for i in range(0, len(numbers), self.max_recipients):
+                chunk = numbers[i:i + self.max_recipients]
+
+                delay = self.limiter.delay()
+                if delay and self._stop_event.wait(delay):
+                    break
+
+                started = time.perf_counter()
+                try:
+                    with self._lock:
+                        self.api_calls += 1
+                    results = recipient_results(service.send_bulk(chunk, message))
+                    error = "no status returned"
+                    SMS_SEND_SECONDS.observe(time.perf_counter() - started, ("ok",))
+                except Exception as e:
+                    SMS_SEND_SECONDS.observe(time.perf_counter() - started, ("error",))
+                    with self._lock:
+                        self.api_errors += 1
+                    logger.error(f"SMS API call failed for {len(chunk)} recipients: {str(e)}")
+                    results = None
+                    error = str(e)[:200]
+
+                for number in chunk:
+                    for row in by_number[number]:
+                        outcome = self._outcome(row, (results or {}).get(number), error, now)
+                        updates.append(outcome)
+                        if outcome["status"] == STATUS_SENT:
+                            sent_ids.append(row.id)
+
+                # The provider is failing or throttling us, leave the rest for a later round
+                if results is None:
+                    break
+            else:
+                continue
+            break
+
+        # Rows not attempted because the round stopped early go back to the outbox
+        attempted = {outcome["id"] for outcome in updates}
+        updates.extend({"id": row.id, "status": STATUS_PENDING} for row in rows if row.id not in attempted)
+
+        db.session.execute(update(SMSMessage), updates)
+        if sent_ids:
+            db.session.execute(
+                update(Notification).where(Notification.sms_message_id.in_(sent_ids)).values(sms_sent=True)
+            )
+        db.session.commit()
+
+        return len(attempted)
+
+    def _claim(self, now):
+        """
+        Claim a batch of due messages for this sender
+
+        The claim is its own committed UPDATE, conditional on the messages
+        still being pending, so a message another sender claimed first is
+        skipped. Only the rows this UPDATE touched are returned.
+
+        Returns:
+            list: Claimed rows with id, recipient, message and attempts
+        """
+        from app.models.notification import SMSMessage
+        from app import db
+
+        # Release claims of senders that stopped before recording their outcomes
+        db.session.execute(
+            update(SMSMessage).where(
+                SMSMessage.status == STATUS_SENDING,
+                SMSMessage.claimed_at <= now - timedelta(seconds=self.claim_timeout)
+            ).values(status=STATUS_PENDING, claim_token=None)
+        )
+
+        due = [row[0] for row in db.session.query(SMSMessage.id).filter(
+            SMSMessage.status == STATUS_PENDING,
+            SMSMessage.next_attempt_at <= now
+        ).order_by(SMSMessage.next_attempt_at, SMSMessage.id).limit(self.batch_size)]
+
+        if not due:
+            db.session.commit()
+            return []
+
+        token = uuid.uuid4().hex
+        db.session.execute(
+            update(SMSMessage).where(
+                SMSMessage.id.in_(due),
+                SMSMessage.status == STATUS_PENDING
+            ).values(status=STATUS_SENDING, claimed_at=now, claim_token=token)
+        )
+        db.session.commit()
+
+        return db.session.query(
+            SMSMessage.id, SMSMessage.recipient, SMSMessage.message, SMSMessage.attempts
+        ).filter(
+            SMSMessage.claim_token == token,
+            SMSMessage.status == STATUS_SENDING
+        ).order_by(SMSMessage.next_attempt_at, SMSMessage.id).all()
+
+    def _outcome(self, row, result, error, now):
+        """Build the outbox update for one message from its recipient result"""
+        attempts = row.attempts + 1
+        outcome = {"id": row.id, "attempts": attempts}
+
+        if result and result.get("statusCode") in AT_SUCCESS_CODES:
+            outcome.update(status=STATUS_SENT, sent_at=now, last_error=None,
+                           provider_message_id=result.get("messageId"))
+            SMS_MESSAGES.inc(1, (STATUS_SENT,))
+            with self._lock:
+                self.sent += 1
+            return outcome
+
+        if result:
+            error = f"{result.get('statusCode')} {result.get('status')}"[:200]
+
+        if (result and result.get("statusCode") in AT_PERMANENT_FAILURE_CODES) or attempts >= self.max_attempts:
+            outcome.update(status=STATUS_FAILED, last_error=error)
+            SMS_MESSAGES.inc(1, (STATUS_FAILED,))
+            with self._lock:
+                self.failed += 1
+            logger.warning(f"SMS {row.id} to {row.recipient} failed after {attempts} attempts: {error}")
+            return outcome
+
+        backoff = min(self.backoff_base * (2 ** (attempts - 1)), self.backoff_max)
+        outcome.update(status=STATUS_PENDING, last_error=error, next_attempt_at=now + timedelta(seconds=backoff))
+        SMS_MESSAGES.inc(1, ("retried",))
+        with self._lock:
+            self.retried += 1
+        return outcome
+
+    def _run(self):
+        """Sender loop: release digests, send due messages, then sleep until woken or the poll interval"""
+        from app import db
+
+        while not self._stop_event.is_set():
+            processed = 0
+            with self.app.app_context():
+                try:
+                    self.release()
+                    processed = self.dispatch()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"SMS sender error: {str(e)}")
+                finally:
+                    db.session.remove()
+
+            # A full batch means more messages may be due
+            if processed < self.batch_size:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+def recipient_results(response):
+    """
+    Map phone numbers to their per-recipient results in an AfricasTalking response
+
+    Returns:
+        dict: Number to recipient dict with 'statusCode', 'status' and 'messageId'
+    """
+    if not isinstance(response, dict):
+        return {}
+    recipients = (response.get("SMSMessageData") or {}).get("Recipients") or []
+    return {recipient.get("number"): recipient for recipient in recipients}
+
+def setup_sms_sender(app):
+    """Initialize and start the global SMS sender"""
+    global sms_sender
+
+    if sms_sender:
+        return sms_sender
+
+    sms_sender = SMSOutboxSender(
+        app,
+        poll_interval=app.config.get('SMS_POLL_INTERVAL', 2.0),
+        batch_size=app.config.get('SMS_BATCH_SIZE', 500),
+        max_recipients=app.config.get('SMS_MAX_RECIPIENTS', 100),
+        rate_limit=app.config.get('SMS_RATE_LIMIT', 5.0),
+        max_attempts=app.config.get('SMS_MAX_ATTEMPTS', 5),
+        backoff_base=app.config.get('SMS_BACKOFF_BASE', 30.0),
+        backoff_max=app.config.get('SMS_BACKOFF_MAX', 3600.0),
+        digest_window=app.config.get('SMS_DIGEST_WINDOW', 60.0),
+        quiet_hours_offset=app.config.get('QUIET_HOURS_UTC_OFFSET', 0.0),
+        claim_timeout=app.config.get('SMS_CLAIM_TIMEOUT', 600.0)
+    )
+    sms_sender.start()
+    atexit.register(sms_sender.stop)
+
+    return sms_sender
@@ -0,0 +1,293 @@
+import atexit
+import json
+import threading
+import time
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from app.models.ussd_session import USSDSessionRecord
+
+logger = logging.getLogger(__name__)
+
+# Global USSD session store
+session_store = None
+
+# Session store backends
+BACKEND_MEMORY = 'memory'
+BACKEND_DATABASE = 'database'
+BACKEND_REDIS = 'redis'
+
+class SessionStore:
+    """
+    Interface for USSD session stores
+
+    Sessions are small JSON-serializable dicts that expire ttl seconds after
+    they were last written.
+    """
+
+    def __init__(self, ttl=180):
+        self.ttl = ttl
+
+    def get(self, session_id):
+        """
+        Get a session
+
+        Returns:
+            dict: Session data, or None if missing or expired
+        """
+        raise NotImplementedError
+
+    def set(self, session_id, data):
+        """Store a session, restarting its TTL"""
+        raise NotImplementedError
+
+    def delete(self, session_id):
+        """
+        Remove a session
+
+        Returns:
+            bool: True if the session existed
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        """Get store counters"""
+        return {}
+
+    def close(self):
+        pass
+
+class MemorySessionStore(SessionStore):
+    """
+    Per-process session store with TTL eviction and a size bound
+
+    Expired sessions are dropped on access and by a background sweeper, and
+    the least recently written sessions are evicted past max_size. Only
+    suitable for a single worker process.
+    """
+
+    def __init__(self, ttl=180, max_size=100000, sweep_interval=30.0):
+        super().__init__(ttl)
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
+
+        # session_id -> (expires_at, data), oldest write first
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self.expired = 0
+        self.evicted = 0
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._sessions[session_id]
+                self.expired += 1
+                return None
+            return json.loads(entry[1])
+
+    def set(self, session_id, data):
+        # Stored serialized, like the shared backends, so callers cannot mutate it in place
+        encoded = json.dumps(data)
+        with self._lock:
+            self._sessions[session_id] = (time.monotonic() + self.ttl, encoded)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_size:
+                self._sessions.popitem(last=False)
+                self.evicted += 1
+
+    def delete(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def sweep(self):
+        """
+        Drop expired sessions
+
+        Entries are kept in write order and share one TTL, so expired sessions
+        are always at the front.
+
+        Returns:
+            int: Number of sessions dropped
+        """
+        now = time.monotonic()
+        dropped = 0
+        with self._lock:
+            while self._sessions:
+                session_id, (expires_at, _) = next(iter(self._sessions.items()))
+                if expires_at > now:
+                    break
+                del self._sessions[session_id]
+                dropped += 1
+            self.expired += dropped
+        return dropped
+
+    def start(self):
+        """Start the background sweeper"""
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="ussd-session-sweeper", daemon=True)
+        self._thread.start()
+
+    def close(self, timeout=5.0):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": BACKEND_MEMORY,
+                "sessions": len(self._sessions),
+                "expired": self.expired,
+                "evicted": self.evicted
+            }
+
+    def _run(self):
+        while not self._stop_event.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"USSD session sweep error: {str(e)}")
+
+class DatabaseSessionStore(SessionStore):
+    """
+    Session store in the ussd_sessions table, shared by all processes using the database
+
+    Expired rows are ignored on read and deleted in bulk every sweep_every
+    writes.
+    """
+
+    def __init__(self, ttl=180, sweep_every=1000):
+        super().__init__(ttl)
+        self.sweep_every = sweep_every
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        from app import db
+
+        data = db.session.query(USSDSessionRecord.data).filter(
+            USSDSessionRecord.session_id == session_id,
+            USSDSessionRecord.expires_at > datetime.utcnow()
+        ).scalar()
+        return json.loads(data) if data is not None else None
+
+    def set(self, session_id, data):
+        from sqlalchemy import insert, update
+        from sqlalchemy.exc import IntegrityError
+        from app import db
+
+        now = datetime.utcnow()
+        values = {"data": json.dumps(data), "expires_at": now + timedelta(seconds=self.ttl), "updated_at": now}
+
+        result = db.session.execute(
+            update(USSDSessionRecord).where(USSDSessionRecord.session_id == session_id).values(**values)
+        )
+        if result.rowcount == 0:
+            try:
+                db.session.execute(insert(USSDSessionRecord).values(session_id=session_id, **values))
+            except IntegrityError:
+                # Another process created it first, overwrite it
+                db.session.rollback()
+                db.session.execute(
+                    update(USSDSessionRecord).where(USSDSessionRecord.session_id == session_id).values(**values)
+                )
+        db.session.commit()
+
+        with self._lock:
+            self._writes += 1
+            sweep = self._writes % self.sweep_every == 0
+        if sweep:
+            self.sweep()
+
+    def delete(self, session_id):
+        from sqlalchemy import delete
+        from app import db
+
+        result = db.session.execute(delete(USSDSessionRecord).where(USSDSessionRecord.session_id == session_id))
+        db.session.commit()
+        return result.rowcount > 0
+
+    def sweep(self):
+        """
+        Delete expired sessions
+
+        Returns:
+            int: Number of sessions deleted
+        """
+        from sqlalchemy import delete
+        from app import db
+
+        result = db.session.execute(delete(USSDSessionRecord).where(USSDSessionRecord.expires_at <= datetime.utcnow()))
+        db.session.commit()
+        return result.rowcount
+
+    def stats(self):
+        return {"backend": BACKEND_DATABASE, "writes": self._writes}
+
+class RedisSessionStore(SessionStore):
+    """
+    Session store in Redis, which expires keys itself (SETEX)
+
+    Works with any client implementing get, setex and delete, such as
+    redis.Redis.
+    """
+
+    def __init__(self, client, ttl=180, prefix='smart-farm:ussd:'):
+        super().__init__(ttl)
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, ttl=180):
+        import redis
+        return cls(redis.Redis.from_url(url), ttl)
+
+    def get(self, session_id):
+        data = self.client.get(self.prefix + session_id)
+        return json.loads(data) if data is not None else None
+
+    def set(self, session_id, data):
+        self.client.setex(self.prefix + session_id, int(self.ttl), json.dumps(data))
+
+    def delete(self, session_id):
+        return bool(self.client.delete(self.prefix + session_id))
+
+    def stats(self):
+        return {"backend": BACKEND_REDIS}
+
+def create_session_store(app):
+    """Create the session store configured by USSD_SESSION_BACKEND"""
+    backend = app.config.get('USSD_SESSION_BACKEND', BACKEND_MEMORY)
+    ttl = app.config.get('USSD_SESSION_TTL', 180)
+
+    if backend == BACKEND_REDIS:
+        return RedisSessionStore.from_url(app.config.get('USSD_SESSION_URL'), ttl)
+    if backend == BACKEND_DATABASE:
+        return DatabaseSessionStore(ttl)
+    if backend != BACKEND_MEMORY:
+        raise ValueError(f"Unknown USSD session backend '{backend}'")
+
+    store = MemorySessionStore(ttl, app.config.get('USSD_SESSION_MAX', 100000))
+    store.start()
+    atexit.register(store.close)
+    return store
+
+def setup_session_store(app):
+    """Initialize the global USSD session store"""
+    global session_store
+
+    if session_store is None:
+        session_store = create_session_store(app)
+        logger.info(f"USSD sessions stored in {session_store.stats().get('backend')}")
+    return session_store
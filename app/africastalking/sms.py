@@ -4,6 +4,13 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# SMS prefix per notification type
+NOTIFICATION_SMS_PREFIXES = {
+    'alert': 'ALERT',
+    'warning': 'WARNING',
+    'info': 'INFO'
+}
+
 class SMSService:
     """Service for sending SMS via AfricasTalking API"""
 
@@ -16,6 +23,22 @@ class SMSService:
         africastalking.initialize(self.username, self.api_key)
         self.sms = africastalking.SMS
 
+    def send_bulk(self, recipients, message):
+        """
+        Send one message to several recipients in a single API call
+
+        Args:
+            recipients (list): List of phone numbers
+            message (str): Message content
+
+        Raises:
+            Exception: If the API call fails
+
+        Returns:
+            dict: Response from AfricasTalking API
+        """
+        return self.sms.send(message, [format_recipient(recipient) for recipient in recipients])
+
     def send_message(self, recipients, message):
         """
         Send SMS to one or more recipients
@@ -28,15 +51,7 @@ class SMSService:
             dict: Response from AfricasTalking API
         """
         try:
-            # Validate recipients format (should include country code)
-            formatted_recipients = []
-            for recipient in recipients:
-                if not recipient.startswith('+'):
-                    recipient = '+' + recipient
-                formatted_recipients.append(recipient)
-
-            # Send the message
-            response = self.sms.send(message, formatted_recipients)
+            response = self.send_bulk(recipients, message)
             logger.info(f"SMS sent: {response}")
             return response
         except Exception as e:
@@ -56,12 +71,7 @@ class SMSService:
         Returns:
             dict: Response from AfricasTalking API
         """
-        message = (
-            f"ALERT: Your device '{device_name}' "
-            f"is consuming {power_usage:.2f}W, which exceeds the "
-            f"threshold of {threshold:.2f}W. Please check your system."
-        )
-        return self.send_message([recipient], message)
+        return self.send_message([recipient], power_alert_message(device_name, power_usage, threshold))
 
     def send_device_status_change(self, recipient, device_name, new_status):
         """
@@ -100,6 +110,66 @@ class SMSService:
         )
         return self.send_message([recipient], message)
 
+def format_recipient(phone_number):
+    """Add the leading '+' AfricasTalking expects (numbers include the country code)"""
+    phone_number = phone_number.strip()
+    return phone_number if phone_number.startswith('+') else '+' + phone_number
+
+def power_alert_message(device_name, power_usage, threshold):
+    """Text of a power usage alert"""
+    return (
+        f"ALERT: Your device '{device_name}' "
+        f"is consuming {power_usage:.2f}W, which exceeds the "
+        f"threshold of {threshold:.2f}W. Please check your system."
+    )
+
+def notification_message(notification_type, message):
+    """Text of the SMS for a single notification"""
+    return f"{NOTIFICATION_SMS_PREFIXES.get(notification_type, 'INFO')}: {message}"
+
+def digest_message(notifications, per_kind=3):
+    """
+    Text of one SMS combining several notifications
+
+    Notifications are grouped by the kind in their title ('Device Error: Pump 1'
+    is a 'Device Error' for 'Pump 1') and each kind lists up to per_kind devices.
+
+    Args:
+        notifications (list): (notification_type, title) tuples, oldest first
+        per_kind (int): Devices named per kind
+
+    Returns:
+        str: Message content
+    """
+    kinds = {}
+    critical = 0
+    for notification_type, title in notifications:
+        kind, _, subject = title.partition(': ')
+        kinds.setdefault(kind, []).append(subject or kind)
+        critical += notification_type == 'alert'
+
+    parts = []
+    for kind, subjects in kinds.items():
+        names = list(dict.fromkeys(subjects))
+        listed = ", ".join(names[:per_kind])
+        if len(names) > per_kind:
+            listed += f" +{len(names) - per_kind} more"
+        parts.append(f"{kind}: {listed}")
+
+    return (
+        f"Farm Alerts: {len(notifications)} new ({critical} critical). "
+        f"{'. '.join(parts)}. "
+        f"Please check your dashboard for details."
+    )
+
 def get_sms_service():
-    """Factory function to get SMS service instance"""
-    return SMSService()
\ No newline at end of file
+    """
+    Get the SMS service of the current app
+
+    The SDK is initialized once per app and the service is reused.
+    """
+    app = current_app._get_current_object()
+    service = app.extensions.get('sms_service')
+    if service is None:
+        service = app.extensions['sms_service'] = SMSService()
+    return service
\ No newline at end of file
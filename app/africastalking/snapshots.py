@@ -0,0 +1,368 @@
+import threading
+import time
+import logging
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+
+logger = logging.getLogger(__name__)
+
+# Device attributes shown in the USSD menus
+DeviceSnapshot = namedtuple('DeviceSnapshot', [
+    'id',
+    'name',
+    'device_type',
+    'location',
+    'status',
+    'power_state',
+    'current_power',    # watts
+    'max_power',        # watts
+    'last_updated'
+])
+
+# Today's totals over all of a user's devices
+SummarySnapshot = namedtuple('SummarySnapshot', ['total_energy', 'peak_power', 'cost_estimate'])
+
+# Everything the USSD menus show a user
+USSDSnapshot = namedtuple('USSDSnapshot', [
+    'user_id',
+    'full_name',
+    'devices',          # tuple of DeviceSnapshot ordered by ID
+    'summary',          # SummarySnapshot, or None if today has not been summarized
+    'summary_date'      # date the summary was loaded for, None once it is stale
+])
+
+# DeviceSnapshot fields that telemetry and control updates may change
+DEVICE_FIELDS = ('status', 'power_state', 'current_power', 'last_updated')
+
+class USSDSnapshotCache:
+    """
+    Bounded LRU cache of per-user USSD snapshots
+
+    A snapshot holds a user's devices and today's power summary so menu hops
+    render without queries. The telemetry and control paths apply device
+    changes to cached snapshots in place; device edits invalidate them, and
+    new daily summaries mark their summary stale. Phone numbers are resolved
+    to users through the indexed User.phone_key, falling back to the raw
+    phone number for users without one, with unregistered numbers cached
+    for negative_ttl.
+
+    Processes that do not ingest telemetry pick changes up when the
+    snapshot expires.
+    """
+
+    def __init__(self, max_size=10000, ttl=300, negative_ttl=60):
+        """
+        Args:
+            max_size (int): Maximum number of cached users
+            ttl (float): Seconds a snapshot stays cached
+            negative_ttl (float): Seconds an unregistered phone number stays cached
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        # user_id -> (USSDSnapshot, expires_at)
+        self._entries = OrderedDict()
+        # phone_key -> (user_id or None, expires_at)
+        self._phones = {}
+        # device primary key -> user_id, for the devices in cached snapshots
+        self._owners = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def init_app(self, app):
+        """Configure the cache from app settings"""
+        self.max_size = app.config.get('USSD_SNAPSHOT_CACHE_SIZE', self.max_size)
+        self.ttl = app.config.get('USSD_SNAPSHOT_TTL', self.ttl)
+        self.negative_ttl = app.config.get('USSD_SNAPSHOT_NEGATIVE_TTL', self.negative_ttl)
+        self.clear()
+
+    def lookup(self, phone_number):
+        """
+        Resolve a phone number to a user
+
+        Args:
+            phone_number (str): Phone number in any format
+
+        Returns:
+            int: User ID, or None if the number is not registered
+        """
+        from app.models.user import User, normalize_phone
+        from app import db
+
+        key = normalize_phone(phone_number)
+        if not key:
+            return None
+
+        now = time.monotonic()
+        cached = self._phones.get(key)
+        if cached and cached[1] > now:
+            return cached[0]
+
+        user_id = db.session.query(User.id).filter(User.phone_key == key).order_by(User.id).limit(1).scalar()
+        if user_id is None:
+            user_id = self._lookup_legacy(phone_number, key)
+
+        with self._lock:
+            self._phones[key] = (user_id, now + (self.ttl if user_id else self.negative_ttl))
+            if len(self._phones) > self.max_size:
+                self._prune_phones(now)
+        return user_id
+
+    def get(self, user_id):
+        """
+        Get a user's snapshot, loading it on a miss and reloading a stale summary
+
+        Args:
+            user_id (int): User ID
+
+        Returns:
+            USSDSnapshot: Snapshot, or None if the user does not exist
+        """
+        now = time.monotonic()
+        today = datetime.utcnow().date()
+
+        with self._lock:
+            cached = self._entries.get(user_id)
+            if cached and cached[1] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                snapshot = cached[0]
+                if snapshot.summary_date == today:
+                    return snapshot
+            else:
+                self.misses += 1
+                snapshot = None
+
+        if snapshot is None:
+            snapshot = self._load(user_id, today)
+            if snapshot is None:
+                return None
+            with self._lock:
+                self._store(snapshot, now + self.ttl)
+            return snapshot
+
+        summary = self._load_summary(user_id, today)
+        with self._lock:
+            cached = self._entries.get(user_id)
+            if cached:
+                snapshot = cached[0]._replace(summary=summary, summary_date=today)
+                self._entries[user_id] = (snapshot, cached[1])
+        return snapshot
+
+    def apply(self, changes):
+        """
+        Apply device changes to the cached snapshots holding those devices
+
+        Args:
+            changes (iterable): Dicts with the device primary key as 'id' and
+                any of status, power_state, current_power and last_updated
+
+        Returns:
+            int: Number of devices updated
+        """
+        updated = 0
+        with self._lock:
+            for change in changes:
+                user_id = self._owners.get(change.get("id"))
+                cached = self._entries.get(user_id) if user_id is not None else None
+                if not cached:
+                    continue
+
+                fields = {field: change[field] for field in DEVICE_FIELDS if field in change}
+                devices = tuple(
+                    device._replace(**fields) if device.id == change["id"] else device
+                    for device in cached[0].devices
+                )
+                self._entries[user_id] = (cached[0]._replace(devices=devices), cached[1])
+                updated += 1
+            self.updates += updated
+        return updated
+
+    def expire_summaries(self):
+        """Mark all cached summaries stale, e.g. after the daily summaries were regenerated"""
+        with self._lock:
+            for user_id, (snapshot, expires_at) in self._entries.items():
+                self._entries[user_id] = (snapshot._replace(summary_date=None), expires_at)
+
+    def invalidate(self, user_id, phone_number=None):
+        """
+        Drop a user's snapshot and phone numbers so the next hop reloads them
+
+        Args:
+            user_id (int): User ID
+            phone_number (str): The user's new phone number, which may be
+                cached as unregistered
+        """
+        from app.models.user import normalize_phone
+
+        new_key = normalize_phone(phone_number)
+        with self._lock:
+            if self._drop(user_id):
+                self.invalidations += 1
+            for key in [key for key, (owner, _) in self._phones.items() if owner == user_id or key == new_key]:
+                del self._phones[key]
+
+    def clear(self):
+        """Drop all cached entries"""
+        with self._lock:
+            self._entries.clear()
+            self._phones.clear()
+            self._owners.clear()
+
+    def stats(self):
+        """Get cache counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "phones": len(self._phones),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "updates": self.updates,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+    def _store(self, snapshot, expires_at):
+        """Store a snapshot, evicting the least recently used ones past max_size"""
+        self._drop(snapshot.user_id)
+        self._entries[snapshot.user_id] = (snapshot, expires_at)
+        for device in snapshot.devices:
+            self._owners[device.id] = snapshot.user_id
+
+        while len(self._entries) > self.max_size:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _drop(self, user_id):
+        """Remove a snapshot and its device owners; the lock must be held"""
+        cached = self._entries.pop(user_id, None)
+        if cached is None:
+            return False
+        for device in cached[0].devices:
+            if self._owners.get(device.id) == user_id:
+                del self._owners[device.id]
+        return True
+
+    def _prune_phones(self, now):
+        """Drop expired phone numbers, then the oldest ones past max_size"""
+        for key in [key for key, (_, expires_at) in self._phones.items() if expires_at <= now]:
+            del self._phones[key]
+        while len(self._phones) > self.max_size:
+            del self._phones[next(iter(self._phones))]
+
+    def _lookup_legacy(self, phone_number, key):
+        """
+        Match users whose phone_key was never set, as before phone_key existed
+
+        Users created before the column was added keep a NULL phone_key until
+        `flask backfill-phone-keys` runs. A user found this way gets its
+        phone_key filled in so later lookups use the index.
+        """
+        from sqlalchemy import update
+        from app.models.user import User
+        from app import db
+
+        user_id = db.session.query(User.id).filter(
+            User.phone_key.is_(None),
+            User.phone_number == phone_number.replace('+', '')
+        ).order_by(User.id).limit(1).scalar()
+
+        if user_id is not None:
+            db.session.execute(update(User).where(User.id == user_id, User.phone_key.is_(None)).values(phone_key=key))
+            db.session.commit()
+        return user_id
+
+    def _load(self, user_id, today):
+        """Load a user's snapshot with one user, one device and one summary query"""
+        from app.models.user import User
+        from app.models.device import Device
+        from app import db
+
+        full_name = db.session.query(User.full_name).filter(User.id == user_id).first()
+        if full_name is None:
+            return None
+
+        devices = db.session.query(
+            Device.id, Device.name, Device.device_type, Device.location, Device.status,
+            Device.power_state, Device.current_power, Device.max_power, Device.last_updated
+        ).filter(Device.user_id == user_id).order_by(Device.id).all()
+
+        return USSDSnapshot(
+            user_id=user_id,
+            full_name=full_name[0],
+            devices=tuple(DeviceSnapshot(*row) for row in devices),
+            summary=self._load_summary(user_id, today),
+            summary_date=today
+        )
+
+    def _load_summary(self, user_id, today):
+        """Sum today's daily summaries over a user's devices"""
+        from sqlalchemy import func
+        from app.models.device import Device
+        from app.models.power_usage import PowerSummary
+        from app import db
+
+        row = db.session.query(
+            func.count(PowerSummary.id),
+            func.sum(PowerSummary.total_energy),
+            func.max(PowerSummary.peak_power),
+            func.sum(PowerSummary.cost_estimate)
+        ).join(
+            Device, Device.id == PowerSummary.device_id
+        ).filter(
+            PowerSummary.summary_type == 'daily',
+            PowerSummary.date == today,
+            Device.user_id == user_id
+        ).one()
+
+        if not row[0]:
+            return None
+        return SummarySnapshot(row[1] or 0.0, row[2] or 0.0, row[3] or 0.0)
+
+def backfill_phone_keys(batch_size=1000):
+    """
+    Set User.phone_key for users created before the column existed
+
+    Args:
+        batch_size (int): Users updated per transaction
+
+    Returns:
+        int: Number of users updated
+    """
+    from sqlalchemy import update
+    from app.models.user import User, normalize_phone
+    from app import db
+
+    updated = 0
+    last_id = 0
+    while True:
+        rows = db.session.query(User.id, User.phone_number).filter(
+            User.phone_key.is_(None), User.id > last_id
+        ).order_by(User.id).limit(batch_size).all()
+        if not rows:
+            return updated
+
+        db.session.execute(update(User), [{"id": row.id, "phone_key": normalize_phone(row.phone_number)} for row in rows])
+        db.session.commit()
+        updated += len(rows)
+        last_id = rows[-1].id
+
+@click.command('backfill-phone-keys')
+@with_appcontext
+def backfill_phone_keys_command():
+    """Set the normalized phone number USSD lookups use for existing users"""
+    click.echo(f"Updated {backfill_phone_keys()} users")
+
+# Global USSD snapshot cache
+ussd_snapshots = USSDSnapshotCache()
@@ -1,6 +1,10 @@
+import time
+from datetime import datetime
 from flask import Blueprint, request, jsonify, current_app
-from app.models.user import User
+from sqlalchemy import update
 from app.models.device import Device
+from app.africastalking.snapshots import ussd_snapshots
+from app.metrics import USSD_CALLBACK_SECONDS
 from app import db
 import logging
 
@@ -8,6 +12,8 @@ logger = logging.getLogger(__name__)
 
 ussd_bp = Blueprint('ussd', __name__, url_prefix='/ussd')
 
+MAIN_MENU = "1. View power summary\n2. Control devices\n3. Exit"
+
 class USSDMenuState:
     """USSD menu state management"""
     WELCOME = "welcome"
@@ -18,28 +24,31 @@ class USSDMenuState:
     POWER_ALERT = "power_alert"
 
 class USSDSession:
-    """Simple USSD session manager"""
-    sessions = {}  # In production, use Redis or another persistent store
+    """USSD session manager backed by the configured session store"""
+
+    @staticmethod
+    def store():
+        from app.africastalking import sessions
+        return sessions.session_store
 
     @classmethod
     def get_session(cls, session_id):
-        return cls.sessions.get(session_id, {})
+        return cls.store().get(session_id) or {}
 
     @classmethod
     def set_session(cls, session_id, data):
-        cls.sessions[session_id] = data
-        return cls.sessions[session_id]
+        cls.store().set(session_id, data)
+        return data
 
     @classmethod
     def clear_session(cls, session_id):
-        if session_id in cls.sessions:
-            del cls.sessions[session_id]
-            return True
-        return False
+        return cls.store().delete(session_id)
 
 @ussd_bp.route('/callback', methods=['POST'])
 def ussd_callback():
     """USSD callback endpoint"""
+    started = time.perf_counter()
+
     # Get the USSD parameters
     session_id = request.form.get('sessionId')
     service_code = request.form.get('serviceCode')
@@ -56,10 +65,20 @@ def ussd_callback():
     }
 
     # Handle based on the current state and user input
+    state = session.get('state') if text else USSDMenuState.WELCOME
     response = handle_ussd_menu(session, text)
 
-    # Save the updated session
-    USSDSession.set_session(session_id, session)
+    # Save the updated session, or drop it once the menu has ended
+    if response.startswith('END'):
+        USSDSession.clear_session(session_id)
+    else:
+        USSDSession.set_session(session_id, session)
+
+    elapsed = time.perf_counter() - started
+    elapsed_ms = elapsed * 1000
+    USSD_CALLBACK_SECONDS.observe(elapsed, (state or 'unknown',))
+    if elapsed_ms > current_app.config.get('USSD_SLOW_RESPONSE_MS', 500):
+        logger.warning(f"Slow USSD response: {elapsed_ms:.0f} ms for session {session_id}, text={text}")
 
     # Return the response (must start with "CON " for continuing or "END " for ending)
     return response
@@ -72,50 +91,78 @@ def handle_ussd_menu(session, text):
     # Check if this is a new session or has no input
     if not text:
         # Find the user by phone number
-        user = User.query.filter_by(phone_number=phone.replace('+', '')).first()
-        if not user:
+        user_id = ussd_snapshots.lookup(phone)
+        snapshot = ussd_snapshots.get(user_id) if user_id else None
+        if not snapshot:
             return "END Sorry, your phone number is not registered in our system."
 
-        session['user_id'] = user.id
-        return show_welcome_menu(user)
+        session['user_id'] = user_id
+        return show_welcome_menu(snapshot)
+
+    snapshot = ussd_snapshots.get(session.get('user_id'))
+    if not snapshot:
+        return "END Sorry, your phone number is not registered in our system."
 
     # Process input based on current state
     if state == USSDMenuState.WELCOME or state == USSDMenuState.MAIN_MENU:
-        return handle_main_menu(session, text)
+        return handle_main_menu(session, snapshot, text)
     elif state == USSDMenuState.DEVICE_LIST:
-        return handle_device_list(session, text)
+        return handle_device_list(session, snapshot, text)
     elif state == USSDMenuState.DEVICE_CONTROL:
-        return handle_device_control(session, text)
+        return handle_device_control(session, snapshot, text)
     elif state == USSDMenuState.POWER_SUMMARY:
         return handle_power_summary(session, text)
 
     # Default response if state is unknown
     session['state'] = USSDMenuState.MAIN_MENU
-    return "CON An error occurred. Returning to main menu.\n1. View power summary\n2. Control devices\n3. Exit"
+    return "CON An error occurred. Returning to main menu.\n" + MAIN_MENU
 
-def show_welcome_menu(user):
+def show_welcome_menu(snapshot):
     """Show welcome menu for the user"""
-    welcome_text = f"CON Welcome to Smart Farm Power Control, {user.full_name}\n"
-    menu_text = "1. View power summary\n2. Control devices\n3. Exit"
-    return welcome_text + menu_text
+    welcome_text = f"CON Welcome to Smart Farm Power Control, {snapshot.full_name}\n"
+    return welcome_text + MAIN_MENU
+
+def show_device_list(session, snapshot):
+    """Show the user's devices and remember their order in the session"""
+    session['state'] = USSDMenuState.DEVICE_LIST
+
+    if not snapshot.devices:
+        return "END You don't have any devices registered yet."
+
+    response = "CON Select a device to control:\n"
+    for i, device in enumerate(snapshot.devices, 1):
+        status = "ON" if device.power_state else "OFF"
+        response += f"{i}. {device.name} [{status}]\n"
 
-def handle_main_menu(session, text):
+    response += "0. Back to main menu"
+    session['devices'] = [d.id for d in snapshot.devices]
+    return response
+
+def show_device(device):
+    """Show a device with its control options"""
+    return (
+        f"CON Device: {device.name}\n"
+        f"Status: {'ON' if device.power_state else 'OFF'}\n"
+        f"Current Power: {device.current_power or 0:.2f} W\n\n"
+        f"1. Turn {('OFF' if device.power_state else 'ON')}\n"
+        f"2. View device details\n"
+        f"0. Back to device list"
+    )
+
+def find_device(snapshot, device_id):
+    """Find a device in the user's snapshot"""
+    return next((device for device in snapshot.devices if device.id == device_id), None)
+
+def handle_main_menu(session, snapshot, text):
     """Handle main menu selection"""
-    user_id = session.get('user_id')
+    # Africa's Talking sends every input of the session joined by '*'
+    text = text.split('*')[-1]
 
     # Update the session state based on selection
     if text == "1":
         # Power Summary
         session['state'] = USSDMenuState.POWER_SUMMARY
-        # Get power summary data
-        from app.models.power_usage import PowerSummary
-        import datetime
-
-        today = datetime.date.today()
-        summary = PowerSummary.query.filter_by(
-            summary_type='daily',
-            date=today
-        ).first()
+        summary = snapshot.summary
 
         if not summary:
             return "END No power data available for today. Please check again later."
@@ -130,20 +177,7 @@ def handle_main_menu(session, text):
 
     elif text == "2":
         # Device Control - Show device list
-        session['state'] = USSDMenuState.DEVICE_LIST
-        devices = Device.query.filter_by(user_id=user_id).all()
-
-        if not devices:
-            return "END You don't have any devices registered yet."
-
-        response = "CON Select a device to control:\n"
-        for i, device in enumerate(devices, 1):
-            status = "ON" if device.power_state else "OFF"
-            response += f"{i}. {device.name} [{status}]\n"
-
-        response += "0. Back to main menu"
-        session['devices'] = [d.id for d in devices]
-        return response
+        return show_device_list(session, snapshot)
 
     elif text == "3":
         # Exit
@@ -151,103 +185,92 @@ def handle_main_menu(session, text):
 
     else:
         # Invalid selection
-        return "CON Invalid selection. Please try again:\n1. View power summary\n2. Control devices\n3. Exit"
+        return "CON Invalid selection. Please try again:\n" + MAIN_MENU
 
-def handle_device_list(session, text):
+def handle_device_list(session, snapshot, text):
     """Handle device selection from the list"""
-    if text == "0":
+    last_input = text.split('*')[-1]
+
+    if last_input == "0":
         # Back to main menu
         session['state'] = USSDMenuState.MAIN_MENU
-        return "CON Main Menu:\n1. View power summary\n2. Control devices\n3. Exit"
+        return "CON Main Menu:\n" + MAIN_MENU
 
     try:
-        selection = int(text.split('*')[-1])
+        selection = int(last_input)
         devices = session.get('devices', [])
 
         if 1 <= selection <= len(devices):
             device_id = devices[selection - 1]
-            device = Device.query.get(device_id)
+            device = find_device(snapshot, device_id)
 
             if not device:
                 return "END Device not found. Please try again later."
 
             session['selected_device'] = device_id
             session['state'] = USSDMenuState.DEVICE_CONTROL
-
-            status = "ON" if device.power_state else "OFF"
-            return (
-                f"CON Device: {device.name}\n"
-                f"Status: {status}\n"
-                f"Current Power: {device.current_power:.2f} W\n\n"
-                f"1. Turn {('OFF' if device.power_state else 'ON')}\n"
-                f"2. View device details\n"
-                f"0. Back to device list"
-            )
+            return show_device(device)
         else:
             return "CON Invalid selection. Please select a valid device number or 0 to go back."
 
     except ValueError:
         return "CON Invalid input. Please select a valid device number or 0 to go back."
 
-def handle_device_control(session, text):
+def handle_device_control(session, snapshot, text):
     """Handle device control operations"""
-    device_id = session.get('selected_device')
-    device = Device.query.get(device_id)
+    device = find_device(snapshot, session.get('selected_device'))
 
     if not device:
-        session['state'] = USSDMenuState.DEVICE_LIST
-        return "CON Device not found. Returning to device list."
+        return show_device_list(session, snapshot)
 
     # Get the last input (after the last *)
     last_input = text.split('*')[-1]
 
     if last_input == "0":
         # Back to device list
-        session['state'] = USSDMenuState.DEVICE_LIST
         session['selected_device'] = None
-        return handle_device_list(session, "")
+        return show_device_list(session, snapshot)
 
     elif last_input == "1":
         # Toggle power state
         new_state = not device.power_state
-        device.update_power_state(new_state)
+        set_power_state(snapshot.user_id, device, new_state)
 
         status = "ON" if new_state else "OFF"
         return f"END Device '{device.name}' has been turned {status}."
 
     elif last_input == "2":
         # View device details
+        last_updated = device.last_updated.strftime('%Y-%m-%d %H:%M') if device.last_updated else 'never'
         return (
             f"END Device Details: {device.name}\n"
             f"Type: {device.device_type}\n"
             f"Location: {device.location}\n"
             f"Status: {device.status}\n"
             f"Power State: {'ON' if device.power_state else 'OFF'}\n"
-            f"Current Power: {device.current_power:.2f} W\n"
-            f"Max Power: {device.max_power:.2f} W\n"
-            f"Last Updated: {device.last_updated.strftime('%Y-%m-%d %H:%M')}"
+            f"Current Power: {device.current_power or 0:.2f} W\n"
+            f"Max Power: {device.max_power or 0:.2f} W\n"
+            f"Last Updated: {last_updated}"
         )
 
     else:
-        return (
-            f"CON Device: {device.name}\n"
-            f"Status: {'ON' if device.power_state else 'OFF'}\n"
-            f"Current Power: {device.current_power:.2f} W\n\n"
-            f"1. Turn {('OFF' if device.power_state else 'ON')}\n"
-            f"2. View device details\n"
-            f"0. Back to device list"
-        )
+        return show_device(device)
 
-def handle_power_summary(session, text):
-    """Handle power summary view"""
-    last_input = text.split('*')[-1]
+def set_power_state(user_id, device, state):
+    """Save a device's new power state with one UPDATE and apply it to the snapshot and dashboards"""
+    from app.iot.events import EVENT_DEVICE, publish_event
 
-    if last_input == "0":
-        # Back to main menu
-        session['state'] = USSDMenuState.MAIN_MENU
-        return "CON Main Menu:\n1. View power summary\n2. Control devices\n3. Exit"
+    changes = {"power_state": state, "last_updated": datetime.utcnow()}
+    db.session.execute(
+        update(Device).where(Device.id == device.id, Device.user_id == user_id).values(**changes)
+    )
+    db.session.commit()
 
-    else:
-        # Any other input also goes back to main menu
-        session['state'] = USSDMenuState.MAIN_MENU
-        return "CON Main Menu:\n1. View power summary\n2. Control devices\n3. Exit"
\ No newline at end of file
+    ussd_snapshots.apply([dict(changes, id=device.id)])
+    publish_event(user_id, EVENT_DEVICE, dict(changes, id=device.id))
+
+def handle_power_summary(session, text):
+    """Handle power summary view"""
+    # Any input goes back to the main menu
+    session['state'] = USSDMenuState.MAIN_MENU
+    return "CON Main Menu:\n" + MAIN_MENU
@@ -3,4 +3,4 @@ from flask import Blueprint
 api_bp = Blueprint('api', __name__)
 
 # Import routes to register them with the blueprint
-from app.api import routes, device_routes, power_routes, user_routes, notification_routes
\ No newline at end of file
+from app.api import routes, device_routes, power_routes, user_routes, notification_routes, event_routes
\ No newline at end of file
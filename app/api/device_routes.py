@@ -1,8 +1,14 @@
 from flask import jsonify, request, current_app
+from datetime import datetime
+from sqlalchemy import update
 from app.api import api_bp
 from app.api.routes import token_required
 from app.models.device import Device, DeviceType
-from app.iot.mqtt_client import send_device_control
+from app.iot.mqtt_client import send_device_controls
+from app.iot.commands import COMMAND_CONFIRMED, requested_wait, send_command, wait_for_all
+from app.iot.device_registry import device_registry
+from app.api.power_routes import dashboard_cache
+from app.africastalking.snapshots import ussd_snapshots
 from app import db
 
 import logging
@@ -82,6 +88,11 @@ def create_device(current_user):
     db.session.add(device)
     db.session.commit()
 
+    # Forget any cached "unknown device" entry for this ID
+    device_registry.invalidate(device.device_id)
+    dashboard_cache.invalidate(current_user.id)
+    ussd_snapshots.invalidate(current_user.id)
+
     return jsonify({
         'message': 'Device created successfully',
         'device': device.to_dict()
@@ -126,6 +137,9 @@ def update_device(current_user, device_id):
         device.max_power = float(data['max_power'])
 
     db.session.commit()
+    device_registry.invalidate(device.device_id)
+    dashboard_cache.invalidate(current_user.id)
+    ussd_snapshots.invalidate(current_user.id)
 
     return jsonify({
         'message': 'Device updated successfully',
@@ -151,6 +165,9 @@ def delete_device(current_user, device_id):
 
     db.session.delete(device)
     db.session.commit()
+    device_registry.invalidate(device.device_id)
+    dashboard_cache.invalidate(current_user.id)
+    ussd_snapshots.invalidate(current_user.id)
 
     return jsonify({
         'message': 'Device deleted successfully'
@@ -165,8 +182,14 @@ def control_device(current_user, device_id):
     Args:
         device_id (int): Device ID
 
+    Request Body:
+        command (str): Command name (e.g., 'power')
+        value: Command value
+        wait (bool): Wait for the device to confirm the command
+        timeout (float): Seconds to wait for confirmation
+
     Returns:
-        JSON: Success or error message
+        JSON: Success or error message, 504 if the device did not confirm in time
     """
     device = Device.query.filter_by(id=device_id, user_id=current_user.id).first()
 
@@ -180,22 +203,152 @@ def control_device(current_user, device_id):
 
     command = data['command']
     value = data.get('value')
+    wait = requested_wait(data)
 
     # Send command to device via MQTT
-    success = send_device_control(device.device_id, command, value)
+    success, pending = send_command(device.device_id, command, value, device.power_state)
 
     if not success:
         return jsonify({'error': 'Failed to send command to device'}), 500
 
+    if wait is not None and pending and not pending.wait(wait):
+        return jsonify({
+            'error': 'Device did not confirm the command in time',
+            'command': pending.to_dict()
+        }), 504
+
     # If the command is to turn power on/off, update the device state
     if command == 'power':
         if isinstance(value, bool):
             device.update_power_state(value)
         elif value in ['on', 'off']:
             device.update_power_state(value == 'on')
+        dashboard_cache.invalidate(current_user.id)
+
+    return jsonify({
+        'message': f'Command {command} sent successfully to device',
+        'command': pending.to_dict() if pending else None
+    })
+
+def parse_power_value(value):
+    """Get the power state for a 'power' command value, or None if it is not a valid state"""
+    if isinstance(value, bool):
+        return value
+    if value in ['on', 'off']:
+        return value == 'on'
+    return None
+
+def is_integer(value):
+    """Check for a JSON integer; bool is a subclass of int but not an ID"""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+# Device columns a bulk control selector may filter on, with their value check
+SELECTOR_FIELDS = {
+    'device_type': lambda value: isinstance(value, str),
+    'location': lambda value: isinstance(value, str),
+    'user_id': is_integer
+}
+
+@api_bp.route('/devices/control', methods=['POST'])
+@token_required
+def control_devices(current_user):
+    """
+    Send a control command to many devices at once
+
+    Devices are given by ID or by a selector. Commands are published in one
+    pass with a limit on unacknowledged publishes, and power state changes
+    are saved with a single UPDATE.
+
+    Request Body:
+        command (str): Command name (e.g., 'power')
+        value: Command value
+        device_ids (list): Device IDs, or
+        selector (dict): Any of device_type, location and, for admins, user_id
+        wait (bool): Wait for the devices to confirm the command
+        timeout (float): Seconds to wait for confirmation
+
+    Returns:
+        JSON: Result per device ID and success/failure counts
+    """
+    data = request.get_json()
+
+    if not data or 'command' not in data:
+        return jsonify({'error': 'Command is required'}), 400
+
+    command = data['command']
+    value = data.get('value')
+    wait = requested_wait(data)
+    device_ids = data.get('device_ids')
+    selector = data.get('selector')
+
+    if command == 'power' and parse_power_value(value) is None:
+        return jsonify({'error': "Power value must be true, false, 'on' or 'off'"}), 400
+
+    if not device_ids and not selector:
+        return jsonify({'error': 'device_ids or selector is required'}), 400
+
+    query = Device.query
+
+    # Admins may control any user's devices, everyone else only their own
+    if not current_user.is_admin:
+        query = query.filter(Device.user_id == current_user.id)
+
+    if device_ids:
+        if not isinstance(device_ids, list) or not all(is_integer(i) for i in device_ids):
+            return jsonify({'error': 'device_ids must be a list of integers'}), 400
+        query = query.filter(Device.id.in_(device_ids))
+    else:
+        if not isinstance(selector, dict):
+            return jsonify({'error': 'selector must be an object'}), 400
+        unknown = set(selector) - set(SELECTOR_FIELDS)
+        if unknown:
+            return jsonify({'error': f"Unknown selector fields: {', '.join(sorted(unknown))}"}), 400
+        invalid = [field for field, value in selector.items() if not SELECTOR_FIELDS[field](value)]
+        if invalid:
+            return jsonify({'error': f"Invalid selector values: {', '.join(sorted(invalid))}"}), 400
+        if 'user_id' in selector and not current_user.is_admin and selector['user_id'] != current_user.id:
+            return jsonify({'error': 'Admin access required'}), 403
+        query = query.filter_by(**selector)
+
+    devices = query.all()
+
+    # Send all commands in one pass
+    sent = send_device_controls([(device.device_id, command, value, device.power_state) for device in devices])
+
+    if wait is not None:
+        wait_for_all([pending for _, pending in sent.values() if pending], wait)
+
+    results = {}
+    succeeded = []
+    for device in devices:
+        error, pending = sent.get(device.device_id, ('Failed to send command to device', None))
+        if error is None and wait is not None and pending and pending.status != COMMAND_CONFIRMED:
+            error = 'Device did not confirm the command in time'
+
+        results[device.id] = {'device_id': device.device_id, 'success': error is None, 'error': error}
+        if pending:
+            results[device.id]['command'] = pending.to_dict()
+        if error is None:
+            succeeded.append(device.id)
+
+    # Devices requested by ID that were not found or are not the user's
+    for device_id in device_ids or []:
+        if device_id not in results:
+            results[device_id] = {'device_id': None, 'success': False, 'error': 'Device not found'}
+
+    # Save power state changes with a single UPDATE
+    if command == 'power' and succeeded:
+        changes = {'power_state': parse_power_value(value), 'last_updated': datetime.utcnow()}
+        db.session.execute(update(Device).where(Device.id.in_(succeeded)).values(**changes))
+        db.session.commit()
+        ussd_snapshots.apply(dict(changes, id=device_pk) for device_pk in succeeded)
+        for user_id in {device.user_id for device in devices if device.id in succeeded}:
+            dashboard_cache.invalidate(user_id)
 
     return jsonify({
-        'message': f'Command {command} sent successfully to device'
+        'results': results,
+        'succeeded': len(succeeded),
+        'failed': len(results) - len(succeeded)
     })
 
 @api_bp.route('/device-types', methods=['GET'])
@@ -0,0 +1,47 @@
+from flask import Response, current_app, stream_with_context
+from app.api import api_bp
+from app.api.routes import token_required
+
+import logging
+logger = logging.getLogger(__name__)
+
+def event_stream_response(user_id):
+    """
+    Build the Server-Sent Events response streaming a user's live events
+
+    Args:
+        user_id (int): User ID
+
+    Returns:
+        Response: text/event-stream response
+    """
+    from app.iot.events import sse_stream
+
+    stream = sse_stream(
+        user_id,
+        keepalive=current_app.config.get('EVENTS_KEEPALIVE', 15.0),
+        max_duration=current_app.config.get('EVENTS_STREAM_TIMEOUT', 300.0)
+    )
+    return Response(
+        stream_with_context(stream),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # Stop nginx from buffering the stream
+        }
+    )
+
+@api_bp.route('/events', methods=['GET'])
+@token_required
+def stream_events(current_user):
+    """
+    Stream live device power, device state and notification events
+
+    Events are pushed as they are ingested instead of being polled. Event
+    types are 'power', 'device', 'notification' and 'resync' (some events
+    were dropped, reload the data).
+
+    Returns:
+        Response: Server-Sent Events stream
+    """
+    return event_stream_response(current_user.id)
@@ -1,22 +1,53 @@
-from flask import jsonify, request
+from flask import jsonify, request, current_app
+from sqlalchemy import case, func
 from app.api import api_bp
 from app.api.routes import token_required
+from app.api.pagination import (
+    CountCache, COUNT_EXACT, COUNT_APPROX, COUNT_MODES, encode_cursor, decode_cursor, after_cursor
+)
 from app.models.notification import Notification
 from app import db
 
 import logging
 logger = logging.getLogger(__name__)
 
+# Per-user notification counts for count=approx
+notification_counts = CountCache()
+
+def count_notifications(user_id):
+    """
+    Count a user's notifications and unread notifications in one query
+
+    Args:
+        user_id (int): User ID
+
+    Returns:
+        dict: 'total' and 'unread' counts
+    """
+    total, unread = db.session.query(
+        func.count(Notification.id),
+        func.coalesce(func.sum(case((Notification.is_read == False, 1), else_=0)), 0)
+    ).filter(Notification.user_id == user_id).one()
+
+    counts = {'total': total, 'unread': int(unread)}
+    notification_counts.put(user_id, counts, ttl=current_app.config['PAGINATION_COUNT_TTL'])
+    return counts
+
 @api_bp.route('/notifications', methods=['GET'])
 @token_required
 def get_notifications(current_user):
     """
-    Get user notifications
+    Get user notifications, newest first
+
+    Pass the returned next_cursor as after to fetch the next page. Offset
+    pagination is still accepted but gets slower the deeper the page.
 
     Query Parameters:
         unread_only (bool): Filter to only unread notifications
         limit (int): Maximum number of notifications to return
-        offset (int): Offset for pagination
+        after (str): Cursor returned by the previous page
+        offset (int): Offset for pagination (ignored when after is given)
+        count (str): 'exact' (default), 'approx' (cached for a few seconds) or 'none'
 
     Returns:
         JSON: List of notifications
@@ -25,27 +56,53 @@ def get_notifications(current_user):
     unread_only = request.args.get('unread_only', 'false').lower() == 'true'
     limit = request.args.get('limit', 20, type=int)
     offset = request.args.get('offset', 0, type=int)
+    count_mode = request.args.get('count', COUNT_EXACT)
+
+    if count_mode not in COUNT_MODES:
+        return jsonify({'error': f"Invalid count. Use one of: {', '.join(COUNT_MODES)}"}), 400
 
-    # Build query
-    query = Notification.query.filter_by(user_id=current_user.id)
+    # Build query, newest first
+    query = Notification.query.filter_by(user_id=current_user.id) \
+        .order_by(Notification.timestamp.desc(), Notification.id.desc())
 
     if unread_only:
         query = query.filter_by(is_read=False)
 
-    # Get total count before applying pagination
-    total_count = query.count()
-
-    # Apply sorting and pagination
-    notifications = query.order_by(Notification.timestamp.desc()) \
-        .offset(offset) \
-        .limit(limit) \
-        .all()
+    if request.args.get('after'):
+        try:
+            cursor = decode_cursor(request.args['after'])
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        query = query.filter(after_cursor(Notification.timestamp, Notification.id, cursor, descending=True))
+    elif offset:
+        query = query.offset(offset)
+
+    # Fetch one extra row to know whether there is a next page
+    notifications = query.limit(limit + 1).all()
+
+    next_cursor = None
+    if len(notifications) > limit:
+        notifications = notifications[:limit]
+        next_cursor = encode_cursor(notifications[-1].timestamp, notifications[-1].id)
+
+    # Total and unread counts
+    if count_mode == COUNT_EXACT:
+        counts = count_notifications(current_user.id)
+    elif count_mode == COUNT_APPROX:
+        counts = notification_counts.get(
+            current_user.id,
+            lambda: count_notifications(current_user.id),
+            ttl=current_app.config['PAGINATION_COUNT_TTL']
+        )
+    else:
+        counts = None
 
     return jsonify({
         'notifications': [notification.to_dict() for notification in notifications],
         'count': len(notifications),
-        'total_count': total_count,
-        'unread_count': Notification.query.filter_by(user_id=current_user.id, is_read=False).count()
+        'next_cursor': next_cursor,
+        'total_count': (counts['unread'] if unread_only else counts['total']) if counts else None,
+        'unread_count': counts['unread'] if counts else None
     })
 
 @api_bp.route('/notifications/<int:notification_id>', methods=['GET'])
@@ -93,6 +150,7 @@ def mark_notification_read(current_user, notification_id):
         return jsonify({'error': 'Notification not found'}), 404
 
     notification.mark_as_read()
+    notification_counts.invalidate(current_user.id)
 
     return jsonify({
         'message': 'Notification marked as read',
@@ -121,6 +179,7 @@ def mark_all_notifications_read(current_user):
         count += 1
 
     db.session.commit()
+    notification_counts.invalidate(current_user.id)
 
     return jsonify({
         'message': 'All notifications marked as read',
@@ -149,6 +208,7 @@ def delete_notification(current_user, notification_id):
 
     db.session.delete(notification)
     db.session.commit()
+    notification_counts.invalidate(current_user.id)
 
     return jsonify({
         'message': 'Notification deleted',
@@ -174,6 +234,7 @@ def clear_all_notifications(current_user):
         count += 1
 
     db.session.commit()
+    notification_counts.invalidate(current_user.id)
 
     return jsonify({
         'message': 'All notifications cleared',
@@ -0,0 +1,104 @@
+import base64
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import and_, or_
+
+COUNT_EXACT = 'exact'
+COUNT_APPROX = 'approx'
+COUNT_NONE = 'none'
+COUNT_MODES = (COUNT_EXACT, COUNT_APPROX, COUNT_NONE)
+
+def encode_cursor(timestamp, row_id):
+    """
+    Encode a (timestamp, id) position as an opaque cursor token
+
+    Args:
+        timestamp (datetime): Timestamp of the last row returned
+        row_id (int): ID of the last row returned
+
+    Returns:
+        str: URL-safe cursor token
+    """
+    raw = f"{timestamp.isoformat()}|{row_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(token):
+    """
+    Decode a cursor token created by encode_cursor
+
+    Raises:
+        ValueError: If the token is malformed
+
+    Returns:
+        tuple: (timestamp, id)
+    """
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+        timestamp, row_id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+def after_cursor(timestamp_column, id_column, cursor, descending=False):
+    """
+    Build the keyset condition for rows after a cursor position
+
+    Args:
+        timestamp_column (Column): Timestamp column of the sort key
+        id_column (Column): ID column breaking timestamp ties
+        cursor (tuple): (timestamp, id) of the last row returned
+        descending (bool): True if rows are sorted newest first
+
+    Returns:
+        BinaryExpression: Filter condition
+    """
+    timestamp, row_id = cursor
+    if descending:
+        return or_(timestamp_column < timestamp, and_(timestamp_column == timestamp, id_column < row_id))
+    return or_(timestamp_column > timestamp, and_(timestamp_column == timestamp, id_column > row_id))
+
+class TTLCache:
+    """Short-lived cache of computed values that expire after a TTL"""
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, compute, ttl=None):
+        """
+        Get a cached value, computing and storing it if missing or expired
+
+        Args:
+            key (hashable): Cache key
+            compute (callable): Function returning the fresh value
+            ttl (float): Optional override of the default TTL in seconds
+
+        Returns:
+            object: Cached or freshly computed value
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                return entry[1]
+
+        value = compute()
+        self.put(key, value, ttl)
+        return value
+
+    def put(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class CountCache(TTLCache):
+    """Short-lived cache of expensive listing counts, keyed per user"""
@@ -1,16 +1,27 @@
-from flask import jsonify, request
-from datetime import datetime
+from flask import jsonify, request, current_app, Response, stream_with_context
+from datetime import datetime, timedelta
+from sqlalchemy import func, select
+import csv
+import hashlib
+import io
+import json
 import logging
+import zlib
 
 from app.api import api_bp
 from app.api.routes import token_required
+from app.api.pagination import TTLCache, encode_cursor, decode_cursor, after_cursor
 from app.models.power_usage import PowerReading, PowerSummary, EnergyRate
 from app.models.device import Device
 from app.iot.sensor_data import get_device_power_stats, get_farm_power_summary
+from app.iot.analytics import load_series, series_stats
 from app import db
 
 logger = logging.getLogger(__name__)
 
+# Per-user (etag, data) of the power dashboard
+dashboard_cache = TTLCache()
+
 @api_bp.route('/power/summary', methods=['GET'])
 @token_required
 def get_power_summary(current_user):
@@ -80,6 +91,49 @@ def get_device_power(current_user, device_id):
 
     return jsonify(stats)
 
+@api_bp.route('/power/devices/<int:device_id>/analytics', methods=['GET'])
+@token_required
+def get_device_power_analytics(current_user, device_id):
+    """
+    Get detailed power analytics for a specific device
+
+    Args:
+        device_id (int): Device ID
+
+    Query Parameters:
+        start_time (str): Start time (ISO format), defaults to 24 hours ago
+        end_time (str): End time (ISO format)
+        on_threshold (float): Power in watts above which the device counts as on
+        max_gap (float): Seconds between readings reported as a gap
+
+    Returns:
+        JSON: Energy, power statistics, percentiles, duty cycle and gaps
+    """
+    # Verify device belongs to user
+    device = Device.query.filter_by(id=device_id, user_id=current_user.id).first()
+
+    if not device:
+        return jsonify({'error': 'Device not found or unauthorized'}), 404
+
+    try:
+        start_time = datetime.fromisoformat(request.args['start_time']) if request.args.get('start_time') \
+            else datetime.utcnow() - timedelta(days=1)
+        end_time = datetime.fromisoformat(request.args['end_time']) if request.args.get('end_time') else None
+    except ValueError:
+        return jsonify({'error': 'Invalid time format. Use ISO format'}), 400
+
+    series = load_series(device_id, start_time, end_time)
+    stats = series_stats(
+        series,
+        on_threshold=request.args.get('on_threshold', 1.0, type=float),
+        max_gap=request.args.get('max_gap', 300, type=float)
+    )
+    stats['device_id'] = device_id
+    stats['start_time'] = start_time.isoformat()
+    stats['end_time'] = end_time.isoformat() if end_time else None
+
+    return jsonify(stats)
+
 @api_bp.route('/power/readings', methods=['GET'])
 @token_required
 def get_power_readings(current_user):
@@ -91,9 +145,10 @@ def get_power_readings(current_user):
         start_time (str): Start time (ISO format)
         end_time (str): End time (ISO format)
         limit (int): Maximum number of readings to return
+        after (str): Cursor returned by the previous page
 
     Returns:
-        JSON: Power readings
+        JSON: Power readings, newest first, and the cursor of the next page
     """
     # Parse query parameters
     device_id = request.args.get('device_id', type=int)
@@ -133,20 +188,189 @@ def get_power_readings(current_user):
         except ValueError:
             return jsonify({'error': 'Invalid end_time format. Use ISO format'}), 400
 
-    # Order by timestamp (descending)
-    query = query.order_by(PowerReading.timestamp.desc())
+    # Continue after the last reading of the previous page
+    if request.args.get('after'):
+        try:
+            cursor = decode_cursor(request.args['after'])
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        query = query.filter(after_cursor(PowerReading.timestamp, PowerReading.id, cursor, descending=True))
+
+    # Order by timestamp (descending), id breaking ties
+    query = query.order_by(PowerReading.timestamp.desc(), PowerReading.id.desc())
 
-    # Apply limit
-    query = query.limit(limit)
+    # Apply limit, fetching one extra row to know whether there is a next page
+    query = query.limit(limit + 1)
 
     # Execute query
     readings = query.all()
 
+    next_cursor = None
+    if len(readings) > limit:
+        readings = readings[:limit]
+        next_cursor = encode_cursor(readings[-1].timestamp, readings[-1].id)
+
     return jsonify({
         'readings': [reading.to_dict() for reading in readings],
-        'count': len(readings)
+        'count': len(readings),
+        'next_cursor': next_cursor
     })
 
+EXPORT_COLUMNS = ('id', 'timestamp', 'power_usage', 'voltage', 'current',
+                  'power_factor', 'energy_consumed', 'device_id')
+EXPORT_FETCH_SIZE = 1000
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+def export_rows(query, row_limit=None):
+    """
+    Stream reading rows from a server-side cursor
+
+    Args:
+        query (Select): Keyset-ordered reading query
+        row_limit (int): Optional maximum number of rows
+
+    Yields:
+        tuple: Reading rows, followed by a next cursor token (str) if rows remain
+    """
+    if row_limit:
+        query = query.limit(row_limit + 1)
+
+    result = db.session.execute(query.execution_options(yield_per=EXPORT_FETCH_SIZE))
+    emitted = 0
+    last = None
+    try:
+        for row in result:
+            if row_limit and emitted == row_limit:
+                yield encode_cursor(last.timestamp, last.id)
+                return
+            yield row
+            last = row
+            emitted += 1
+    finally:
+        result.close()
+
+def format_ndjson(rows):
+    for row in rows:
+        if isinstance(row, str):
+            yield json.dumps({'next_cursor': row}) + '\n'
+        else:
+            record = dict(zip(EXPORT_COLUMNS, row))
+            record['timestamp'] = row.timestamp.isoformat()
+            yield json.dumps(record) + '\n'
+
+def format_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        if isinstance(row, str):
+            buffer.write(f'# next_cursor={row}\n')
+        else:
+            writer.writerow((row.id, row.timestamp.isoformat()) + tuple(row)[2:])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+def encode_chunks(lines, compress=False):
+    """
+    Group text lines into chunks of bytes, optionally gzip compressed
+
+    Args:
+        lines (iterable): Text lines
+        compress (bool): Whether to gzip the output
+
+    Yields:
+        bytes: Output chunks
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    pending = []
+    size = 0
+    for line in lines:
+        pending.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_SIZE:
+            data = ''.join(pending).encode('utf-8')
+            pending, size = [], 0
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+    data = ''.join(pending).encode('utf-8')
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+@api_bp.route('/power/readings/export', methods=['GET'])
+@token_required
+def export_power_readings(current_user):
+    """
+    Stream power readings as NDJSON or CSV in (timestamp, id) order
+
+    Rows are read through a server-side cursor and written as they are
+    fetched, so memory use does not depend on the size of the range. When
+    limit is reached a next_cursor is written as the last line; pass it back
+    as after to resume the export.
+
+    Query Parameters:
+        device_id (int): Optional device ID
+        start_time (str): Start time (ISO format)
+        end_time (str): End time (ISO format)
+        format (str): 'ndjson' (default) or 'csv'
+        gzip (bool): Gzip the response body
+        after (str): Cursor returned by a previous export
+        limit (int): Optional maximum number of readings
+
+    Returns:
+        Response: Streamed readings
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({'error': "Invalid format. Use 'ndjson' or 'csv'"}), 400
+
+    compress = request.args.get('gzip', 'false').lower() in ('true', '1', 'yes')
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit <= 0:
+        return jsonify({'error': 'limit must be positive'}), 400
+
+    device_id = request.args.get('device_id', type=int)
+    if device_id:
+        device = Device.query.filter_by(id=device_id, user_id=current_user.id).first()
+        if not device:
+            return jsonify({'error': 'Device not found or unauthorized'}), 404
+        device_filter = PowerReading.device_id == device_id
+    else:
+        owned = select(Device.id).where(Device.user_id == current_user.id)
+        device_filter = PowerReading.device_id.in_(owned)
+
+    query = select(*[getattr(PowerReading, column) for column in EXPORT_COLUMNS]).where(device_filter)
+
+    try:
+        if request.args.get('start_time'):
+            query = query.where(PowerReading.timestamp >= datetime.fromisoformat(request.args['start_time']))
+        if request.args.get('end_time'):
+            query = query.where(PowerReading.timestamp <= datetime.fromisoformat(request.args['end_time']))
+    except ValueError:
+        return jsonify({'error': 'Invalid time format. Use ISO format'}), 400
+
+    if request.args.get('after'):
+        try:
+            cursor = decode_cursor(request.args['after'])
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        query = query.where(after_cursor(PowerReading.timestamp, PowerReading.id, cursor))
+
+    query = query.order_by(PowerReading.timestamp, PowerReading.id)
+
+    formatter = format_csv if export_format == 'csv' else format_ndjson
+    body = encode_chunks(formatter(export_rows(query, limit)), compress)
+
+    headers = {'Content-Disposition': f'attachment; filename=power_readings.{export_format}'}
+    if compress:
+        headers['Content-Encoding'] = 'gzip'
+
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(body), mimetype=mimetype, headers=headers)
+
 @api_bp.route('/power/rates', methods=['GET'])
 @token_required
 def get_energy_rates(current_user):
@@ -243,78 +467,98 @@ def create_energy_rate(current_user):
         logger.error(f"Error creating energy rate: {str(e)}")
         return jsonify({'error': 'Failed to create energy rate'}), 500
 
-@api_bp.route('/power/dashboard', methods=['GET'])
-@token_required
-def get_power_dashboard(current_user):
+def build_power_dashboard(user_id):
     """
-    Get power dashboard data for the current user
+    Build the power dashboard of a user with two queries
+
+    Daily summaries of the user's devices for the last 8 days are summed per
+    day in one range query; today falls back to yesterday until today's
+    summaries exist.
+
+    Args:
+        user_id (int): User ID
 
     Returns:
-        JSON: Dashboard data
+        dict: Dashboard data, without the response timestamp
     """
-    # Get all devices for this user
-    devices = Device.query.filter_by(user_id=current_user.id).all()
+    devices = db.session.query(
+        Device.id, Device.name, Device.current_power, Device.status, Device.power_state, Device.last_updated
+    ).filter(Device.user_id == user_id).all()
 
-    # Get current power usage for each device
-    device_power = [{
+    # Current power usage for each device, highest first
+    device_power = sorted(({
         'id': device.id,
         'name': device.name,
         'current_power': device.current_power,
         'status': device.status,
         'power_state': device.power_state,
         'last_updated': device.last_updated.isoformat() if device.last_updated else None
-    } for device in devices]
-
-    # Sort by power usage (descending)
-    device_power.sort(key=lambda x: x['current_power'], reverse=True)
+    } for device in devices), key=lambda x: x['current_power'] or 0, reverse=True)
 
-    # Get today's power summary
     today = datetime.utcnow().date()
-    today_summary = PowerSummary.query.filter_by(
-        date=today,
-        summary_type='daily',
-        device_id=None  # Farm-wide summary
-    ).first()
-
-    # If no summary for today yet, get yesterday's
-    if not today_summary:
-        yesterday = today - datetime.timedelta(days=1)
-        today_summary = PowerSummary.query.filter_by(
-            date=yesterday,
-            summary_type='daily',
-            device_id=None
-        ).first()
-
-    # Today's usage stats
+    rows = db.session.query(
+        PowerSummary.date,
+        func.sum(PowerSummary.total_energy),
+        func.max(PowerSummary.peak_power),
+        func.sum(PowerSummary.cost_estimate)
+    ).join(
+        Device, Device.id == PowerSummary.device_id
+    ).filter(
+        PowerSummary.summary_type == 'daily',
+        PowerSummary.date >= today - timedelta(days=7),
+        PowerSummary.date <= today,
+        Device.user_id == user_id
+    ).group_by(PowerSummary.date).all()
+
+    days = {row[0]: row for row in rows}
+
+    # Today's usage stats, yesterday's until today has been summarized
+    latest = days.get(today) or days.get(today - timedelta(days=1))
     today_stats = {
-        'total_energy': today_summary.total_energy if today_summary else 0,
-        'peak_power': today_summary.peak_power if today_summary else 0,
-        'cost_estimate': today_summary.cost_estimate if today_summary else 0
+        'total_energy': latest[1] if latest else 0,
+        'peak_power': latest[2] if latest else 0,
+        'cost_estimate': latest[3] if latest else 0
     }
 
-    # Get last 7 days of power summaries
-    last_7_days = []
-    for i in range(7):
-        date = today - datetime.timedelta(days=i)
-        summary = PowerSummary.query.filter_by(
-            date=date,
-            summary_type='daily',
-            device_id=None
-        ).first()
-
-        if summary:
-            last_7_days.append({
-                'date': date.isoformat(),
-                'total_energy': summary.total_energy,
-                'cost_estimate': summary.cost_estimate
-            })
+    # Last 7 days, newest first
+    last_7_days = [{
+        'date': date.isoformat(),
+        'total_energy': days[date][1],
+        'cost_estimate': days[date][3]
+    } for date in (today - timedelta(days=i) for i in range(7)) if date in days]
 
-    return jsonify({
+    return {
         'current_power': {
             'devices': device_power,
-            'total': sum(d['current_power'] for d in device_power)
+            'total': sum(d['current_power'] or 0 for d in device_power)
         },
         'today': today_stats,
-        'last_7_days': last_7_days,
-        'timestamp': datetime.utcnow().isoformat()
-    })
\ No newline at end of file
+        'last_7_days': last_7_days
+    }
+
+@api_bp.route('/power/dashboard', methods=['GET'])
+@token_required
+def get_power_dashboard(current_user):
+    """
+    Get power dashboard data for the current user
+
+    Responses are cached per user for POWER_DASHBOARD_CACHE_TTL seconds and
+    carry an ETag of the dashboard data, so polls with If-None-Match get a
+    304 while nothing has changed.
+
+    Returns:
+        JSON: Dashboard data
+    """
+    def build():
+        data = build_power_dashboard(current_user.id)
+        etag = hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+        return etag, dict(data, timestamp=datetime.utcnow().isoformat())
+
+    etag, data = dashboard_cache.get(
+        current_user.id, build, current_app.config.get('POWER_DASHBOARD_CACHE_TTL', 10)
+    )
+
+    response = jsonify(data)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
\ No newline at end of file
@@ -3,6 +3,8 @@ from app.api import api_bp
 from app.api.routes import token_required
 from app.models.user import User
 from app.models.notification import NotificationSetting
+from app.iot.user_settings import settings_cache
+from app.africastalking.snapshots import ussd_snapshots
 from app import db
 
 import logging
@@ -71,6 +73,8 @@ def update_user_profile(current_user):
         current_user.password = data['new_password']
 
     db.session.commit()
+    settings_cache.invalidate(current_user.id)
+    ussd_snapshots.invalidate(current_user.id, current_user.phone_number)
 
     return jsonify({
         'message': 'Profile updated successfully',
@@ -111,6 +115,7 @@ def get_notification_settings(current_user):
         )
         db.session.add(settings)
         db.session.commit()
+        settings_cache.invalidate(current_user.id)
 
     return jsonify({
         'settings': {
@@ -190,6 +195,7 @@ def update_notification_settings(current_user):
             return jsonify({'error': 'Invalid quiet_hours_end format. Use HH:MM'}), 400
 
     db.session.commit()
+    settings_cache.invalidate(current_user.id)
 
     return jsonify({
         'message': 'Notification settings updated successfully',
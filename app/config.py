@@ -17,6 +17,102 @@ class Config:
     MQTT_PASSWORD = os.environ.get('MQTT_PASSWORD')
     MQTT_KEEPALIVE = 60
     MQTT_TLS_ENABLED = False
+    MQTT_ENABLED = os.environ.get('MQTT_ENABLED', 'true').lower() == 'true'
+
+    # embedded: every process ingests, shared: processes split ingestion via
+    # an MQTT v5 shared subscription, publish_only: leave ingestion to ingest_worker.py
+    MQTT_INGEST_MODE = os.environ.get('MQTT_INGEST_MODE', 'embedded')
+    MQTT_SHARED_GROUP = os.environ.get('MQTT_SHARED_GROUP', 'smart-farm-ingest')
+
+    # Telemetry ingestion batching
+    INGEST_FLUSH_SIZE = int(os.environ.get('INGEST_FLUSH_SIZE', 500))
+    INGEST_FLUSH_INTERVAL = float(os.environ.get('INGEST_FLUSH_INTERVAL', 1.0))  # seconds
+    INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', 10000))
+    INGEST_ENQUEUE_TIMEOUT = float(os.environ.get('INGEST_ENQUEUE_TIMEOUT', 0.5))  # seconds to block when full
+    INGEST_FLUSH_RETRIES = int(os.environ.get('INGEST_FLUSH_RETRIES', 3))  # retries of a batch whose write failed
+
+    # MQTT message worker pool
+    MQTT_DISPATCH_WORKERS = int(os.environ.get('MQTT_DISPATCH_WORKERS', 4))  # 0 handles messages inline
+    MQTT_DISPATCH_QUEUE_SIZE = int(os.environ.get('MQTT_DISPATCH_QUEUE_SIZE', 1000))  # per worker
+    MQTT_DISPATCH_ENQUEUE_TIMEOUT = float(os.environ.get('MQTT_DISPATCH_ENQUEUE_TIMEOUT', 0.5))  # seconds
+    MQTT_DISPATCH_DECODE_PROCESSES = int(os.environ.get('MQTT_DISPATCH_DECODE_PROCESSES', 0))
+
+    # Bulk device control
+    MQTT_CONTROL_MAX_IN_FLIGHT = int(os.environ.get('MQTT_CONTROL_MAX_IN_FLIGHT', 50))  # unacknowledged publishes
+    MQTT_CONTROL_PUBLISH_TIMEOUT = float(os.environ.get('MQTT_CONTROL_PUBLISH_TIMEOUT', 5))  # seconds per window
+
+    # Control command acknowledgement
+    COMMAND_ACK_TIMEOUT = float(os.environ.get('COMMAND_ACK_TIMEOUT', 5))  # seconds per attempt
+    COMMAND_MAX_RETRIES = int(os.environ.get('COMMAND_MAX_RETRIES', 3))
+    COMMAND_BACKOFF_BASE = float(os.environ.get('COMMAND_BACKOFF_BASE', 1))  # seconds, doubled per retry
+    COMMAND_BACKOFF_MAX = float(os.environ.get('COMMAND_BACKOFF_MAX', 30))
+    COMMAND_POLL_INTERVAL = float(os.environ.get('COMMAND_POLL_INTERVAL', 0.5))  # seconds
+    COMMAND_WAIT_MAX = float(os.environ.get('COMMAND_WAIT_MAX', 30))  # longest a request may wait
+
+    # Power threshold alerts
+    ALERT_HYSTERESIS = float(os.environ.get('ALERT_HYSTERESIS', 0.1))  # fraction below threshold that clears an alert
+    ALERT_WARNING_COOLDOWN = float(os.environ.get('ALERT_WARNING_COOLDOWN', 3600))  # seconds
+    ALERT_CRITICAL_COOLDOWN = float(os.environ.get('ALERT_CRITICAL_COOLDOWN', 900))  # seconds, doubles per reminder
+    ALERT_MAX_COOLDOWN = float(os.environ.get('ALERT_MAX_COOLDOWN', 21600))  # seconds
+    ALERT_ESCALATE_AFTER = float(os.environ.get('ALERT_ESCALATE_AFTER', 1800))  # seconds a warning lasts before SMS
+    ALERT_FLUSH_SIZE = int(os.environ.get('ALERT_FLUSH_SIZE', 200))
+    ALERT_FLUSH_INTERVAL = float(os.environ.get('ALERT_FLUSH_INTERVAL', 2))  # seconds
+
+    # SMS outbox sender, runs in every process that ingests telemetry and raises alerts
+    SMS_SENDER_ENABLED = os.environ.get('SMS_SENDER_ENABLED', 'true').lower() == 'true'
+    SMS_CLAIM_TIMEOUT = float(os.environ.get('SMS_CLAIM_TIMEOUT', 600))  # seconds before a stuck claim is released
+    SMS_POLL_INTERVAL = float(os.environ.get('SMS_POLL_INTERVAL', 2))  # seconds
+    SMS_BATCH_SIZE = int(os.environ.get('SMS_BATCH_SIZE', 500))  # messages per round
+    SMS_MAX_RECIPIENTS = int(os.environ.get('SMS_MAX_RECIPIENTS', 100))  # recipients per API call
+    SMS_RATE_LIMIT = float(os.environ.get('SMS_RATE_LIMIT', 5))  # API calls per second
+    SMS_MAX_ATTEMPTS = int(os.environ.get('SMS_MAX_ATTEMPTS', 5))
+    SMS_BACKOFF_BASE = float(os.environ.get('SMS_BACKOFF_BASE', 30))  # seconds, doubles per attempt
+    SMS_BACKOFF_MAX = float(os.environ.get('SMS_BACKOFF_MAX', 3600))  # seconds
+    SMS_DIGEST_WINDOW = float(os.environ.get('SMS_DIGEST_WINDOW', 60))  # seconds a user's alerts are combined
+    QUIET_HOURS_UTC_OFFSET = float(os.environ.get('QUIET_HOURS_UTC_OFFSET', 0))  # hours, local time of quiet hours
+
+    # Live dashboard events (Server-Sent Events)
+    EVENTS_BROKER_URL = os.environ.get('EVENTS_BROKER_URL')  # redis://..., in-process events if unset
+    EVENTS_QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE', 100))  # events buffered per connection
+    EVENTS_KEEPALIVE = float(os.environ.get('EVENTS_KEEPALIVE', 15))  # seconds
+    EVENTS_STREAM_TIMEOUT = float(os.environ.get('EVENTS_STREAM_TIMEOUT', 300))  # seconds before clients reconnect
+
+    # USSD sessions: 'memory' (single worker only), 'database' or 'redis'
+    USSD_SESSION_BACKEND = os.environ.get('USSD_SESSION_BACKEND', 'memory')
+    USSD_SESSION_URL = os.environ.get('USSD_SESSION_URL')  # redis://... for the redis backend
+    USSD_SESSION_TTL = float(os.environ.get('USSD_SESSION_TTL', 180))  # seconds since the last hop
+    USSD_SESSION_MAX = int(os.environ.get('USSD_SESSION_MAX', 100000))  # sessions kept by the memory backend
+
+    # USSD menu snapshots
+    USSD_SNAPSHOT_CACHE_SIZE = int(os.environ.get('USSD_SNAPSHOT_CACHE_SIZE', 10000))
+    USSD_SNAPSHOT_TTL = float(os.environ.get('USSD_SNAPSHOT_TTL', 300))  # seconds
+    USSD_SNAPSHOT_NEGATIVE_TTL = float(os.environ.get('USSD_SNAPSHOT_NEGATIVE_TTL', 60))  # seconds for unregistered numbers
+    USSD_SLOW_RESPONSE_MS = float(os.environ.get('USSD_SLOW_RESPONSE_MS', 500))  # callbacks slower than this are logged
+
+    # Device registry cache
+    DEVICE_CACHE_SIZE = int(os.environ.get('DEVICE_CACHE_SIZE', 10000))
+    DEVICE_CACHE_TTL = float(os.environ.get('DEVICE_CACHE_TTL', 300))  # seconds
+    DEVICE_CACHE_NEGATIVE_TTL = float(os.environ.get('DEVICE_CACHE_NEGATIVE_TTL', 60))  # seconds for unknown IDs
+
+    # Notification settings cache
+    SETTINGS_CACHE_SIZE = int(os.environ.get('SETTINGS_CACHE_SIZE', 10000))
+    SETTINGS_CACHE_TTL = float(os.environ.get('SETTINGS_CACHE_TTL', 600))  # seconds
+
+    # Device schedule runner, enabled on exactly one process since each runner fires every schedule (times are UTC)
+    SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', 'false').lower() == 'true'
+    SCHEDULER_POLL_INTERVAL = float(os.environ.get('SCHEDULER_POLL_INTERVAL', 30))  # seconds between change checks
+    SCHEDULER_BATCH_SIZE = int(os.environ.get('SCHEDULER_BATCH_SIZE', 100))
+    SCHEDULER_FLUSH_INTERVAL = float(os.environ.get('SCHEDULER_FLUSH_INTERVAL', 5))  # seconds
+
+    # Approximate (cached) counts for paginated listings
+    PAGINATION_COUNT_TTL = float(os.environ.get('PAGINATION_COUNT_TTL', 30))  # seconds
+
+    # Per-user power dashboard response cache
+    POWER_DASHBOARD_CACHE_TTL = float(os.environ.get('POWER_DASHBOARD_CACHE_TTL', 10))  # seconds
+
+    # Prometheus metrics endpoint
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # bearer token required to scrape /metrics, if set
 
     # Application settings
     DEVICES_PER_PAGE = 10
@@ -38,6 +134,7 @@ class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL',
                                              'sqlite:///test-smart-farm.db')
     WTF_CSRF_ENABLED = False
+    MQTT_ENABLED = False
 
 class ProductionConfig(Config):
     """Production config."""
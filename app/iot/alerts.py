@@ -0,0 +1,362 @@
+import atexit
+import threading
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# Global alert engine
+alert_engine = None
+
+# Alert levels, stored as Notification.notification_type
+LEVEL_WARNING = 'warning'
+LEVEL_CRITICAL = 'alert'
+
+# Title prefixes of the threshold alerts; other 'alert' notifications, such
+# as device errors, share the type but not a threshold cooldown
+TITLE_CRITICAL = "Critical Power Usage: "
+TITLE_WARNING = "High Power Usage: "
+TITLE_SUSTAINED = "Sustained High Power Usage: "
+THRESHOLD_TITLES = (TITLE_CRITICAL, TITLE_WARNING, TITLE_SUSTAINED)
+
+class AlertState:
+    """Threshold state of one device at one alert level"""
+
+    __slots__ = ('active', 'since', 'last_fired', 'repeats', 'escalated')
+
+    def __init__(self):
+        self.active = False       # power is above the threshold (until it drops below the hysteresis band)
+        self.since = None         # when the level became active
+        self.last_fired = None    # when an alert was last emitted for this level
+        self.repeats = 0          # reminders emitted during the current activation
+        self.escalated = False    # a long-running warning was escalated during this activation
+
+class AlertEngine:
+    """
+    Decides which threshold alerts to emit, without database queries
+
+    Each (device, level) pair is a small state machine. A level becomes
+    active above its threshold and only clears once power drops below the
+    threshold less the hysteresis band, so readings hovering at the threshold
+    do not re-trigger it. An alert fires when a level becomes active, unless
+    one fired within the cooldown; while the level stays active reminders
+    fire with a cooldown that doubles each time. A warning active for longer
+    than escalate_after is escalated once to an SMS warning.
+
+    Emitted alerts are queued and written as Notification rows in batches by
+    a background thread.
+    """
+
+    def __init__(self, app, hysteresis=0.1, warning_cooldown=3600, critical_cooldown=900,
+                 max_cooldown=21600, escalate_after=1800, flush_size=200, flush_interval=2.0):
+        """
+        Args:
+            app (Flask): Application used for the writer thread's app context
+            hysteresis (float): Fraction below the threshold at which a level clears
+            warning_cooldown (float): Minimum seconds between warnings for a device
+            critical_cooldown (float): Minimum seconds between critical alerts for a device
+            max_cooldown (float): Upper bound for the doubling reminder cooldown
+            escalate_after (float): Seconds a warning stays active before it is escalated
+            flush_size (int): Write queued alerts once this many are pending
+            flush_interval (float): Maximum seconds an alert waits to be written
+        """
+        self.app = app
+        self.hysteresis = hysteresis
+        self.cooldowns = {LEVEL_WARNING: warning_cooldown, LEVEL_CRITICAL: critical_cooldown}
+        self.max_cooldown = max_cooldown
+        self.escalate_after = escalate_after
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+
+        self._states = {}
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self.checks = 0
+        self.fired = 0
+        self.suppressed = 0
+        self.written = 0
+
+    def start(self):
+        """Start the background writer thread"""
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="alert-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Stop the writer thread and write queued alerts"""
+        self._stop_event.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        """Get alert counters"""
+        with self._lock:
+            return {
+                "tracked": len(self._states),
+                "active": sum(1 for state in self._states.values() if state.active),
+                "checks": self.checks,
+                "fired": self.fired,
+                "suppressed": self.suppressed,
+                "written": self.written,
+                "pending": len(self._pending)
+            }
+
+    def load_recent(self, since=None):
+        """
+        Restore cooldowns from recently written threshold alerts
+
+        Called at startup so a restart does not re-send alerts that went out
+        shortly before it. Only notifications titled as threshold alerts
+        count, so a device error does not suppress the next critical alert.
+
+        Args:
+            since (datetime): Oldest notification to consider, defaults to the longest cooldown
+        """
+        from app.models.notification import Notification
+        from app import db
+
+        since = since or datetime.utcnow() - timedelta(seconds=max(self.cooldowns.values()))
+        rows = db.session.query(
+            Notification.device_id, Notification.notification_type, db.func.max(Notification.timestamp)
+        ).filter(
+            Notification.timestamp >= since,
+            Notification.device_id.isnot(None),
+            Notification.notification_type.in_(list(self.cooldowns)),
+            db.or_(*(Notification.title.startswith(prefix) for prefix in THRESHOLD_TITLES))
+        ).group_by(Notification.device_id, Notification.notification_type).all()
+
+        with self._lock:
+            for device_pk, level, last_fired in rows:
+                state = self._states.setdefault((device_pk, level), AlertState())
+                if not state.last_fired or last_fired > state.last_fired:
+                    state.last_fired = last_fired
+
+    def check(self, device, power_usage, warning_threshold, critical_threshold,
+              send_sms=False, send_email=False, now=None):
+        """
+        Update the alert state of a device and queue any alert that should fire
+
+        Args:
+            device (DeviceEntry): Device
+            power_usage (float): Power usage in watts
+            warning_threshold (float): Warning threshold in watts
+            critical_threshold (float): Critical threshold in watts
+            send_sms (bool): User receives SMS alerts
+            send_email (bool): User receives email alerts
+            now (datetime): Sample time, defaults to now
+
+        Returns:
+            list: Alerts queued by this check
+        """
+        now = now or datetime.utcnow()
+        alerts = []
+
+        with self._lock:
+            self.checks += 1
+            critical = self._transition(device.id, LEVEL_CRITICAL, power_usage, critical_threshold, now)
+            warning = self._transition(device.id, LEVEL_WARNING, power_usage, warning_threshold, now)
+            critical_active = self._states[(device.id, LEVEL_CRITICAL)].active
+
+            if critical:
+                alerts.append({
+                    "title": f"{TITLE_CRITICAL}{device.name}",
+                    "message": f"Device '{device.name}' is consuming {power_usage:.2f}W, which exceeds the critical threshold of {critical_threshold:.2f}W.",
+                    "notification_type": LEVEL_CRITICAL,
+                    "send_sms": send_sms,
+                    "send_email": send_email
+                })
+            elif warning and not critical_active:
+                alerts.append({
+                    "title": f"{TITLE_WARNING}{device.name}",
+                    "message": f"Device '{device.name}' is consuming {power_usage:.2f}W, which exceeds the warning threshold of {warning_threshold:.2f}W.",
+                    "notification_type": LEVEL_WARNING,
+                    "send_sms": False,  # Only send SMS for critical alerts
+                    "send_email": send_email
+                })
+
+            # A warning that has not cleared for escalate_after is sent by SMS, once
+            state = self._states[(device.id, LEVEL_WARNING)]
+            if (state.active and not state.escalated and not critical_active and self.escalate_after
+                    and (now - state.since).total_seconds() >= self.escalate_after):
+                state.escalated = True
+                minutes = (now - state.since).total_seconds() / 60
+                alerts.append({
+                    "title": f"{TITLE_SUSTAINED}{device.name}",
+                    "message": f"Device '{device.name}' has been above the warning threshold of {warning_threshold:.2f}W for {minutes:.0f} minutes and is now consuming {power_usage:.2f}W.",
+                    "notification_type": LEVEL_WARNING,  # held during quiet hours, unlike critical alerts
+                    "send_sms": send_sms,
+                    "send_email": send_email
+                })
+
+            for alert in alerts:
+                alert.update(user_id=device.user_id, device_id=device.id, timestamp=now)
+            self._pending.extend(alerts)
+            self.fired += len(alerts)
+            pending = len(self._pending)
+
+        if pending >= self.flush_size:
+            self._wake.set()
+        return alerts
+
+    def flush(self):
+        """
+        Write queued alerts as notifications
+
+        Notifications with send_sms are delivered by the SMS sender, which
+        combines each user's alerts into digests.
+
+        Returns:
+            int: Number of notifications written
+        """
+        from app.models.notification import Notification
+        from app.iot.events import EVENT_NOTIFICATION, notification_event, publish_events
+        from app import db
+
+        with self._flush_lock:
+            with self._lock:
+                alerts, self._pending = self._pending, []
+            if not alerts:
+                return 0
+
+            with self.app.app_context():
+                try:
+                    notifications = [Notification(**alert) for alert in alerts]
+                    db.session.add_all(notifications)
+                    db.session.flush()
+                    events = {}
+                    for notification in notifications:
+                        events.setdefault(notification.user_id, []).append(notification_event(notification))
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Error writing alerts: {str(e)}")
+                    # Keep them for the next flush unless the backlog is growing without bound
+                    with self._lock:
+                        if len(self._pending) < self.flush_size * 10:
+                            self._pending[:0] = alerts
+                    return 0
+                finally:
+                    db.session.remove()
+
+            publish_events((user_id, EVENT_NOTIFICATION, {"notifications": items}) for user_id, items in events.items())
+
+            with self._lock:
+                self.written += len(notifications)
+            return len(notifications)
+
+    def _transition(self, device_pk, level, power_usage, threshold, now):
+        """
+        Advance one level's state machine; caller holds the lock
+
+        Returns:
+            bool: True if an alert should fire for this level
+        """
+        state = self._states.get((device_pk, level))
+        if state is None:
+            state = self._states[(device_pk, level)] = AlertState()
+
+        if threshold is None:
+            return False
+
+        base_cooldown = self.cooldowns[level]
+
+        if power_usage > threshold:
+            if not state.active:
+                state.active = True
+                state.since = now
+                state.repeats = 0
+                state.escalated = False
+                if state.last_fired and (now - state.last_fired).total_seconds() < base_cooldown:
+                    self.suppressed += 1
+                    return False
+                state.last_fired = now
+                return True
+
+            # Still above: remind with a doubling cooldown
+            cooldown = min(base_cooldown * (2 ** state.repeats), self.max_cooldown)
+            if state.last_fired and (now - state.last_fired).total_seconds() < cooldown:
+                self.suppressed += 1
+                return False
+            state.repeats += 1
+            state.last_fired = now
+            return True
+
+        if state.active and power_usage < threshold * (1 - self.hysteresis):
+            state.active = False
+        return False
+
+    def _run(self):
+        """Writer loop, triggered by queue size or flush interval"""
+        while not self._stop_event.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Alert writer error: {str(e)}")
+
+def engine_from_config(app):
+    """Create an alert engine configured from the app config"""
+    return AlertEngine(
+        app,
+        hysteresis=app.config.get('ALERT_HYSTERESIS', 0.1),
+        warning_cooldown=app.config.get('ALERT_WARNING_COOLDOWN', 3600),
+        critical_cooldown=app.config.get('ALERT_CRITICAL_COOLDOWN', 900),
+        max_cooldown=app.config.get('ALERT_MAX_COOLDOWN', 21600),
+        escalate_after=app.config.get('ALERT_ESCALATE_AFTER', 1800),
+        flush_size=app.config.get('ALERT_FLUSH_SIZE', 200),
+        flush_interval=app.config.get('ALERT_FLUSH_INTERVAL', 2.0)
+    )
+
+def get_alert_engine():
+    """
+    Get the alert engine for the current process
+
+    Returns the running engine when the MQTT client started one. Otherwise
+    returns an engine without a writer thread, kept per app, whose alerts
+    the caller flushes itself.
+
+    Returns:
+        tuple: (AlertEngine, True if the caller must flush)
+    """
+    from flask import current_app
+
+    if alert_engine:
+        return alert_engine, False
+
+    app = current_app._get_current_object()
+    engine = app.extensions.get('alert_engine')
+    if engine is None:
+        engine = app.extensions['alert_engine'] = engine_from_config(app)
+    return engine, True
+
+def setup_alert_engine(app):
+    """Initialize and start the global alert engine"""
+    global alert_engine
+
+    if alert_engine:
+        return alert_engine
+
+    alert_engine = engine_from_config(app)
+
+    with app.app_context():
+        try:
+            alert_engine.load_recent()
+        except Exception as e:
+            logger.error(f"Could not restore alert cooldowns: {str(e)}")
+
+    alert_engine.start()
+    atexit.register(alert_engine.stop)
+
+    return alert_engine
@@ -0,0 +1,186 @@
+from collections import namedtuple
+import logging
+
+import numpy as np
+from sqlalchemy import func, select
+
+from app import db
+from app.models.power_usage import PowerReading
+
+logger = logging.getLogger(__name__)
+
+# Columnar power reading series: epoch seconds and float64 measurements
+ReadingSeries = namedtuple('ReadingSeries', ['timestamps', 'power', 'voltage', 'current'])
+
+def epoch_seconds(column):
+    """SQL expression converting a timestamp column to epoch seconds"""
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        return func.extract("epoch", column)
+    if dialect == "mysql":
+        return func.unix_timestamp(column)
+    # 2440587.5 is the Julian day of the Unix epoch
+    return (func.julianday(column) - 2440587.5) * 86400.0
+
+def fetch_array(query, columns):
+    """
+    Run a query of numeric columns straight into a float64 array
+
+    Rows are read from the DBAPI cursor, skipping SQLAlchemy row objects.
+
+    Args:
+        query (Select): Query selecting only numeric columns
+        columns (int): Number of selected columns
+
+    Returns:
+        ndarray: Array of shape (rows, columns), NULLs as NaN
+    """
+    result = db.session.connection().execute(query)
+    try:
+        data = result.cursor.fetchall()
+    finally:
+        result.close()
+
+    if not data:
+        return np.empty((0, columns), dtype=np.float64)
+    return np.array(data, dtype=np.float64)
+
+def series_from_array(data):
+    """Build a ReadingSeries from an array of (timestamp, power, voltage, current) rows"""
+    return ReadingSeries(
+        timestamps=data[:, 0],
+        power=data[:, 1],
+        voltage=data[:, 2],
+        current=data[:, 3]
+    )
+
+def load_series(device_id, start_time, end_time=None):
+    """
+    Load a device's readings as columnar arrays without building ORM objects
+
+    Args:
+        device_id (int): Device ID in database
+        start_time (datetime): Start of the range
+        end_time (datetime): Optional end of the range (inclusive)
+
+    Returns:
+        ReadingSeries: Readings ordered by timestamp
+    """
+    query = select(
+        epoch_seconds(PowerReading.timestamp),
+        PowerReading.power_usage,
+        PowerReading.voltage,
+        PowerReading.current
+    ).where(
+        PowerReading.device_id == device_id,
+        PowerReading.timestamp >= start_time
+    )
+    if end_time:
+        query = query.where(PowerReading.timestamp <= end_time)
+
+    return series_from_array(fetch_array(query.order_by(PowerReading.timestamp), 4))
+
+def energy_kwh(timestamps, power):
+    """Trapezoidal energy in kWh for power (W) sampled at epoch-second timestamps"""
+    if len(power) < 2:
+        return 0.0
+    # Energy in kWh = average power (W) * time (s) / 3600 / 1000
+    return float(np.sum((power[1:] + power[:-1]) * np.diff(timestamps)) / 7200000.0)
+
+def duty_cycle(timestamps, power, on_threshold):
+    """Fraction of the covered time a device drew more than on_threshold watts"""
+    if len(power) < 2:
+        return 0.0
+
+    durations = np.diff(timestamps)
+    total = durations.sum()
+    if total <= 0:
+        return 0.0
+
+    # Each interval takes the state of the sample that starts it
+    return float(durations[power[:-1] > on_threshold].sum() / total)
+
+def find_gaps(timestamps, max_gap):
+    """
+    Find intervals between consecutive samples longer than max_gap seconds
+
+    Returns:
+        list: (start, end) epoch-second pairs
+    """
+    if len(timestamps) < 2:
+        return []
+
+    indices = np.flatnonzero(np.diff(timestamps) > max_gap)
+    return [(float(timestamps[i]), float(timestamps[i + 1])) for i in indices]
+
+def series_stats(series, percentiles=(50, 90, 95, 99), on_threshold=1.0, max_gap=300):
+    """
+    Compute power statistics for a series in vectorized form
+
+    Args:
+        series (ReadingSeries): Readings ordered by timestamp
+        percentiles (tuple): Power percentiles to compute
+        on_threshold (float): Power in watts above which the device counts as on
+        max_gap (float): Seconds between samples above which a gap is reported
+
+    Returns:
+        dict: Power statistics
+    """
+    power = series.power
+    if not len(power):
+        return {
+            "total_readings": 0,
+            "average_power": 0,
+            "max_power": 0,
+            "min_power": 0,
+            "total_energy": 0,
+            "percentiles": {},
+            "duty_cycle": 0,
+            "average_voltage": None,
+            "average_current": None,
+            "gaps": []
+        }
+
+    values = np.percentile(power, percentiles)
+    voltage = series.voltage[~np.isnan(series.voltage)]
+    current = series.current[~np.isnan(series.current)]
+
+    return {
+        "total_readings": int(len(power)),
+        "average_power": float(power.mean()),
+        "max_power": float(power.max()),
+        "min_power": float(power.min()),
+        "total_energy": energy_kwh(series.timestamps, power),
+        "percentiles": {f"p{p}": float(v) for p, v in zip(percentiles, values)},
+        "duty_cycle": duty_cycle(series.timestamps, power, on_threshold),
+        "average_voltage": float(voltage.mean()) if len(voltage) else None,
+        "average_current": float(current.mean()) if len(current) else None,
+        "gaps": find_gaps(series.timestamps, max_gap)
+    }
+
+def grouped_energy(keys, timestamps, power):
+    """
+    Trapezoidal energy, peak, average power and count per group
+
+    Args:
+        keys (ndarray): Integer group key per sample; samples must be sorted by key then timestamp
+        timestamps (ndarray): Epoch seconds
+        power (ndarray): Power in watts
+
+    Returns:
+        tuple: (group keys, energy kWh, peak W, average W, sample counts)
+    """
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+
+    # Segment energy, zeroed where the segment crosses into the next group
+    segments = (power[1:] + power[:-1]) * np.diff(timestamps) / 7200000.0
+    segments[keys[1:] != keys[:-1]] = 0.0
+    cumulative = np.r_[0.0, np.cumsum(segments)]
+    ends = starts + counts - 1
+    energy = cumulative[ends] - cumulative[starts]
+
+    peak = np.maximum.reduceat(power, starts)
+    average = np.add.reduceat(power, starts) / counts
+
+    return keys[starts], energy, peak, average, counts
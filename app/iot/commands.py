@@ -0,0 +1,516 @@
+import atexit
+import bisect
+import heapq
+import itertools
+import threading
+import time
+import uuid
+import logging
+from datetime import datetime
+
+from sqlalchemy import update
+
+logger = logging.getLogger(__name__)
+
+# Global command tracker
+command_tracker = None
+
+# Command states
+COMMAND_PENDING = 'pending'
+COMMAND_CONFIRMED = 'confirmed'
+COMMAND_TIMEOUT = 'timeout'
+COMMAND_FAILED = 'failed'
+
+# Upper bounds of the latency histogram buckets in milliseconds
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value_ms):
+        self.counts[bisect.bisect_left(self.buckets, value_ms)] += 1
+        self.count += 1
+        self.total += value_ms
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket containing it"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        cumulative = list(itertools.accumulate(self.counts))
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count, 2) if self.count else None,
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99),
+            "buckets": {str(bound): cumulative[i] for i, bound in enumerate(self.buckets + ('+Inf',))}
+        }
+
+class PendingCommand:
+    """A control command waiting for the device to confirm it"""
+
+    def __init__(self, cid, device_id, device_pk, device_type, command, value, expected_state, previous_state):
+        self.cid = cid
+        self.device_id = device_id
+        self.device_pk = device_pk
+        self.device_type = device_type
+        self.command = command
+        self.value = value
+        self.expected_state = expected_state    # power state that confirms the command, None if not a power command
+        self.previous_state = previous_state    # power state to restore if the command is never confirmed
+        self.status = COMMAND_PENDING
+        self.attempts = 0
+        self.first_sent = None
+        self.sent_at_utc = None
+        self.latency_ms = None
+        self.info = None                        # MQTT publish handle of the last attempt
+        self.due = None                         # monotonic time of the next timeout or retry
+        self.retry_due = False                  # True while waiting out a backoff
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the command is confirmed or has finally failed
+
+        Returns:
+            bool: True if confirmed
+        """
+        self._done.wait(timeout)
+        return self.status == COMMAND_CONFIRMED
+
+    def to_dict(self):
+        return {
+            'command_id': self.cid,
+            'device_id': self.device_id,
+            'command': self.command,
+            'status': self.status,
+            'attempts': self.attempts,
+            'latency_ms': self.latency_ms
+        }
+
+def expected_power_state(command, value):
+    """Get the power state a command should produce, or None if it does not set one"""
+    if command != 'power':
+        return None
+    if isinstance(value, bool):
+        return value
+    if value in ('on', 'off'):
+        return value == 'on'
+    return None
+
+class CommandTracker:
+    """
+    Tracks control commands until devices confirm them
+
+    Each command carries a correlation ID ("cid") in its payload. A device
+    report echoing the cid, or reporting the expected power state, confirms
+    the command. Unconfirmed commands are republished with exponential
+    backoff and marked timed out after max_retries.
+    """
+
+    def __init__(self, app, ack_timeout=5.0, max_retries=3, backoff_base=1.0, backoff_max=30.0,
+                 confirm_from_db=False, poll_interval=0.5):
+        """
+        Args:
+            app (Flask): Application used for the tracker thread's app context
+            ack_timeout (float): Seconds to wait for confirmation of each attempt
+            max_retries (int): Republish attempts after the first
+            backoff_base (float): Backoff before the first retry, doubled for each further retry
+            backoff_max (float): Maximum backoff in seconds
+            confirm_from_db (bool): Also confirm from the device row, for processes that
+                do not receive device status messages themselves
+            poll_interval (float): Seconds between database checks when confirm_from_db is set
+        """
+        self.app = app
+        self.ack_timeout = ack_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.confirm_from_db = confirm_from_db
+        self.poll_interval = poll_interval
+
+        self._pending = {}
+        self._by_device = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._histograms = {}
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self.sent = 0
+        self.retried = 0
+        self.confirmed = 0
+        self.timed_out = 0
+
+    def start(self):
+        """Start the timeout and retry thread"""
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="command-tracker", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stop_event.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def send(self, device_id, command, value=None, previous_state=None):
+        """
+        Publish a tracked control command
+
+        Args:
+            device_id (str): Device ID
+            command (str): Command name
+            value: Command value
+            previous_state (bool): Power state to restore if the command is never confirmed
+
+        Returns:
+            PendingCommand: Tracked command, or None if it could not be published
+        """
+        from app.iot.device_registry import device_registry
+
+        entry = device_registry.get(device_id)
+        pending = PendingCommand(
+            cid=uuid.uuid4().hex[:16],
+            device_id=device_id,
+            device_pk=entry.id if entry else None,
+            device_type=entry.device_type if entry else None,
+            command=command,
+            value=value,
+            expected_state=expected_power_state(command, value),
+            previous_state=previous_state
+        )
+
+        # Register before publishing so a fast confirmation is not missed
+        pending.first_sent = time.monotonic()
+        pending.sent_at_utc = datetime.utcnow()
+        with self._lock:
+            self._pending[pending.cid] = pending
+            self._by_device.setdefault(device_id, []).append(pending.cid)
+            self._schedule(pending, pending.first_sent + self.ack_timeout)
+
+        if not self._publish(pending):
+            with self._lock:
+                self._finish(pending, COMMAND_FAILED)
+            return None
+
+        with self._lock:
+            self.sent += 1
+
+        self._wake.set()
+        return pending
+
+    def acknowledge(self, device_id, data):
+        """
+        Match a device report against pending commands
+
+        Args:
+            device_id (str): Device ID
+            data (dict): Decoded device status message
+
+        Returns:
+            PendingCommand: Confirmed command, or None
+        """
+        cid = data.get("cid")
+        reported = data.get("power_state")
+
+        with self._lock:
+            if cid:
+                pending = self._pending.get(cid)
+                if pending and pending.device_id != device_id:
+                    pending = None
+            else:
+                pending = None
+                if reported is not None:
+                    for candidate in self._by_device.get(device_id, ()):
+                        candidate = self._pending[candidate]
+                        if candidate.expected_state == bool(reported):
+                            pending = candidate
+                            break
+
+            if pending:
+                self._finish(pending, COMMAND_CONFIRMED)
+        return pending
+
+    def get(self, cid):
+        with self._lock:
+            return self._pending.get(cid)
+
+    def stats(self):
+        """Get counters and latency histograms per device type"""
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "sent": self.sent,
+                "retried": self.retried,
+                "confirmed": self.confirmed,
+                "timed_out": self.timed_out,
+                "latency": {device_type or 'unknown': histogram.snapshot()
+                            for device_type, histogram in self._histograms.items()}
+            }
+
+    def tick(self, now=None):
+        """
+        Retry or time out every command whose deadline has passed
+
+        Args:
+            now (float): Current monotonic time
+
+        Returns:
+            int: Number of commands retried or timed out
+        """
+        now = now if now is not None else time.monotonic()
+        handled = 0
+        retries = []
+        expired = []
+
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due, _, cid = heapq.heappop(self._heap)
+                pending = self._pending.get(cid)
+                if not pending or pending.due != due:
+                    continue
+                handled += 1
+
+                if pending.retry_due:
+                    # Backoff elapsed, republish with the same cid
+                    pending.retry_due = False
+                    self.retried += 1
+                    self._schedule(pending, now + self.ack_timeout)
+                    retries.append(pending)
+                elif pending.attempts <= self.max_retries:
+                    # Attempt timed out, back off before republishing
+                    backoff = min(self.backoff_base * (2 ** (pending.attempts - 1)), self.backoff_max)
+                    pending.retry_due = True
+                    self._schedule(pending, now + backoff)
+                else:
+                    self._finish(pending, COMMAND_TIMEOUT)
+                    expired.append(pending)
+
+        # A failed republish is retried again when its ack timeout passes
+        for pending in retries:
+            self._publish(pending)
+
+        if expired:
+            self._restore_states(expired)
+        return handled
+
+    def confirm_from_devices(self):
+        """
+        Confirm pending power commands from device rows
+
+        Another process may have handled the device's status message; a
+        device updated since the command was sent and now in the expected
+        state confirms it.
+
+        Returns:
+            int: Number of commands confirmed
+        """
+        from app.models.device import Device
+        from app import db
+
+        with self._lock:
+            candidates = [p for p in self._pending.values() if p.expected_state is not None and p.device_pk]
+        if not candidates:
+            return 0
+
+        rows = db.session.query(Device.id, Device.power_state, Device.last_updated) \
+            .filter(Device.id.in_({p.device_pk for p in candidates})).all()
+        states = {row.id: row for row in rows}
+
+        confirmed = 0
+        with self._lock:
+            for pending in candidates:
+                row = states.get(pending.device_pk)
+                if (pending.status == COMMAND_PENDING and row and row.last_updated
+                        and row.last_updated >= pending.sent_at_utc
+                        and bool(row.power_state) == pending.expected_state):
+                    self._finish(pending, COMMAND_CONFIRMED)
+                    confirmed += 1
+        return confirmed
+
+    def _publish(self, pending):
+        from app.iot.mqtt_client import publish_device_control
+
+        pending.attempts += 1
+        info = publish_device_control(pending.device_id, pending.command, pending.value, cid=pending.cid)
+        if info is None:
+            return False
+
+        pending.info = info
+        return True
+
+    def _schedule(self, pending, due):
+        pending.due = due
+        heapq.heappush(self._heap, (due, next(self._seq), pending.cid))
+
+    def _finish(self, pending, status):
+        """Resolve a command; caller holds the lock"""
+        if pending.status != COMMAND_PENDING:
+            return
+
+        pending.status = status
+        self._pending.pop(pending.cid, None)
+        cids = self._by_device.get(pending.device_id)
+        if cids:
+            cids.remove(pending.cid)
+            if not cids:
+                del self._by_device[pending.device_id]
+
+        if status == COMMAND_CONFIRMED:
+            self.confirmed += 1
+            pending.latency_ms = round((time.monotonic() - pending.first_sent) * 1000, 1)
+            histogram = self._histograms.setdefault(pending.device_type, LatencyHistogram())
+            histogram.observe(pending.latency_ms)
+        elif status == COMMAND_TIMEOUT:
+            self.timed_out += 1
+            logger.warning(f"Command {pending.command} to {pending.device_id} was not confirmed "
+                           f"after {pending.attempts} attempts")
+
+        pending._done.set()
+
+    def _restore_states(self, expired):
+        """Undo optimistic power state updates for commands that were never confirmed"""
+        from app.models.device import Device
+        from app.africastalking.snapshots import ussd_snapshots
+        from app import db
+
+        restores = [p for p in expired
+                    if p.device_pk and p.expected_state is not None and p.previous_state is not None
+                    and p.previous_state != p.expected_state]
+        if not restores:
+            return
+
+        with self.app.app_context():
+            try:
+                restored = []
+                for pending in restores:
+                    # Only if nothing else changed the state since
+                    result = db.session.execute(
+                        update(Device)
+                        .where(Device.id == pending.device_pk, Device.power_state == pending.expected_state)
+                        .values(power_state=pending.previous_state)
+                    )
+                    if result.rowcount:
+                        restored.append({"id": pending.device_pk, "power_state": pending.previous_state})
+                db.session.commit()
+                ussd_snapshots.apply(restored)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error restoring device power states: {str(e)}")
+
+    def _run(self):
+        from app import db
+
+        next_poll = 0
+        while not self._stop_event.is_set():
+            try:
+                self.tick()
+                if self.confirm_from_db and self._pending and time.monotonic() >= next_poll:
+                    with self.app.app_context():
+                        try:
+                            self.confirm_from_devices()
+                        finally:
+                            db.session.remove()
+                    next_poll = time.monotonic() + self.poll_interval
+            except Exception as e:
+                logger.error(f"Command tracker error: {str(e)}")
+
+            with self._lock:
+                timeout = self._heap[0][0] - time.monotonic() if self._heap else 1.0
+            if self.confirm_from_db and self._pending:
+                timeout = min(timeout, self.poll_interval)
+
+            self._wake.wait(max(min(timeout, 1.0), 0.01))
+            self._wake.clear()
+
+def send_command(device_id, command, value=None, previous_state=None):
+    """
+    Send a control command, tracking it when the tracker is running
+
+    Args:
+        device_id (str): Device ID
+        command (str): Command name
+        value: Command value
+        previous_state (bool): Power state to restore if the command is never confirmed
+
+    Returns:
+        tuple: (sent, PendingCommand or None)
+    """
+    from app.iot.mqtt_client import publish_device_control
+
+    if command_tracker:
+        pending = command_tracker.send(device_id, command, value, previous_state)
+        return pending is not None, pending
+    return publish_device_control(device_id, command, value) is not None, None
+
+def requested_wait(data):
+    """
+    Get how long a control request asked to wait for confirmation
+
+    Args:
+        data (dict): Request body with optional 'wait' and 'timeout' (seconds)
+
+    Returns:
+        float: Seconds to wait, capped by COMMAND_WAIT_MAX, or None if not waiting
+    """
+    from flask import current_app
+
+    if not data.get('wait'):
+        return None
+
+    default = current_app.config.get('COMMAND_ACK_TIMEOUT', 5.0)
+    try:
+        timeout = float(data.get('timeout', default))
+    except (TypeError, ValueError):
+        timeout = default
+    return max(0.0, min(timeout, current_app.config.get('COMMAND_WAIT_MAX', 30.0)))
+
+def wait_for_all(pendings, timeout):
+    """Wait for several commands with one shared deadline"""
+    deadline = time.monotonic() + timeout
+    for pending in pendings:
+        pending.wait(max(0.0, deadline - time.monotonic()))
+
+def setup_command_tracker(app, confirm_from_db=False):
+    """Initialize and start the global command tracker"""
+    global command_tracker
+
+    if command_tracker:
+        return command_tracker
+
+    command_tracker = CommandTracker(
+        app,
+        ack_timeout=app.config.get('COMMAND_ACK_TIMEOUT', 5.0),
+        max_retries=app.config.get('COMMAND_MAX_RETRIES', 3),
+        backoff_base=app.config.get('COMMAND_BACKOFF_BASE', 1.0),
+        backoff_max=app.config.get('COMMAND_BACKOFF_MAX', 30.0),
+        confirm_from_db=confirm_from_db,
+        poll_interval=app.config.get('COMMAND_POLL_INTERVAL', 0.5)
+    )
+    command_tracker.start()
+    atexit.register(command_tracker.stop)
+
+    return command_tracker
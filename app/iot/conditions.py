@@ -0,0 +1,279 @@
+import operator
+import re
+import threading
+import time
+import logging
+from collections import namedtuple
+from datetime import datetime
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Condition types stored in Schedule.condition_type
+CONDITION_POWER_THRESHOLD = 'power_threshold'
+CONDITION_TIME_OF_DAY = 'time_of_day'
+CONDITION_WEATHER = 'weather'
+
+COMPARISONS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne
+}
+
+COMPARISON_PATTERN = re.compile(r'^\s*(>=|<=|==|!=|>|<|=)\s*(-?\d+(?:\.\d+)?)\s*[wW]?\s*$')
+TIME_RANGE_PATTERN = re.compile(r'^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*$')
+WEATHER_COMPARISON_PATTERN = re.compile(r'^\s*([a-z_]+)\s*(>=|<=|==|!=|>|<|=)\s*(-?\d+(?:\.\d+)?)\s*$')
+
+# Everything a compiled condition may look at when a schedule fires
+ConditionContext = namedtuple('ConditionContext', [
+    'device_pk',    # Device primary key
+    'location',     # Device location, used for weather lookups
+    'now'           # Fire time (UTC)
+])
+
+# Latest telemetry kept for a device
+DeviceState = namedtuple('DeviceState', ['power', 'timestamp'])
+
+class DeviceStateStore:
+    """Latest power reading per device, kept in memory by the telemetry path"""
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def update(self, device_pk, power, timestamp):
+        """Record a sample unless a newer one is already stored"""
+        with self._lock:
+            current = self._states.get(device_pk)
+            if not current or timestamp >= current.timestamp:
+                self._states[device_pk] = DeviceState(power, timestamp)
+
+    def update_many(self, samples):
+        """
+        Record several samples at once
+
+        Args:
+            samples (iterable): (device_pk, power, timestamp) tuples
+        """
+        with self._lock:
+            for device_pk, power, timestamp in samples:
+                current = self._states.get(device_pk)
+                if not current or timestamp >= current.timestamp:
+                    self._states[device_pk] = DeviceState(power, timestamp)
+
+    def get(self, device_pk):
+        return self._states.get(device_pk)
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+
+# Global device state store fed by the ingestor
+device_state_store = DeviceStateStore()
+
+class WeatherProvider:
+    """Interface for current weather lookups used by weather conditions"""
+
+    def current(self, location):
+        """
+        Get the current weather at a location
+
+        Args:
+            location (str): Device location
+
+        Returns:
+            dict: 'condition' (e.g. 'rain', 'clear') plus numeric readings such
+            as 'temperature' (C), 'humidity' (%) and 'rainfall' (mm), or None
+            if unknown
+        """
+        raise NotImplementedError
+
+class StaticWeatherProvider(WeatherProvider):
+    """Weather provider returning fixed values, for local runs and tests"""
+
+    def __init__(self, default=None, locations=None):
+        """
+        Args:
+            default (dict): Weather returned for locations without an entry
+            locations (dict): Weather per location
+        """
+        self.default = default
+        self.locations = dict(locations or {})
+
+    def set(self, location, weather):
+        self.locations[location] = weather
+
+    def current(self, location):
+        return self.locations.get(location, self.default)
+
+class CachedWeather:
+    """Caches provider lookups per location so many schedules share one call"""
+
+    def __init__(self, provider, ttl=300):
+        self.provider = provider
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def current(self, location):
+        now = time.monotonic()
+        entry = self._entries.get(location)
+        if entry and entry[0] > now:
+            return entry[1]
+
+        try:
+            weather = self.provider.current(location)
+        except Exception as e:
+            logger.error(f"Weather lookup failed for {location}: {str(e)}")
+            weather = None
+
+        with self._lock:
+            self._entries[location] = (now + self.ttl, weather)
+        return weather
+
+# Global weather source, a static stand-in until a real provider is configured
+weather = CachedWeather(StaticWeatherProvider())
+
+def set_weather_provider(provider, ttl=300):
+    """Replace the weather provider used by weather conditions"""
+    global weather
+    weather = CachedWeather(provider, ttl)
+
+def power_threshold_predicate(value, max_age=300):
+    """Compile '>500', '<= 100W' and similar into a predicate on the device's latest power"""
+    match = COMPARISON_PATTERN.match(value or '')
+    if not match:
+        raise ValueError(f"Invalid power threshold '{value}', expected e.g. '>500'")
+
+    compare = COMPARISONS[match.group(1)]
+    threshold = float(match.group(2))
+
+    def predicate(ctx):
+        state = device_state_store.get(ctx.device_pk)
+        if state is None or (ctx.now - state.timestamp).total_seconds() > max_age:
+            return False, "no recent telemetry"
+        if compare(state.power, threshold):
+            return True, None
+        return False, f"power {state.power:.1f}W is not {match.group(1)} {threshold:g}W"
+
+    return predicate
+
+def time_of_day_predicate(value):
+    """Compile 'HH:MM-HH:MM' into a predicate on the fire time, ranges may cross midnight"""
+    match = TIME_RANGE_PATTERN.match(value or '')
+    if not match:
+        raise ValueError(f"Invalid time of day '{value}', expected e.g. '06:00-18:00'")
+
+    start_h, start_m, end_h, end_m = (int(part) for part in match.groups())
+    if start_h > 23 or end_h > 23 or start_m > 59 or end_m > 59:
+        raise ValueError(f"Invalid time of day '{value}'")
+
+    start = start_h * 60 + start_m
+    end = end_h * 60 + end_m
+
+    def predicate(ctx):
+        minute = ctx.now.hour * 60 + ctx.now.minute
+        inside = start <= minute < end if start <= end else minute >= start or minute < end
+        return (True, None) if inside else (False, f"{ctx.now.strftime('%H:%M')} is outside {value.strip()}")
+
+    return predicate
+
+def weather_predicate(value):
+    """Compile 'rain', '!rain', 'not rain' or 'temperature>30' into a predicate on the current weather"""
+    text = (value or '').strip().lower()
+    if not text:
+        raise ValueError("Empty weather condition")
+
+    match = WEATHER_COMPARISON_PATTERN.match(text)
+    if match:
+        field = match.group(1)
+        compare = COMPARISONS[match.group(2)]
+        threshold = float(match.group(3))
+
+        def test(current):
+            reading = current.get(field)
+            return reading is not None and compare(float(reading), threshold)
+    else:
+        negate = text.startswith('!') or text.startswith('not ')
+        expected = text.lstrip('!').replace('not ', '', 1).strip()
+
+        def test(current):
+            return (current.get('condition', '').lower() == expected) != negate
+
+    def predicate(ctx):
+        current = weather.current(ctx.location)
+        if not current:
+            return False, "weather unavailable"
+        if test(current):
+            return True, None
+        return False, f"weather condition '{text}' not met"
+
+    return predicate
+
+CONDITION_COMPILERS = {
+    CONDITION_POWER_THRESHOLD: power_threshold_predicate,
+    CONDITION_TIME_OF_DAY: time_of_day_predicate,
+    CONDITION_WEATHER: weather_predicate
+}
+
+@lru_cache(maxsize=4096)
+def compile_condition(condition_type, condition_value):
+    """
+    Parse a schedule condition once into a predicate
+
+    Schedules sharing a condition share the compiled predicate. A predicate
+    takes a ConditionContext and returns (met, reason), where reason explains
+    why the condition was not met.
+
+    Args:
+        condition_type (str): 'power_threshold', 'time_of_day' or 'weather'
+        condition_value (str): Condition, e.g. '>500', '06:00-18:00', 'rain'
+
+    Raises:
+        ValueError: If the condition cannot be parsed
+
+    Returns:
+        function: Predicate
+    """
+    compiler = CONDITION_COMPILERS.get(condition_type)
+    if not compiler:
+        raise ValueError(f"Unknown condition type '{condition_type}'")
+    return compiler(condition_value)
+
+def invalid_condition(reason):
+    """Predicate for a condition that failed to parse, it is never met"""
+    def predicate(ctx):
+        return False, reason
+    return predicate
+
+def condition_for(schedule):
+    """
+    Get the compiled condition of a schedule
+
+    Args:
+        schedule (Schedule): Schedule row
+
+    Returns:
+        function: Predicate, or None if the schedule is unconditional
+    """
+    if not schedule.conditional:
+        return None
+
+    try:
+        return compile_condition(schedule.condition_type, schedule.condition_value)
+    except ValueError as e:
+        logger.warning(f"Schedule {schedule.id} has an invalid condition: {str(e)}")
+        return invalid_condition(f"invalid condition: {str(e)}")
+
+def evaluate(predicate, device_pk, location=None, now=None):
+    """
+    Evaluate a compiled condition for a device
+
+    Returns:
+        tuple: (met, reason)
+    """
+    return predicate(ConditionContext(device_pk, location, now or datetime.utcnow()))
@@ -0,0 +1,142 @@
+import threading
+import time
+import logging
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Cached view of a device, carrying the attributes the ingest path needs
+DeviceEntry = namedtuple('DeviceEntry', [
+    'id',           # primary key in the devices table
+    'device_id',    # IoT device identifier
+    'user_id',
+    'name',
+    'device_type',
+    'max_power'     # max power capacity in watts
+])
+
+class DeviceRegistry:
+    """Bounded LRU cache mapping IoT device IDs to device entries"""
+
+    def __init__(self, max_size=10000, ttl=300, negative_ttl=60):
+        """
+        Args:
+            max_size (int): Maximum number of cached device IDs
+            ttl (float): Seconds a known device stays cached
+            negative_ttl (float): Seconds an unknown device ID stays cached
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        # device_id -> (DeviceEntry or None, expires_at)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def init_app(self, app):
+        """Configure the registry from app settings"""
+        self.max_size = app.config.get('DEVICE_CACHE_SIZE', self.max_size)
+        self.ttl = app.config.get('DEVICE_CACHE_TTL', self.ttl)
+        self.negative_ttl = app.config.get('DEVICE_CACHE_NEGATIVE_TTL', self.negative_ttl)
+        self.clear()
+
+    def get(self, device_id):
+        """
+        Resolve an IoT device ID
+
+        Args:
+            device_id (str): Device ID from IoT device
+
+        Returns:
+            DeviceEntry: Cached device, or None if the device is unknown
+        """
+        return self.get_many([device_id]).get(device_id)
+
+    def get_many(self, device_ids):
+        """
+        Resolve several IoT device IDs, loading all misses with one query
+
+        Args:
+            device_ids (iterable): Device IDs from IoT devices
+
+        Returns:
+            dict: Device ID to DeviceEntry for the known devices
+        """
+        found = {}
+        missing = []
+        now = time.monotonic()
+
+        with self._lock:
+            for device_id in set(device_ids):
+                cached = self._entries.get(device_id)
+                if cached and cached[1] > now:
+                    self._entries.move_to_end(device_id)
+                    if cached[0] is None:
+                        self.negative_hits += 1
+                    else:
+                        self.hits += 1
+                        found[device_id] = cached[0]
+                else:
+                    self.misses += 1
+                    missing.append(device_id)
+
+        if missing:
+            loaded = self._load(missing)
+            with self._lock:
+                for device_id in missing:
+                    entry = loaded.get(device_id)
+                    ttl = self.ttl if entry else self.negative_ttl
+                    self._store(device_id, entry, now + ttl)
+            found.update(loaded)
+
+        return found
+
+    def invalidate(self, device_id):
+        """Drop a device ID from the cache so the next lookup reloads it"""
+        with self._lock:
+            self._entries.pop(device_id, None)
+
+    def clear(self):
+        """Drop all cached entries"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Get cache counters"""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+    def _store(self, device_id, entry, expires_at):
+        """Store an entry, evicting the least recently used ones past max_size"""
+        self._entries[device_id] = (entry, expires_at)
+        self._entries.move_to_end(device_id)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _load(self, device_ids):
+        """Load device entries from the database"""
+        from app.models.device import Device
+        from app import db
+
+        rows = db.session.query(
+            Device.id, Device.device_id, Device.user_id,
+            Device.name, Device.device_type, Device.max_power
+        ).filter(Device.device_id.in_(device_ids))
+
+        return {row.device_id: DeviceEntry(*row) for row in rows}
+
+# Global device registry
+device_registry = DeviceRegistry()
@@ -0,0 +1,202 @@
+import atexit
+import json
+import queue
+import threading
+import time
+import zlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Global message dispatcher
+message_dispatcher = None
+
+# Processing stages timed by the dispatcher
+STAGES = ("queue", "decode", "handle")
+
+def decode_payload(payload):
+    """Decode a raw MQTT payload into a dict"""
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8')
+    return json.loads(payload)
+
+class MessageDispatcher:
+    """Hands MQTT messages to a pool of worker threads, keeping per-device order"""
+
+    def __init__(self, app, handler, workers=4, queue_size=1000, enqueue_timeout=0.5, decode_processes=0):
+        """
+        Args:
+            app (Flask): Application used for each worker's app context
+            handler (callable): Called as handler(topic, data) with the decoded payload
+            workers (int): Number of worker threads
+            queue_size (int): Maximum number of pending messages per worker
+            enqueue_timeout (float): Seconds to block the MQTT thread when a worker queue is full
+            decode_processes (int): Decode payloads in a process pool of this size (0 decodes in the worker)
+        """
+        self.app = app
+        self.handler = handler
+        self.enqueue_timeout = enqueue_timeout
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(max(1, workers))]
+        self.decode_pool = ProcessPoolExecutor(max_workers=decode_processes) if decode_processes else None
+
+        self._lock = threading.Lock()
+        self._threads = []
+        self._running = False
+
+        self.dispatched = 0
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.latency = {stage: {"count": 0, "total": 0.0, "max": 0.0} for stage in STAGES}
+
+    def start(self):
+        """Start the worker threads"""
+        if self._running:
+            return
+
+        self._running = True
+        for index, work_queue in enumerate(self.queues):
+            thread = threading.Thread(
+                target=self._run, args=(work_queue,),
+                name=f"mqtt-worker-{index}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5.0):
+        """Let the workers finish pending messages and stop them"""
+        if not self._running:
+            return
+
+        self._running = False
+        for work_queue in self.queues:
+            work_queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+        if self.decode_pool:
+            self.decode_pool.shutdown(wait=False)
+
+    def worker_for(self, device_id):
+        """Get the worker index for a device, so one device is always handled in order"""
+        return zlib.crc32(device_id.encode('utf-8')) % len(self.queues)
+
+    def dispatch(self, device_id, topic, payload):
+        """
+        Queue a message on the worker that owns its device
+
+        Args:
+            device_id (str): Device ID extracted from the topic
+            topic (str): MQTT topic
+            payload (bytes): Raw MQTT payload
+
+        Returns:
+            bool: True if queued, False if dropped
+        """
+        work_queue = self.queues[self.worker_for(device_id)]
+        block = self.enqueue_timeout > 0
+
+        try:
+            work_queue.put((time.monotonic(), topic, payload), block=block,
+                           timeout=self.enqueue_timeout if block else None)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logger.warning(f"MQTT worker queue full, dropped message on {topic}")
+            return False
+
+        with self._lock:
+            self.dispatched += 1
+        return True
+
+    def stats(self):
+        """Get queue depths, counters and per-stage latency in milliseconds"""
+        with self._lock:
+            return {
+                "workers": len(self.queues),
+                "queue_depth": sum(q.qsize() for q in self.queues),
+                "worker_queue_depths": [q.qsize() for q in self.queues],
+                "dispatched": self.dispatched,
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "latency_ms": {
+                    stage: {
+                        "avg": (values["total"] / values["count"] * 1000) if values["count"] else 0,
+                        "max": values["max"] * 1000
+                    } for stage, values in self.latency.items()
+                }
+            }
+
+    def _record(self, stage, seconds):
+        values = self.latency[stage]
+        values["count"] += 1
+        values["total"] += seconds
+        if seconds > values["max"]:
+            values["max"] = seconds
+
+    def _decode(self, payload):
+        if self.decode_pool:
+            return self.decode_pool.submit(decode_payload, payload).result()
+        return decode_payload(payload)
+
+    def _process(self, queued_at, topic, payload):
+        """Decode and handle one message, timing each stage"""
+        from app import db
+
+        started = time.monotonic()
+        try:
+            data = self._decode(payload)
+            decoded = time.monotonic()
+
+            self.handler(topic, data)
+            handled = time.monotonic()
+
+            with self._lock:
+                self.processed += 1
+                self._record("queue", started - queued_at)
+                self._record("decode", decoded - started)
+                self._record("handle", handled - decoded)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            logger.error(f"Error processing MQTT message on {topic}: {str(e)}")
+        finally:
+            # Give every message a fresh session
+            db.session.remove()
+
+    def _run(self, work_queue):
+        """Worker loop, each worker keeps its own app context and scoped session"""
+        with self.app.app_context():
+            while True:
+                item = work_queue.get()
+                if item is None:
+                    break
+                self._process(*item)
+
+def setup_message_dispatcher(app, handler):
+    """Initialize and start the global message dispatcher"""
+    global message_dispatcher
+
+    if message_dispatcher:
+        return message_dispatcher
+
+    workers = app.config.get('MQTT_DISPATCH_WORKERS', 4)
+    if workers <= 0:
+        # Messages are handled inline on the MQTT network thread
+        return None
+
+    message_dispatcher = MessageDispatcher(
+        app,
+        handler,
+        workers=workers,
+        queue_size=app.config.get('MQTT_DISPATCH_QUEUE_SIZE', 1000),
+        enqueue_timeout=app.config.get('MQTT_DISPATCH_ENQUEUE_TIMEOUT', 0.5),
+        decode_processes=app.config.get('MQTT_DISPATCH_DECODE_PROCESSES', 0)
+    )
+    message_dispatcher.start()
+    atexit.register(message_dispatcher.stop)
+
+    return message_dispatcher
@@ -0,0 +1,281 @@
+import json
+import threading
+import time
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Global event broker, replaced by setup_event_broker
+event_broker = None
+
+# Event types pushed to dashboards
+EVENT_POWER = 'power'
+EVENT_DEVICE = 'device'
+EVENT_NOTIFICATION = 'notification'
+EVENT_RESYNC = 'resync'   # events were dropped, the client should reload its data
+
+def user_channel(user_id):
+    """Channel carrying a user's events"""
+    return f"user:{user_id}"
+
+def encode_event(event_type, data):
+    """Serialize an event for publishing"""
+    return json.dumps({"type": event_type, "data": data}, default=str, separators=(',', ':'))
+
+def notification_event(notification):
+    """Event data for a new notification, read before the commit expires its attributes"""
+    return {
+        "id": notification.id,
+        "title": notification.title,
+        "notification_type": notification.notification_type,
+        "device_id": notification.device_id,
+        "timestamp": notification.timestamp.isoformat()
+    }
+
+class Subscription:
+    """Bounded queue of messages for one subscriber; the oldest are dropped when it overflows"""
+
+    def __init__(self, broker, channel, max_size=100):
+        self.broker = broker
+        self.channel = channel
+        self._messages = deque(maxlen=max_size)
+        self._ready = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, message):
+        with self._ready:
+            if len(self._messages) == self._messages.maxlen:
+                self.dropped += 1
+            self._messages.append(message)
+            self._ready.notify()
+
+    def get(self, timeout=None):
+        """
+        Wait for the next message
+
+        Returns:
+            str: Message, or None on timeout or once closed
+        """
+        with self._ready:
+            if not self._messages and not self.closed:
+                self._ready.wait(timeout)
+            return self._messages.popleft() if self._messages else None
+
+    def take_dropped(self):
+        """Get and reset the number of messages dropped since the last call"""
+        with self._ready:
+            dropped, self.dropped = self.dropped, 0
+            return dropped
+
+    def close(self):
+        with self._ready:
+            self.closed = True
+            self._ready.notify_all()
+        self.broker.unsubscribe(self)
+
+class LocalBroker:
+    """
+    In-process pub/sub with the publish/subscribe interface of Redis
+
+    Publishing to a channel without subscribers is a dictionary lookup, so
+    the ingest path can publish unconditionally.
+    """
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._channels = {}
+        self._lock = threading.Lock()
+
+        self.published = 0
+        self.delivered = 0
+
+    def publish(self, channel, message):
+        """
+        Deliver a message to the channel's subscribers in this process
+
+        Returns:
+            int: Number of subscribers that received it
+        """
+        subscribers = self._channels.get(channel)
+        self.published += 1
+        if not subscribers:
+            return 0
+
+        for subscription in tuple(subscribers):
+            subscription.put(message)
+        self.delivered += len(subscribers)
+        return len(subscribers)
+
+    def publish_many(self, messages):
+        """
+        Publish several (channel, message) pairs
+
+        Returns:
+            int: Number of deliveries
+        """
+        return sum(self.publish(channel, message) for channel, message in messages)
+
+    def wants(self, channel):
+        """Whether a message published to the channel can reach anyone"""
+        return channel in self._channels
+
+    def subscribe(self, channel):
+        """Subscribe to a channel, close the returned Subscription to leave it"""
+        subscription = Subscription(self, channel, self.queue_size)
+        with self._lock:
+            self._channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._channels.get(subscription.channel)
+            if subscribers:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._channels[subscription.channel]
+
+    def subscriber_count(self, channel=None):
+        with self._lock:
+            if channel is not None:
+                return len(self._channels.get(channel, ()))
+            return sum(len(subscribers) for subscribers in self._channels.values())
+
+    def stats(self):
+        """Get broker counters"""
+        return {
+            "channels": len(self._channels),
+            "subscribers": self.subscriber_count(),
+            "published": self.published,
+            "delivered": self.delivered
+        }
+
+    def close(self):
+        pass
+
+class RedisBroker(LocalBroker):
+    """
+    Fan-out across processes through Redis pub/sub
+
+    Messages are published to Redis. Each process holds a single pattern
+    subscription and hands the messages it receives to its local
+    subscribers, so Redis sees one connection per process rather than one
+    per browser.
+    """
+
+    def __init__(self, url, queue_size=100, prefix='smart-farm:'):
+        import redis
+
+        super().__init__(queue_size)
+        self.prefix = prefix
+        self.redis = redis.Redis.from_url(url)
+        self._pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.psubscribe(**{f"{prefix}*": self._receive})
+        self._thread = self._pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+    def wants(self, channel):
+        return True
+
+    def publish(self, channel, message):
+        self.published += 1
+        return self.redis.publish(self.prefix + channel, message)
+
+    def publish_many(self, messages):
+        pipeline = self.redis.pipeline(transaction=False)
+        for channel, message in messages:
+            pipeline.publish(self.prefix + channel, message)
+            self.published += 1
+        return sum(pipeline.execute())
+
+    def _receive(self, item):
+        channel = item["channel"].decode() if isinstance(item["channel"], bytes) else item["channel"]
+        message = item["data"].decode() if isinstance(item["data"], bytes) else item["data"]
+        super().publish(channel[len(self.prefix):], message)
+
+    def close(self):
+        self._thread.stop()
+        self._pubsub.close()
+
+def publish_events(events):
+    """
+    Publish events without letting a broker failure reach the caller
+
+    Args:
+        events (iterable): (user_id, event_type, data) tuples
+    """
+    if event_broker is None:
+        return
+
+    # Events nobody listens to are not even serialized
+    messages = []
+    for user_id, event_type, data in events:
+        channel = user_channel(user_id)
+        if event_broker.wants(channel):
+            messages.append((channel, encode_event(event_type, data)))
+    if not messages:
+        return
+    try:
+        event_broker.publish_many(messages)
+    except Exception as e:
+        logger.error(f"Error publishing events: {str(e)}")
+
+def publish_event(user_id, event_type, data):
+    """Publish one event to a user's channel"""
+    publish_events([(user_id, event_type, data)])
+
+def sse_stream(user_id, keepalive=15.0, max_duration=300.0):
+    """
+    Server-Sent Events for a user
+
+    Yields the events published to the user's channel. Comment lines keep
+    idle connections open, and the stream ends after max_duration so workers
+    are recycled; browsers reconnect on their own after the retry delay.
+
+    Args:
+        user_id (int): User ID
+        keepalive (float): Seconds between keepalive comments when idle
+        max_duration (float): Seconds before the stream is closed
+
+    Yields:
+        str: SSE frames
+    """
+    subscription = event_broker.subscribe(user_channel(user_id))
+    deadline = time.monotonic() + max_duration
+    try:
+        yield "retry: 3000\n: connected\n\n"
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            message = subscription.get(min(keepalive, remaining))
+            if subscription.take_dropped():
+                yield f"event: {EVENT_RESYNC}\ndata: {{}}\n\n"
+            if message is None:
+                yield ": keepalive\n\n"
+                continue
+
+            event_type = json.loads(message)["type"]
+            yield f"event: {event_type}\ndata: {message}\n\n"
+    finally:
+        subscription.close()
+
+def setup_event_broker(app):
+    """Create the event broker, using Redis when EVENTS_BROKER_URL is set"""
+    global event_broker
+
+    if event_broker is not None:
+        return event_broker
+
+    queue_size = app.config.get('EVENTS_QUEUE_SIZE', 100)
+    url = app.config.get('EVENTS_BROKER_URL')
+    if url:
+        try:
+            event_broker = RedisBroker(url, queue_size)
+            return event_broker
+        except Exception as e:
+            logger.error(f"Could not connect to the event broker, using in-process events: {str(e)}")
+
+    event_broker = LocalBroker(queue_size)
+    return event_broker
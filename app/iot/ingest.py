@@ -0,0 +1,392 @@
+import atexit
+import queue
+import threading
+import time
+import logging
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import insert, update
+
+logger = logging.getLogger(__name__)
+
+# Global telemetry ingestor
+telemetry_ingestor = None
+
+# A decoded telemetry sample waiting to be written
+TelemetrySample = namedtuple('TelemetrySample', [
+    'device_id',       # IoT device identifier (string)
+    'timestamp',       # time the message was received
+    'power',           # power usage in watts
+    'voltage',         # voltage in volts, None if not reported
+    'current',         # current in amps, None if not reported
+    'power_factor',
+    'energy',
+    'is_reading'       # True if the sample should be stored as a PowerReading
+])
+
+def build_sample(device_id, data, received_at=None):
+    """
+    Build a telemetry sample from a decoded MQTT payload
+
+    Args:
+        device_id (str): Device ID from IoT device
+        data (dict): Decoded telemetry payload
+        received_at (datetime): Time the message was received
+
+    Returns:
+        TelemetrySample: Sample, or None if the payload has no power value
+    """
+    if "power" not in data:
+        return None
+
+    is_reading = all(k in data for k in ["power", "voltage", "current"])
+
+    return TelemetrySample(
+        device_id=device_id,
+        timestamp=received_at or datetime.utcnow(),
+        power=float(data["power"]),
+        voltage=float(data["voltage"]) if is_reading else None,
+        current=float(data["current"]) if is_reading else None,
+        power_factor=float(data.get("power_factor", 0.0)),
+        energy=float(data.get("energy", 0.0)),
+        is_reading=is_reading
+    )
+
+# A committed telemetry batch, handed to the post-commit step
+CommittedBatch = namedtuple('CommittedBatch', [
+    'written',         # number of samples of known devices
+    'devices',         # IoT device ID -> device registry entry
+    'latest',          # device primary key -> latest current_power and last_updated
+    'peaks'            # device primary key -> (device entry, peak power)
+])
+
+def write_telemetry_batch(samples):
+    """
+    Write a batch of telemetry samples to the database and act on it
+
+    Args:
+        samples (list): List of TelemetrySample
+
+    Returns:
+        int: Number of samples written
+    """
+    committed = store_telemetry_batch(samples)
+    after_telemetry_commit(committed)
+    return committed.written
+
+def store_telemetry_batch(samples):
+    """
+    Write and commit a batch of telemetry samples
+
+    Inserts all power readings with a single bulk INSERT and coalesces the
+    current power of each device into a single bulk UPDATE, then commits once.
+    Nothing else happens here, so an error means the batch was not stored.
+
+    Args:
+        samples (list): List of TelemetrySample
+
+    Returns:
+        CommittedBatch: What was written, for after_telemetry_commit
+    """
+    from app.models.device import Device
+    from app.models.power_usage import PowerReading
+    from app.iot.device_registry import device_registry
+    from app.iot.rollups import update_rollups
+    from app import db
+
+    if not samples:
+        return CommittedBatch(0, {}, {}, {})
+
+    # Resolve all device IDs in the batch, only cache misses hit the database
+    devices = device_registry.get_many(sample.device_id for sample in samples)
+
+    readings = []
+    latest = {}
+    peaks = {}
+    written = 0
+
+    for sample in samples:
+        device = devices.get(sample.device_id)
+        if not device:
+            logger.warning(f"Received telemetry for unknown device: {sample.device_id}")
+            continue
+
+        written += 1
+
+        # Only the most recent sample per device ends up in current_power
+        previous = latest.get(device.id)
+        if not previous or sample.timestamp >= previous["last_updated"]:
+            latest[device.id] = {
+                "id": device.id,
+                "current_power": sample.power,
+                "last_updated": sample.timestamp
+            }
+
+        if sample.is_reading:
+            readings.append({
+                "device_id": device.id,
+                "timestamp": sample.timestamp,
+                "power_usage": sample.power,
+                "voltage": sample.voltage,
+                "current": sample.current,
+                "power_factor": sample.power_factor,
+                "energy_consumed": sample.energy
+            })
+
+            if device.id not in peaks or sample.power > peaks[device.id][1]:
+                peaks[device.id] = (device, sample.power)
+
+    if readings:
+        db.session.execute(insert(PowerReading), readings)
+        update_rollups([(r["device_id"], r["timestamp"], r["power_usage"]) for r in readings])
+
+    if latest:
+        db.session.execute(update(Device), list(latest.values()))
+
+    db.session.commit()
+    return CommittedBatch(written, devices, latest, peaks)
+
+def after_telemetry_commit(committed):
+    """
+    Update in-memory state, publish events and check thresholds for a stored batch
+
+    The readings are already committed, so each step logs its own errors
+    rather than failing the batch.
+
+    Args:
+        committed (CommittedBatch): Result of store_telemetry_batch
+    """
+    from app.iot.mqtt_client import check_power_thresholds
+    from app.iot.conditions import device_state_store
+    from app.iot.events import EVENT_POWER, publish_events
+    from app.africastalking.snapshots import ussd_snapshots
+    from app import db
+
+    latest = committed.latest
+    try:
+        # Keep the in-memory device state used by conditional schedules current
+        device_state_store.update_many(
+            (device_pk, state["current_power"], state["last_updated"]) for device_pk, state in latest.items()
+        )
+        ussd_snapshots.apply(latest.values())
+
+        # Push the new power of each device to its owner's live dashboards, one event per user
+        owners = {device.id: device.user_id for device in committed.devices.values()}
+        changed = {}
+        for device_pk, state in latest.items():
+            changed.setdefault(owners[device_pk], []).append(state)
+        publish_events((user_id, EVENT_POWER, {"devices": states}) for user_id, states in changed.items())
+    except Exception as e:
+        logger.error(f"Error publishing telemetry updates: {str(e)}")
+
+    # Check thresholds once per device using the peak sample of the window
+    for device, power_usage in committed.peaks.values():
+        try:
+            check_power_thresholds(device, power_usage)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error checking power thresholds for {device.device_id}: {str(e)}")
+
+class TelemetryIngestor:
+    """
+    Buffers decoded telemetry and flushes it to the database in batches
+
+    A batch whose write fails, e.g. on a lock timeout, is retried up to
+    max_retries times before it is counted as failed. Errors after the
+    commit (events, threshold checks) are logged and do not affect the
+    flush counters.
+    """
+
+    def __init__(self, app, flush_size=500, flush_interval=1.0, max_queue_size=10000, enqueue_timeout=0.5,
+                 max_retries=3, retry_backoff=0.1):
+        """
+        Args:
+            app (Flask): Application used for the flush thread's app context
+            flush_size (int): Flush as soon as this many samples are buffered
+            flush_interval (float): Maximum seconds a sample waits before being flushed
+            max_queue_size (int): Maximum number of buffered samples
+            enqueue_timeout (float): Seconds to block a producer when the queue is full
+            max_retries (int): Retries of a batch whose write failed
+            retry_backoff (float): Seconds before the first retry, doubled per retry
+        """
+        self.app = app
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.queue = queue.Queue(maxsize=max_queue_size)
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self.queued = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retries = 0
+        self.flushes = 0
+
+    def start(self):
+        """Start the background flush thread"""
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="telemetry-ingestor", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Stop the flush thread and write any buffered samples"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        self.drain()
+
+    def submit(self, sample):
+        """
+        Queue a telemetry sample for the next flush
+
+        Blocks for up to enqueue_timeout when the queue is full so that a
+        backlog slows the MQTT network loop down, then drops the sample.
+
+        Args:
+            sample (TelemetrySample): Sample to write
+
+        Returns:
+            bool: True if queued, False if dropped
+        """
+        block = self.enqueue_timeout > 0
+        try:
+            self.queue.put(sample, block=block, timeout=self.enqueue_timeout if block else None)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logger.warning(f"Telemetry queue full, dropped sample for {sample.device_id}")
+            return False
+
+        with self._lock:
+            self.queued += 1
+        return True
+
+    def drain(self):
+        """Synchronously flush everything currently buffered"""
+        while True:
+            batch = self._take(self.flush_size, block=False)
+            if not batch:
+                break
+            self._flush(batch)
+
+    def stats(self):
+        """Get ingestion counters"""
+        with self._lock:
+            return {
+                "queued": self.queued,
+                "flushed": self.flushed,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "retries": self.retries,
+                "flushes": self.flushes,
+                "queue_depth": self.queue.qsize()
+            }
+
+    def _take(self, max_items, block=True):
+        """Collect up to max_items samples, waiting at most flush_interval after the first"""
+        batch = []
+        try:
+            batch.append(self.queue.get(block=block, timeout=self.flush_interval if block else None))
+        except queue.Empty:
+            return batch
+
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < max_items:
+            remaining = deadline - time.monotonic()
+            try:
+                if block and remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _flush(self, batch):
+        """Write a batch to the database inside an app context, then act on it"""
+        from app import db
+
+        with self._flush_lock, self.app.app_context():
+            try:
+                committed = self._store(batch)
+                if committed:
+                    after_telemetry_commit(committed)
+            finally:
+                db.session.remove()
+
+    def _store(self, batch):
+        """
+        Write and commit a batch, retrying failed writes with backoff
+
+        Returns:
+            CommittedBatch: Stored batch, or None if every attempt failed
+        """
+        from app.metrics import INGEST_FLUSH_SECONDS, INGEST_FLUSHED_SAMPLES
+        from app import db
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                with INGEST_FLUSH_SECONDS.time():
+                    committed = store_telemetry_batch(batch)
+            except Exception as e:
+                db.session.rollback()
+                if attempt < self.max_retries:
+                    with self._lock:
+                        self.retries += 1
+                    logger.warning(f"Error writing telemetry batch, retrying: {str(e)}")
+                    time.sleep(self.retry_backoff * (2 ** attempt))
+                    continue
+
+                INGEST_FLUSHED_SAMPLES.inc(len(batch), ("failed",))
+                with self._lock:
+                    self.failed += len(batch)
+                logger.error(f"Error flushing telemetry batch after {attempt + 1} attempts: {str(e)}")
+                return None
+
+            INGEST_FLUSHED_SAMPLES.inc(len(batch), ("written",))
+            with self._lock:
+                self.flushed += len(batch)
+                self.flushes += 1
+            return committed
+
+    def _run(self):
+        """Flush loop, triggered by batch size or flush interval"""
+        while not self._stop_event.is_set():
+            batch = self._take(self.flush_size)
+            if batch:
+                self._flush(batch)
+
+def setup_telemetry_ingestor(app):
+    """Initialize and start the global telemetry ingestor"""
+    global telemetry_ingestor
+
+    if telemetry_ingestor:
+        return telemetry_ingestor
+
+    telemetry_ingestor = TelemetryIngestor(
+        app,
+        flush_size=app.config.get('INGEST_FLUSH_SIZE', 500),
+        flush_interval=app.config.get('INGEST_FLUSH_INTERVAL', 1.0),
+        max_queue_size=app.config.get('INGEST_QUEUE_SIZE', 10000),
+        enqueue_timeout=app.config.get('INGEST_ENQUEUE_TIMEOUT', 0.5),
+        max_retries=app.config.get('INGEST_FLUSH_RETRIES', 3)
+    )
+    telemetry_ingestor.start()
+
+    # Write out anything still buffered when the process exits
+    atexit.register(telemetry_ingestor.stop)
+
+    return telemetry_ingestor
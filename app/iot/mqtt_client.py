@@ -1,9 +1,14 @@
+import os
 import json
+import time
 import paho.mqtt.client as mqtt
+from sqlalchemy import update
 from flask import current_app
 import logging
 from datetime import datetime
 
+from app.metrics import MQTT_CALLBACK_SECONDS, MQTT_MESSAGES
+
 logger = logging.getLogger(__name__)
 
 # Global MQTT client
@@ -15,8 +20,40 @@ DEVICE_TOPIC = TOPIC_PREFIX + "devices/"
 CONTROL_TOPIC = TOPIC_PREFIX + "control/"
 TELEMETRY_TOPIC = TOPIC_PREFIX + "telemetry/"
 
-def setup_mqtt_client():
-    """Initialize and configure the MQTT client"""
+# Ingestion modes
+INGEST_EMBEDDED = "embedded"          # every process subscribes to all device topics
+INGEST_SHARED = "shared"              # processes split the load through an MQTT v5 shared subscription
+INGEST_PUBLISH_ONLY = "publish_only"  # process only publishes control commands
+
+def subscription_topics(ingest_mode, shared_group=None):
+    """
+    Get the topic filters a client should subscribe to
+
+    Args:
+        ingest_mode (str): One of the INGEST_* modes
+        shared_group (str): Shared subscription group name for INGEST_SHARED
+
+    Returns:
+        list: Topic filters
+    """
+    topics = [f"{DEVICE_TOPIC}#", f"{TELEMETRY_TOPIC}#"]
+
+    if ingest_mode == INGEST_PUBLISH_ONLY:
+        return []
+
+    if ingest_mode == INGEST_SHARED:
+        return [f"$share/{shared_group}/{topic}" for topic in topics]
+
+    return topics
+
+def setup_mqtt_client(ingest_mode=None, start_loop=True):
+    """
+    Initialize and configure the MQTT client
+
+    Args:
+        ingest_mode (str): Override for the MQTT_INGEST_MODE setting
+        start_loop (bool): Start the network loop in a background thread
+    """
     global mqtt_client
 
     if mqtt_client:
@@ -28,10 +65,16 @@ def setup_mqtt_client():
     broker_port = current_app.config.get('MQTT_BROKER_PORT', 1883)
     username = current_app.config.get('MQTT_USERNAME')
     password = current_app.config.get('MQTT_PASSWORD')
-    client_id = f"smart-farm-server-{datetime.utcnow().timestamp()}"
-
-    # Initialize the MQTT client
-    mqtt_client = mqtt.Client(client_id=client_id, clean_session=True)
+    ingest_mode = ingest_mode or current_app.config.get('MQTT_INGEST_MODE', INGEST_EMBEDDED)
+    shared_group = current_app.config.get('MQTT_SHARED_GROUP', 'smart-farm-ingest')
+    client_id = f"smart-farm-server-{os.getpid()}-{datetime.utcnow().timestamp()}"
+
+    # Shared subscriptions need MQTT v5
+    userdata = {"topics": subscription_topics(ingest_mode, shared_group)}
+    if ingest_mode == INGEST_SHARED:
+        mqtt_client = mqtt.Client(client_id=client_id, userdata=userdata, protocol=mqtt.MQTTv5)
+    else:
+        mqtt_client = mqtt.Client(client_id=client_id, clean_session=True, userdata=userdata)
 
     # Set up authentication if provided
     if username and password:
@@ -41,6 +84,27 @@ def setup_mqtt_client():
     if current_app.config.get('MQTT_TLS_ENABLED', False):
         mqtt_client.tls_set()
 
+    # Track command acknowledgements. Outside embedded mode device reports may
+    # be handled by another process, so also confirm from the device rows
+    from app.iot.commands import setup_command_tracker
+    app = current_app._get_current_object()
+    setup_command_tracker(app, confirm_from_db=ingest_mode != INGEST_EMBEDDED)
+
+    # Warm the settings cache, then start the batching ingestor, alert writer
+    # and worker pool before any message can arrive
+    if ingest_mode != INGEST_PUBLISH_ONLY:
+        from app.iot.ingest import setup_telemetry_ingestor
+        from app.iot.alerts import setup_alert_engine
+        from app.iot.dispatcher import setup_message_dispatcher
+        from app.iot.user_settings import settings_cache
+        try:
+            settings_cache.preload()
+        except Exception as e:
+            logger.error(f"Could not preload notification settings: {str(e)}")
+        setup_telemetry_ingestor(app)
+        setup_alert_engine(app)
+        setup_message_dispatcher(app, route_message)
+
     # Set up callbacks
     mqtt_client.on_connect = on_connect
     mqtt_client.on_message = on_message
@@ -48,25 +112,35 @@ def setup_mqtt_client():
 
     # Connect to broker
     try:
-        mqtt_client.connect(broker_url, broker_port, keepalive=60)
-        mqtt_client.loop_start()
-        logger.info(f"MQTT client connected to {broker_url}:{broker_port}")
+        if ingest_mode == INGEST_SHARED:
+            mqtt_client.connect(broker_url, broker_port, keepalive=60, clean_start=True)
+        else:
+            mqtt_client.connect(broker_url, broker_port, keepalive=60)
+        if start_loop:
+            mqtt_client.loop_start()
+        logger.info(f"MQTT client connected to {broker_url}:{broker_port} ({ingest_mode})")
     except Exception as e:
         logger.error(f"Failed to connect to MQTT broker: {str(e)}")
 
     return mqtt_client
 
-def on_connect(client, userdata, flags, rc):
+def run_ingest_worker():
+    """Run a standalone ingest worker on a shared subscription until interrupted"""
+    client = setup_mqtt_client(ingest_mode=INGEST_SHARED, start_loop=False)
+    client.loop_forever(retry_first_connection=True)
+
+def on_connect(client, userdata, flags, rc, properties=None):
     """Callback for when the client receives a CONNACK response from the server"""
     if rc == 0:
         logger.info("Connected to MQTT broker")
-        # Subscribe to all device topics
-        client.subscribe(f"{DEVICE_TOPIC}#")
-        client.subscribe(f"{TELEMETRY_TOPIC}#")
+        # Subscribe to the device topics for this ingestion mode
+        topics = userdata["topics"] if userdata else subscription_topics(INGEST_EMBEDDED)
+        for topic in topics:
+            client.subscribe(topic)
     else:
         logger.error(f"Failed to connect to MQTT broker, return code: {rc}")
 
-def on_disconnect(client, userdata, rc):
+def on_disconnect(client, userdata, rc, properties=None):
     """Callback for when the client disconnects from the server"""
     if rc != 0:
         logger.warning(f"Unexpected disconnection from MQTT broker, return code: {rc}")
@@ -75,51 +149,86 @@ def on_disconnect(client, userdata, rc):
 
 def on_message(client, userdata, msg):
     """Callback for when a message is received from the server"""
+    started = time.perf_counter()
+    kind = "other"
     try:
         topic = msg.topic
-        payload = msg.payload.decode('utf-8')
-        logger.debug(f"Received message on topic {topic}: {payload}")
-
-        # Process message based on topic
-        if topic.startswith(DEVICE_TOPIC):
-            process_device_message(topic, payload)
-        elif topic.startswith(TELEMETRY_TOPIC):
-            process_telemetry_message(topic, payload)
+        kind = "telemetry" if topic.startswith(TELEMETRY_TOPIC) else "device" if topic.startswith(DEVICE_TOPIC) else "other"
+        logger.debug(f"Received message on topic {topic}: {msg.payload}")
+
+        # Hand the message to the worker pool so the network loop never
+        # waits on the database or the SMS API
+        from app.iot import dispatcher
+        if dispatcher.message_dispatcher:
+            dispatcher.message_dispatcher.dispatch(device_id_from_topic(topic), topic, msg.payload)
+        else:
+            route_message(topic, dispatcher.decode_payload(msg.payload))
     except Exception as e:
         logger.error(f"Error processing MQTT message: {str(e)}")
+    finally:
+        labels = (kind,)
+        MQTT_MESSAGES.inc(1, labels)
+        MQTT_CALLBACK_SECONDS.observe(time.perf_counter() - started, labels)
+
+def device_id_from_topic(topic):
+    """Extract the device ID from a device or telemetry topic"""
+    parts = topic[len(TOPIC_PREFIX):].split("/")
+    return parts[1] if len(parts) > 1 else ""
+
+def route_message(topic, data):
+    """Process a decoded message based on its topic"""
+    if topic.startswith(DEVICE_TOPIC):
+        process_device_message(topic, data)
+    elif topic.startswith(TELEMETRY_TOPIC):
+        process_telemetry_message(topic, data)
 
 def process_device_message(topic, payload):
     """Process device status messages"""
     try:
         # Extract device ID from topic
         device_id = topic.replace(DEVICE_TOPIC, "").split("/")[0]
-        data = json.loads(payload)
+        data = json.loads(payload) if isinstance(payload, (str, bytes)) else payload
 
         # Import here to avoid circular imports
         from app.models.device import Device
+        from app.iot.device_registry import device_registry
         from app import db
 
         # Find the device
-        device = Device.query.filter_by(device_id=device_id).first()
+        device = device_registry.get(device_id)
         if not device:
             logger.warning(f"Received message for unknown device: {device_id}")
             return
 
         # Update device status
+        changes = {"last_updated": datetime.utcnow()}
+
         if "status" in data:
-            device.status = data["status"]
+            changes["status"] = data["status"]
 
         if "power_state" in data:
-            device.power_state = data["power_state"]
+            changes["power_state"] = data["power_state"]
 
         if "firmware_version" in data:
-            device.firmware_version = data["firmware_version"]
+            changes["firmware_version"] = data["firmware_version"]
 
-        device.last_updated = datetime.utcnow()
+        db.session.execute(update(Device).where(Device.id == device.id).values(**changes))
         db.session.commit()
 
         logger.info(f"Updated device {device_id} status: {data}")
 
+        from app.africastalking.snapshots import ussd_snapshots
+        ussd_snapshots.apply([dict(changes, id=device.id)])
+
+        # Push the change to the owner's live dashboards
+        from app.iot.events import EVENT_DEVICE, publish_event
+        publish_event(device.user_id, EVENT_DEVICE, dict(changes, id=device.id))
+
+        # Confirm any control command this report acknowledges
+        from app.iot import commands
+        if commands.command_tracker:
+            commands.command_tracker.acknowledge(device_id, data)
+
         # Check if we need to send notifications for this status change
         if "status" in data and data["status"] == "error":
             send_device_error_notification(device)
@@ -132,61 +241,41 @@ def process_telemetry_message(topic, payload):
     try:
         # Extract device ID from topic
         device_id = topic.replace(TELEMETRY_TOPIC, "").split("/")[0]
-        data = json.loads(payload)
+        data = json.loads(payload) if isinstance(payload, (str, bytes)) else payload
 
         # Import here to avoid circular imports
-        from app.models.device import Device
-        from app.models.power_usage import PowerReading
-        from app import db
+        from app.iot import ingest
 
-        # Find the device
-        device = Device.query.filter_by(device_id=device_id).first()
-        if not device:
-            logger.warning(f"Received telemetry for unknown device: {device_id}")
+        sample = ingest.build_sample(device_id, data)
+        if not sample:
             return
 
-        # Update current power in device record
-        if "power" in data:
-            device.current_power = float(data["power"])
-            device.last_updated = datetime.utcnow()
-            db.session.commit()
-
-        # Create power reading record
-        if all(k in data for k in ["power", "voltage", "current"]):
-            power_reading = PowerReading(
-                device_id=device.id,
-                power_usage=float(data["power"]),
-                voltage=float(data["voltage"]),
-                current=float(data["current"]),
-                power_factor=float(data.get("power_factor", 0.0)),
-                energy_consumed=float(data.get("energy", 0.0))
-            )
-            db.session.add(power_reading)
-            db.session.commit()
-
-            logger.debug(f"Recorded power reading for {device_id}: {data['power']}W")
-
-            # Check for power thresholds and send alerts if needed
-            check_power_thresholds(device, float(data["power"]))
+        # Hand the sample to the batching ingestor, or write it directly
+        # when the ingestor is not running
+        if ingest.telemetry_ingestor:
+            ingest.telemetry_ingestor.submit(sample)
+        else:
+            ingest.write_telemetry_batch([sample])
 
     except Exception as e:
         logger.error(f"Error processing telemetry message: {str(e)}")
 
-def send_device_control(device_id, command, value=None):
+def publish_device_control(device_id, command, value=None, cid=None):
     """
-    Send control command to a device
+    Publish a control command to a device without waiting for the broker
 
     Args:
         device_id (str): Device ID
         command (str): Command name (e.g., 'power', 'reset')
         value: Command value
+        cid (str): Correlation ID the device echoes back in its status report
 
     Returns:
-        bool: Success or failure
+        MQTTMessageInfo: Publish handle, or None if publishing failed
     """
     if not mqtt_client:
         logger.error("MQTT client not initialized")
-        return False
+        return None
 
     topic = f"{CONTROL_TOPIC}{device_id}"
     payload = {"command": command}
@@ -194,83 +283,121 @@ def send_device_control(device_id, command, value=None):
     if value is not None:
         payload["value"] = value
 
+    if cid:
+        payload["cid"] = cid
+
     try:
-        mqtt_client.publish(topic, json.dumps(payload), qos=1)
+        info = mqtt_client.publish(topic, json.dumps(payload), qos=1)
         logger.info(f"Sent command {command} to device {device_id}")
-        return True
+        return info
     except Exception as e:
         logger.error(f"Failed to send command to device: {str(e)}")
-        return False
+        return None
+
+def send_device_control(device_id, command, value=None):
+    """
+    Send control command to a device
+
+    Args:
+        device_id (str): Device ID
+        command (str): Command name (e.g., 'power', 'reset')
+        value: Command value
+
+    Returns:
+        bool: Success or failure
+    """
+    from app.iot import commands
+
+    # Track the acknowledgement when the tracker is running
+    if commands.command_tracker:
+        return commands.command_tracker.send(device_id, command, value) is not None
+    return publish_device_control(device_id, command, value) is not None
+
+def send_device_controls(commands, max_in_flight=None, timeout=None):
+    """
+    Send control commands to many devices in one pass
+
+    At most max_in_flight commands are left unacknowledged by the broker at
+    a time, so a farm-wide command does not flood it.
+
+    Args:
+        commands (list): (device_id, command, value, previous_state) tuples
+        max_in_flight (int): Maximum unacknowledged publishes
+        timeout (float): Seconds to wait for the broker to accept each window
+
+    Returns:
+        dict: device_id -> (error message or None, PendingCommand or None)
+    """
+    from app.iot import commands as command_tracking
+
+    config = current_app.config
+    max_in_flight = max_in_flight or config.get('MQTT_CONTROL_MAX_IN_FLIGHT', 50)
+    timeout = timeout if timeout is not None else config.get('MQTT_CONTROL_PUBLISH_TIMEOUT', 5.0)
+    tracker = command_tracking.command_tracker
+
+    results = {}
+    for start in range(0, len(commands), max_in_flight):
+        window = []
+        for device_id, command, value, previous_state in commands[start:start + max_in_flight]:
+            pending = None
+            if tracker:
+                pending = tracker.send(device_id, command, value, previous_state)
+                info = pending.info if pending else None
+            else:
+                info = publish_device_control(device_id, command, value)
+
+            if info is None or info.rc != mqtt.MQTT_ERR_SUCCESS:
+                results[device_id] = ("Failed to send command to device", None)
+            else:
+                window.append((device_id, info, pending))
+
+        # Wait for the broker before publishing the next window
+        for device_id, info, pending in window:
+            try:
+                info.wait_for_publish(timeout)
+            except (RuntimeError, ValueError) as e:
+                results[device_id] = (f"Failed to send command to device: {str(e)}", None)
+                continue
+            error = None if info.is_published() else "Timed out waiting for broker"
+            results[device_id] = (error, pending)
+
+    return results
 
 def check_power_thresholds(device, power_usage):
-    """Check if power usage exceeds thresholds and send alerts if needed"""
-    from app.models.user import User
-    from app.models.notification import Notification, NotificationSetting
-    from app import db
+    """
+    Check if power usage exceeds thresholds and queue alerts if needed
 
-    # Get warning and critical thresholds
-    notification_setting = NotificationSetting.query.filter_by(user_id=device.user_id).first()
+    Deduplication, cooldowns and escalation are handled in memory by the
+    alert engine, which writes notifications and sends SMS in the background.
+    """
+    from app.iot.alerts import get_alert_engine
+    from app.iot.user_settings import settings_cache
+
+    # Thresholds and delivery preferences come from the settings cache
+    settings = settings_cache.get(device.user_id)
+    configured = bool(settings and settings.has_settings)
 
     # Use default thresholds if not set
-    warning_threshold = notification_setting.power_threshold_warning if notification_setting else current_app.config.get('POWER_WARNING_THRESHOLD')
-    critical_threshold = notification_setting.power_threshold_critical if notification_setting else current_app.config.get('POWER_CRITICAL_THRESHOLD')
-
-    # Check if power usage exceeds critical threshold
-    if power_usage > critical_threshold:
-        # Create critical notification
-        notification = Notification(
-            title=f"Critical Power Usage: {device.name}",
-            message=f"Device '{device.name}' is consuming {power_usage:.2f}W, which exceeds the critical threshold of {critical_threshold:.2f}W.",
-            notification_type="alert",
-            user_id=device.user_id,
-            device_id=device.id,
-            send_sms=True if notification_setting and notification_setting.receive_sms else False,
-            send_email=True if notification_setting and notification_setting.receive_email else False
-        )
-        db.session.add(notification)
-        db.session.commit()
+    warning_threshold = settings.power_threshold_warning if configured else current_app.config.get('POWER_WARNING_THRESHOLD')
+    critical_threshold = settings.power_threshold_critical if configured else current_app.config.get('POWER_CRITICAL_THRESHOLD')
+
+    engine, flush = get_alert_engine()
+    alerts = engine.check(
+        device,
+        power_usage,
+        warning_threshold,
+        critical_threshold,
+        send_sms=configured and bool(settings.receive_sms),
+        send_email=configured and bool(settings.receive_email)
+    )
 
-        # Send SMS if enabled
-        if notification.send_sms:
-            from app.africastalking.sms import get_sms_service
-            user = User.query.get(device.user_id)
-            if user:
-                sms_service = get_sms_service()
-                sms_service.send_power_alert(user.phone_number, device.name, power_usage, critical_threshold)
-
-                # Update notification status
-                notification.sms_sent = True
-                db.session.commit()
-
-    # Check if power usage exceeds warning threshold but is below critical
-    elif power_usage > warning_threshold:
-        # Check if we already sent a warning recently (in the last hour)
-        from datetime import timedelta
-        recent_warning = Notification.query.filter_by(
-            device_id=device.id,
-            notification_type="warning"
-        ).filter(
-            Notification.timestamp > datetime.utcnow() - timedelta(hours=1)
-        ).first()
-
-        if not recent_warning:
-            # Create warning notification
-            notification = Notification(
-                title=f"High Power Usage: {device.name}",
-                message=f"Device '{device.name}' is consuming {power_usage:.2f}W, which exceeds the warning threshold of {warning_threshold:.2f}W.",
-                notification_type="warning",
-                user_id=device.user_id,
-                device_id=device.id,
-                send_sms=False,  # Only send SMS for critical alerts
-                send_email=True if notification_setting and notification_setting.receive_email else False
-            )
-            db.session.add(notification)
-            db.session.commit()
+    if alerts and flush:
+        engine.flush()
 
 def send_device_error_notification(device):
-    """Send notification for device error"""
-    from app.models.user import User
-    from app.models.notification import Notification, NotificationSetting
+    """Send notification for device error, its SMS goes out with the user's next digest"""
+    from app.models.notification import Notification
+    from app.iot.events import EVENT_NOTIFICATION, notification_event, publish_event
     from app import db
 
     # Create error notification
@@ -284,18 +411,8 @@ def send_device_error_notification(device):
         send_email=True
     )
     db.session.add(notification)
+    db.session.flush()
+    event = notification_event(notification)
     db.session.commit()
 
-    # Send SMS
-    from app.africastalking.sms import get_sms_service
-    user = User.query.get(device.user_id)
-    if user:
-        sms_service = get_sms_service()
-        sms_service.send_message(
-            [user.phone_number],
-            f"ALERT: Your device '{device.name}' has reported an error. Please check your system."
-        )
-
-        # Update notification status
-        notification.sms_sent = True
-        db.session.commit()
\ No newline at end of file
+    publish_event(device.user_id, EVENT_NOTIFICATION, {"notifications": [event]})
\ No newline at end of file
@@ -0,0 +1,331 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import logging
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import case, func, or_
+
+from app import db
+from app.models.power_usage import PowerReading, PowerReadingRollup
+
+logger = logging.getLogger(__name__)
+
+# Rollup tiers (bucket size in seconds)
+ROLLUP_MINUTE = 60
+ROLLUP_HOUR = 3600
+ROLLUP_RESOLUTIONS = (ROLLUP_MINUTE, ROLLUP_HOUR)
+
+EPOCH = datetime(1970, 1, 1)
+
+class Aggregate:
+    """In-memory aggregate with the same fields as PowerReadingRollup"""
+
+    def __init__(self):
+        self.sample_count = 0
+        self.power_sum = 0.0
+        self.power_min = None
+        self.power_max = None
+        self.energy = 0.0
+        self.first_timestamp = None
+        self.first_power = None
+        self.last_timestamp = None
+        self.last_power = None
+
+def bucket_start(timestamp, resolution):
+    """Get the start of the bucket containing a timestamp"""
+    seconds = int((timestamp - EPOCH).total_seconds()) // resolution * resolution
+    return EPOCH + timedelta(seconds=seconds)
+
+def energy_between(start_time, start_power, end_time, end_power):
+    """Trapezoidal energy in kWh between two samples"""
+    # Time difference in hours
+    time_diff = (end_time - start_time).total_seconds() / 3600
+    # Energy in kWh = average power (W) * time (h) / 1000
+    return ((start_power + end_power) / 2) * time_diff / 1000
+
+def reset_aggregate(aggregate):
+    """Clear an aggregate or rollup before recomputing it"""
+    aggregate.sample_count = 0
+    aggregate.power_sum = 0.0
+    aggregate.power_min = None
+    aggregate.power_max = None
+    aggregate.energy = 0.0
+    aggregate.first_timestamp = None
+    aggregate.first_power = None
+    aggregate.last_timestamp = None
+    aggregate.last_power = None
+
+def apply_sample(aggregate, timestamp, power):
+    """Add a sample that is not older than the aggregate's last sample"""
+    if not aggregate.sample_count:
+        aggregate.first_timestamp = timestamp
+        aggregate.first_power = power
+        aggregate.power_min = power
+        aggregate.power_max = power
+    else:
+        aggregate.energy += energy_between(aggregate.last_timestamp, aggregate.last_power, timestamp, power)
+        aggregate.power_min = min(aggregate.power_min, power)
+        aggregate.power_max = max(aggregate.power_max, power)
+
+    aggregate.last_timestamp = timestamp
+    aggregate.last_power = power
+    aggregate.sample_count += 1
+    aggregate.power_sum += power
+
+def merge_aggregate(total, segment):
+    """Append a later segment to a running aggregate, integrating across the gap"""
+    if not segment.sample_count:
+        return total
+
+    if not total.sample_count:
+        total.first_timestamp = segment.first_timestamp
+        total.first_power = segment.first_power
+        total.power_min = segment.power_min
+        total.power_max = segment.power_max
+    else:
+        total.energy += energy_between(total.last_timestamp, total.last_power,
+                                       segment.first_timestamp, segment.first_power)
+        total.power_min = min(total.power_min, segment.power_min)
+        total.power_max = max(total.power_max, segment.power_max)
+
+    total.energy += segment.energy
+    total.last_timestamp = segment.last_timestamp
+    total.last_power = segment.last_power
+    total.sample_count += segment.sample_count
+    total.power_sum += segment.power_sum
+    return total
+
+def rebuild_bucket(rollup):
+    """Recompute a rollup bucket from its raw readings"""
+    end = rollup.bucket_start + timedelta(seconds=rollup.resolution)
+    readings = db.session.query(PowerReading.timestamp, PowerReading.power_usage).filter(
+        PowerReading.device_id == rollup.device_id,
+        PowerReading.timestamp >= rollup.bucket_start,
+        PowerReading.timestamp < end
+    ).order_by(PowerReading.timestamp)
+
+    reset_aggregate(rollup)
+    for timestamp, power in readings:
+        apply_sample(rollup, timestamp, power)
+
+def upsert_statement():
+    """
+    Build the INSERT that merges a segment of samples into its rollup bucket
+
+    Conflicts on uq_rollup_bucket are resolved in the database: counts and
+    sums are added, min/max combined, and the first/last samples kept from
+    whichever side is earlier/later. The segment's energy, including the
+    join to the bucket's last sample as read beforehand, is added.
+
+    Returns:
+        Insert: Statement executed with one row per bucket
+    """
+    table = PowerReadingRollup.__table__
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect in ('mysql', 'mariadb'):
+        from sqlalchemy.dialects.mysql import insert
+    else:
+        raise NotImplementedError(f"Rollup upserts are not supported on {dialect}")
+
+    stmt = insert(table)
+    new = stmt.inserted if dialect in ('mysql', 'mariadb') else stmt.excluded
+    c = table.c
+
+    # SQLite's two-argument min()/max() are the scalar LEAST/GREATEST
+    least, greatest = (func.min, func.max) if dialect == 'sqlite' else (func.least, func.greatest)
+    earlier = or_(c.first_timestamp.is_(None), new.first_timestamp < c.first_timestamp)
+    later = or_(c.last_timestamp.is_(None), new.last_timestamp >= c.last_timestamp)
+
+    # MySQL applies these in order and later ones see earlier results, so
+    # timestamps are compared before they are replaced
+    values = [
+        ('energy', c.energy + new.energy),
+        ('power_min', least(func.coalesce(c.power_min, new.power_min), new.power_min)),
+        ('power_max', greatest(func.coalesce(c.power_max, new.power_max), new.power_max)),
+        ('first_power', case((earlier, new.first_power), else_=c.first_power)),
+        ('first_timestamp', case((earlier, new.first_timestamp), else_=c.first_timestamp)),
+        ('last_power', case((later, new.last_power), else_=c.last_power)),
+        ('last_timestamp', case((later, new.last_timestamp), else_=c.last_timestamp)),
+        ('sample_count', c.sample_count + new.sample_count),
+        ('power_sum', c.power_sum + new.power_sum),
+    ]
+
+    if dialect in ('mysql', 'mariadb'):
+        return stmt.on_duplicate_key_update(values)
+    return stmt.on_conflict_do_update(
+        index_elements=['device_id', 'resolution', 'bucket_start'],
+        set_=dict(values)
+    )
+
+def load_buckets(resolution, keys):
+    """
+    Read the sample count and last sample of existing rollup buckets
+
+    Args:
+        resolution (int): Bucket size in seconds
+        keys (iterable): (device_id, bucket_start) pairs
+
+    Returns:
+        dict: (device_id, bucket_start) to (sample_count, last_timestamp, last_power)
+    """
+    keys = set(keys)
+    rows = db.session.query(
+        PowerReadingRollup.device_id, PowerReadingRollup.bucket_start, PowerReadingRollup.sample_count,
+        PowerReadingRollup.last_timestamp, PowerReadingRollup.last_power
+    ).filter(
+        PowerReadingRollup.resolution == resolution,
+        PowerReadingRollup.device_id.in_({device_id for device_id, _ in keys}),
+        PowerReadingRollup.bucket_start.in_({start for _, start in keys})
+    )
+    return {(row[0], row[1]): tuple(row[2:]) for row in rows if (row[0], row[1]) in keys}
+
+def update_rollups(samples, resolutions=ROLLUP_RESOLUTIONS):
+    """
+    Fold newly inserted power readings into the rollup tables
+
+    The samples of each bucket are aggregated in memory and merged into the
+    bucket with one upsert per tier, so concurrent writers never lose each
+    other's counts or fail on the bucket's unique constraint. A bucket is
+    rebuilt from raw readings when a sample is older than its last one, or
+    when another writer changed it between the read and the upsert (its
+    sample count is not what this merge expects). The readings must
+    therefore be written in the same transaction before calling this. The
+    caller commits.
+
+    Args:
+        samples (list): (device_id, timestamp, power) tuples, device_id being the primary key
+        resolutions (tuple): Bucket sizes in seconds to maintain
+    """
+    samples = sorted(samples, key=lambda sample: sample[1])
+    if not samples:
+        return
+
+    statement = upsert_statement()
+
+    for resolution in resolutions:
+        segments = OrderedDict()
+        for device_id, timestamp, power in samples:
+            key = (device_id, bucket_start(timestamp, resolution))
+            if key not in segments:
+                segments[key] = Aggregate()
+            apply_sample(segments[key], timestamp, power)
+
+        existing = load_buckets(resolution, segments)
+        stale = set()
+        rows = []
+        expected = {}
+
+        for key, segment in segments.items():
+            count, last_timestamp, last_power = existing.get(key, (0, None, None))
+            if count and segment.first_timestamp < last_timestamp:
+                stale.add(key)
+                continue
+
+            energy = segment.energy
+            if count:
+                energy += energy_between(last_timestamp, last_power, segment.first_timestamp, segment.first_power)
+
+            rows.append({
+                "device_id": key[0],
+                "resolution": resolution,
+                "bucket_start": key[1],
+                "sample_count": segment.sample_count,
+                "power_sum": segment.power_sum,
+                "power_min": segment.power_min,
+                "power_max": segment.power_max,
+                "energy": energy,
+                "first_timestamp": segment.first_timestamp,
+                "first_power": segment.first_power,
+                "last_timestamp": segment.last_timestamp,
+                "last_power": segment.last_power
+            })
+            expected[key] = count + segment.sample_count
+
+        if rows:
+            db.session.execute(statement, rows)
+            for key, (count, _, _) in load_buckets(resolution, expected).items():
+                if count != expected[key]:
+                    stale.add(key)
+
+        if stale:
+            rebuild_buckets(resolution, stale)
+
+def rebuild_buckets(resolution, keys):
+    """Lock rollup buckets and recompute them from their raw readings"""
+    for device_id, start in keys:
+        rollup = PowerReadingRollup.query.filter_by(
+            device_id=device_id, resolution=resolution, bucket_start=start
+        ).with_for_update().populate_existing().one()
+        rebuild_bucket(rollup)
+
+def rebuild_rollups(start_time, end_time, device_id=None):
+    """
+    Recompute rollups from raw readings, e.g. to backfill existing data
+
+    Args:
+        start_time (datetime): Start of the range, rounded down to the hour
+        end_time (datetime): End of the range, rounded up to the hour
+        device_id (int): Optional device ID in database
+
+    Returns:
+        int: Number of readings processed
+    """
+    start_time = bucket_start(start_time, ROLLUP_HOUR)
+    end_time = bucket_start(end_time, ROLLUP_HOUR) + timedelta(seconds=ROLLUP_HOUR)
+
+    delete = PowerReadingRollup.query.filter(
+        PowerReadingRollup.bucket_start >= start_time,
+        PowerReadingRollup.bucket_start < end_time
+    )
+    readings = db.session.query(
+        PowerReading.device_id, PowerReading.timestamp, PowerReading.power_usage
+    ).filter(
+        PowerReading.timestamp >= start_time,
+        PowerReading.timestamp < end_time
+    )
+    if device_id:
+        delete = delete.filter(PowerReadingRollup.device_id == device_id)
+        readings = readings.filter(PowerReading.device_id == device_id)
+
+    delete.delete(synchronize_session=False)
+
+    # Stream readings and fold them in chunks to keep memory flat
+    count = 0
+    chunk = []
+    for row in readings.order_by(PowerReading.device_id, PowerReading.timestamp).yield_per(5000):
+        chunk.append(tuple(row))
+        if len(chunk) >= 5000:
+            update_rollups(chunk)
+            db.session.flush()
+            count += len(chunk)
+            chunk = []
+
+    if chunk:
+        update_rollups(chunk)
+        count += len(chunk)
+
+    db.session.commit()
+    return count
+
+@click.command('rebuild-rollups')
+@click.option('--days', default=30, show_default=True, help='Days of readings to roll up, ending now')
+@click.option('--device', 'device_id', type=int, help='Only this device (primary key)')
+@with_appcontext
+def rebuild_rollups_command(days, device_id):
+    """Backfill rollups from raw readings, one day per transaction"""
+    end = datetime.utcnow()
+    day = bucket_start(end - timedelta(days=days), ROLLUP_HOUR)
+    total = 0
+
+    while day <= end:
+        # rebuild_rollups rounds the end up to the next hour, so this covers exactly one day
+        total += rebuild_rollups(day, day + timedelta(hours=23), device_id)
+        day += timedelta(days=1)
+
+    click.echo(f"Rolled up {total} readings")
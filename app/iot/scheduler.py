@@ -0,0 +1,482 @@
+import atexit
+import heapq
+import itertools
+import threading
+import time
+import logging
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, update
+
+logger = logging.getLogger(__name__)
+
+# Global schedule runner
+schedule_runner = None
+
+# A schedule starts its window at start_time and ends it at end_time
+EDGE_START = 'start'
+EDGE_END = 'end'
+
+# Power state applied by each action at the start of the window; the end of
+# the window applies the opposite. None means toggle.
+ACTION_POWER_STATES = {
+    'turn_on': True,
+    'turn_off': False,
+    'toggle': None
+}
+
+# In-memory copy of the fields needed to compute fire times and dispatch
+ScheduleSpec = namedtuple('ScheduleSpec', [
+    'id',
+    'device_pk',        # Device primary key
+    'device_id',        # IoT device identifier (string)
+    'start_time',
+    'end_time',
+    'days',             # frozenset of weekdays (0=Monday), empty for every day
+    'one_time_date',    # date for one-time schedules, otherwise None
+    'action',
+    'version',          # Schedule.updated_at when the spec was loaded
+    'location',         # Device location, for weather conditions
+    'condition'         # Compiled condition predicate, None if unconditional
+], defaults=(None, None))
+
+def parse_days(days_of_week):
+    """
+    Parse a days_of_week string such as '0,2,4'
+
+    Returns:
+        frozenset: Weekday numbers (0=Monday), empty for every day
+    """
+    if not days_of_week:
+        return frozenset()
+    return frozenset(int(day) for day in days_of_week.split(',') if day.strip().isdigit())
+
+def spec_from_schedule(schedule, device_id, location=None):
+    """Build a ScheduleSpec from a Schedule row and its device's IoT ID and location"""
+    from app.iot.conditions import condition_for
+
+    return ScheduleSpec(
+        id=schedule.id,
+        device_pk=schedule.device_id,
+        device_id=device_id,
+        start_time=schedule.start_time,
+        end_time=schedule.end_time,
+        days=parse_days(schedule.days_of_week),
+        one_time_date=schedule.one_time_date if schedule.is_one_time else None,
+        action=schedule.action,
+        version=schedule.updated_at,
+        location=location,
+        condition=condition_for(schedule)
+    )
+
+def runs_on(spec, day):
+    """Check whether a schedule's window starts on the given date"""
+    if spec.one_time_date:
+        return day == spec.one_time_date
+    return not spec.days or day.weekday() in spec.days
+
+def next_fire(spec, after):
+    """
+    Find the next start or end of a schedule's window strictly after a time
+
+    A window whose end_time is earlier than its start_time ends the next
+    day. A window whose end_time equals its start_time only has a start.
+
+    Args:
+        spec (ScheduleSpec): Schedule
+        after (datetime): Reference time (UTC)
+
+    Returns:
+        tuple: (fire_at, edge), or None if the schedule never fires again
+    """
+    if spec.one_time_date:
+        days = [spec.one_time_date]
+    else:
+        # Start from yesterday to catch windows that run past midnight
+        days = [after.date() + timedelta(days=offset) for offset in range(-1, 8)]
+
+    best = None
+    for day in days:
+        if not runs_on(spec, day):
+            continue
+
+        start = datetime.combine(day, spec.start_time)
+        candidates = [(start, EDGE_START)]
+        if spec.end_time != spec.start_time:
+            end = datetime.combine(day, spec.end_time)
+            if end < start:
+                end += timedelta(days=1)
+            candidates.append((end, EDGE_END))
+
+        for fire_at, edge in candidates:
+            if fire_at > after and (best is None or fire_at < best[0]):
+                best = (fire_at, edge)
+
+    return best
+
+def power_state_for(action, edge, current_state):
+    """
+    Get the power state a schedule applies at one edge of its window
+
+    Args:
+        action (str): 'turn_on', 'turn_off' or 'toggle'
+        edge (str): EDGE_START or EDGE_END
+        current_state (bool): Current power state of the device
+
+    Returns:
+        bool: Power state to apply
+    """
+    state = ACTION_POWER_STATES[action]
+    if state is None:
+        return not current_state
+    return state if edge == EDGE_START else not state
+
+class ScheduleRunner:
+    """
+    Fires device schedules from a min-heap of next fire times
+
+    Every runner fires every active schedule, so only one process may run
+    it (SCHEDULER_ENABLED).
+    """
+
+    def __init__(self, app, poll_interval=30.0, batch_size=100, flush_interval=5.0):
+        """
+        Args:
+            app (Flask): Application used for the runner thread's app context
+            poll_interval (float): Seconds between checks for changed schedules
+            batch_size (int): Write execution records once this many are pending
+            flush_interval (float): Maximum seconds an execution record waits to be written
+        """
+        self.app = app
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # Heap of (fire_at, seq, schedule_id, version, edge). Entries whose
+        # version no longer matches the loaded spec are stale and skipped.
+        self._heap = []
+        self._seq = itertools.count()
+        self._specs = {}
+        self._last_sync = None
+
+        self._pending_executions = []
+        self._pending_states = {}
+        self._last_flush = time.monotonic()
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self.fired = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def start(self):
+        """Load active schedules and start the runner thread"""
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="schedule-runner", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Stop the runner thread and write pending execution records"""
+        self._stop_event.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        with self.app.app_context():
+            self.flush()
+
+    def wake(self):
+        """Ask the runner to check for changed schedules now"""
+        self._wake.set()
+
+    def stats(self):
+        """Get runner counters"""
+        with self._lock:
+            return {
+                "schedules": len(self._specs),
+                "heap_size": len(self._heap),
+                "fired": self.fired,
+                "succeeded": self.succeeded,
+                "failed": self.failed,
+                "skipped": self.skipped,
+                "pending_executions": len(self._pending_executions)
+            }
+
+    def next_fire_time(self):
+        """Get the earliest pending fire time, or None"""
+        while self._heap:
+            fire_at, _, schedule_id, version, _ = self._heap[0]
+            spec = self._specs.get(schedule_id)
+            if spec and spec.version == version:
+                return fire_at
+            heapq.heappop(self._heap)
+        return None
+
+    def sync(self, now=None):
+        """
+        Load schedules changed since the last sync
+
+        The first call loads every active schedule. Later calls only read
+        rows whose updated_at moved, using the updated_at index.
+
+        Args:
+            now (datetime): Reference time for next fire computation
+        """
+        from app.models.schedule import Schedule
+        from app.models.device import Device
+        from app import db
+
+        now = now or datetime.utcnow()
+        query = db.session.query(Schedule, Device.device_id, Device.location).join(Device, Schedule.device_id == Device.id)
+
+        if self._last_sync is None:
+            query = query.filter(Schedule.is_active == True)
+        else:
+            query = query.filter(Schedule.updated_at >= self._last_sync)
+
+        latest = self._last_sync
+        for schedule, device_id, location in query.yield_per(1000):
+            self._load(schedule, device_id, location, now)
+            if schedule.updated_at and (latest is None or schedule.updated_at > latest):
+                latest = schedule.updated_at
+
+        self._last_sync = latest or now
+
+    def run_due(self, now=None):
+        """
+        Fire every schedule edge that is due
+
+        Args:
+            now (datetime): Current time (UTC)
+
+        Returns:
+            int: Number of edges fired
+        """
+        now = now or datetime.utcnow()
+        fired = 0
+
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, _, schedule_id, version, edge = heapq.heappop(self._heap)
+            spec = self._specs.get(schedule_id)
+            if not spec or spec.version != version:
+                continue
+
+            if self._fire(spec, edge, fire_at, now):
+                fired += 1
+                # Queue the following edge from this fire time so a late
+                # wakeup does not skip the rest of the window
+                self._push(spec, fire_at)
+
+        return fired
+
+    def flush(self):
+        """Write pending execution records and device power states"""
+        from app.models.schedule import ScheduleExecution
+        from app.models.device import Device
+        from app.africastalking.snapshots import ussd_snapshots
+        from app import db
+
+        with self._lock:
+            executions, self._pending_executions = self._pending_executions, []
+            states, self._pending_states = self._pending_states, {}
+        self._last_flush = time.monotonic()
+
+        if not executions and not states:
+            return
+
+        try:
+            if executions:
+                db.session.execute(insert(ScheduleExecution), executions)
+
+            # One UPDATE per target state rather than one per device
+            now = datetime.utcnow()
+            for state in (True, False):
+                device_pks = [pk for pk, value in states.items() if value == state]
+                if device_pks:
+                    db.session.execute(
+                        update(Device).where(Device.id.in_(device_pks)).values(power_state=state, last_updated=now)
+                    )
+
+            db.session.commit()
+            ussd_snapshots.apply({"id": pk, "power_state": value, "last_updated": now} for pk, value in states.items())
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error writing schedule executions: {str(e)}")
+
+    def _load(self, schedule, device_id, location, now):
+        """Replace the in-memory spec for a schedule and queue its next fire"""
+        with self._lock:
+            if not schedule.is_active:
+                # Stale heap entries are skipped when popped
+                self._specs.pop(schedule.id, None)
+                return
+
+            current = self._specs.get(schedule.id)
+            if current and current.version == schedule.updated_at:
+                return
+
+            spec = spec_from_schedule(schedule, device_id, location)
+            self._specs[schedule.id] = spec
+        self._push(spec, now)
+
+    def _reload(self, schedule_id, now):
+        """Reload a single schedule by primary key"""
+        from app.models.schedule import Schedule
+        from app.models.device import Device
+        from app import db
+
+        row = db.session.query(Schedule, Device.device_id, Device.location).join(Device, Schedule.device_id == Device.id) \
+            .filter(Schedule.id == schedule_id).first()
+        if row:
+            self._load(row[0], row[1], row[2], now)
+        else:
+            with self._lock:
+                self._specs.pop(schedule_id, None)
+
+    def _push(self, spec, after):
+        fire = next_fire(spec, after)
+        with self._lock:
+            if fire is None:
+                self._specs.pop(spec.id, None)
+                return
+            heapq.heappush(self._heap, (fire[0], next(self._seq), spec.id, spec.version, fire[1]))
+
+    def _fire(self, spec, edge, fire_at, now):
+        """
+        Send the power command for one edge and record the execution
+
+        The schedule is re-read by primary key first, so a schedule deleted,
+        disabled or edited since the last sync is not fired from a stale spec.
+
+        Returns:
+            bool: True if the edge was handled, False if the spec was stale
+        """
+        from app.models.schedule import Schedule
+        from app.models.device import Device
+        from app.iot.mqtt_client import send_device_control
+        from app.iot.conditions import device_state_store, evaluate
+        from app import db
+
+        row = db.session.query(Schedule.is_active, Schedule.updated_at, Device.power_state,
+                               Device.current_power, Device.last_updated) \
+            .join(Device, Schedule.device_id == Device.id) \
+            .filter(Schedule.id == spec.id).first()
+
+        if not row or not row.is_active:
+            with self._lock:
+                self._specs.pop(spec.id, None)
+            return False
+
+        if row.updated_at != spec.version:
+            # Edited since the last sync: reload it, the new spec's edge may still be due now
+            self._reload(spec.id, fire_at - timedelta(microseconds=1))
+            return False
+
+        if spec.condition:
+            # Telemetry may be ingested by another process, the device row
+            # then holds the latest power this process has not seen
+            if row.last_updated and row.current_power is not None:
+                device_state_store.update(spec.device_pk, row.current_power, row.last_updated)
+
+            met, reason = evaluate(spec.condition, spec.device_pk, spec.location, fire_at)
+            if not met:
+                self._record(spec, 'skipped', f"{spec.action} ({edge}): condition not met, {reason}", now)
+                return True
+
+        with self._lock:
+            current_state = self._pending_states.get(spec.device_pk, bool(row.power_state))
+
+        state = power_state_for(spec.action, edge, current_state)
+
+        if send_device_control(spec.device_id, 'power', state):
+            status = 'success'
+            message = f"{spec.action} ({edge}): power {'on' if state else 'off'} sent to {spec.device_id}"
+        else:
+            status = 'failed'
+            message = f"{spec.action} ({edge}): failed to send command to {spec.device_id}"
+
+        self._record(spec, status, message, now, state if status == 'success' else None)
+        return True
+
+    def _record(self, spec, status, message, now, state=None):
+        with self._lock:
+            self.fired += 1
+            if status == 'success':
+                self.succeeded += 1
+            elif status == 'failed':
+                self.failed += 1
+            else:
+                self.skipped += 1
+
+            self._pending_executions.append({
+                'schedule_id': spec.id,
+                'execution_time': now,
+                'status': status,
+                'result_message': message
+            })
+            if state is not None:
+                self._pending_states[spec.device_pk] = state
+            pending = len(self._pending_executions)
+
+        if pending >= self.batch_size:
+            self.flush()
+
+    def _run(self):
+        """Runner loop: sync changes, fire due edges, flush records, then sleep until the next event"""
+        from app import db
+
+        next_sync = 0
+        while not self._stop_event.is_set():
+            with self.app.app_context():
+                try:
+                    if time.monotonic() >= next_sync:
+                        self.sync()
+                        next_sync = time.monotonic() + self.poll_interval
+
+                    self.run_due()
+
+                    if time.monotonic() - self._last_flush >= self.flush_interval:
+                        self.flush()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Schedule runner error: {str(e)}")
+                finally:
+                    db.session.remove()
+
+            timeout = min(next_sync - time.monotonic(), self.flush_interval)
+            fire_at = self.next_fire_time()
+            if fire_at:
+                timeout = min(timeout, (fire_at - datetime.utcnow()).total_seconds())
+
+            self._wake.wait(max(timeout, 0.05))
+            if self._wake.is_set():
+                self._wake.clear()
+                next_sync = 0
+
+def setup_schedule_runner(app):
+    """Initialize and start the global schedule runner"""
+    global schedule_runner
+
+    if schedule_runner:
+        return schedule_runner
+
+    schedule_runner = ScheduleRunner(
+        app,
+        poll_interval=app.config.get('SCHEDULER_POLL_INTERVAL', 30.0),
+        batch_size=app.config.get('SCHEDULER_BATCH_SIZE', 100),
+        flush_interval=app.config.get('SCHEDULER_FLUSH_INTERVAL', 5.0)
+    )
+    schedule_runner.start()
+
+    # Write out pending execution records when the process exits
+    atexit.register(schedule_runner.stop)
+
+    return schedule_runner
@@ -1,13 +1,22 @@
 import json
-from datetime import datetime, timedelta
-from sqlalchemy import func, desc
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from sqlalchemy import func, desc, insert, literal_column, select, update
 from flask import current_app
 import logging
+import numpy as np
 
 from app import db
-from app.models.power_usage import PowerReading, PowerSummary, EnergyRate
+from app.models.power_usage import PowerReading, PowerReadingRollup, PowerSummary, EnergyRate
 from app.models.device import Device
 from app.models.notification import Notification
+from app.iot.device_registry import device_registry
+from app.iot.conditions import device_state_store
+from app.iot.analytics import epoch_seconds, fetch_array, grouped_energy
+from app.iot.rollups import (
+    ROLLUP_MINUTE, ROLLUP_HOUR, Aggregate, apply_sample, bucket_start, merge_aggregate, update_rollups
+)
 
 logger = logging.getLogger(__name__)
 
@@ -24,27 +33,28 @@ def process_sensor_data(device_id, data):
     """
     try:
         # Find the device
-        device = Device.query.filter_by(device_id=device_id).first()
+        device = device_registry.get(device_id)
         if not device:
             logger.warning(f"Received data for unknown device: {device_id}")
             return False
 
         # Update device status
-        device.last_updated = datetime.utcnow()
+        changes = {"last_updated": datetime.utcnow()}
         if "status" in data:
-            device.status = data["status"]
+            changes["status"] = data["status"]
 
         # Update power state if provided
         if "power_state" in data:
-            device.power_state = data["power_state"]
+            changes["power_state"] = data["power_state"]
 
         # Create power reading if power data is provided
         if "power" in data:
-            device.current_power = float(data["power"])
+            changes["current_power"] = float(data["power"])
 
             # Create power reading record
             power_reading = PowerReading(
                 device_id=device.id,
+                timestamp=changes["last_updated"],
                 power_usage=float(data["power"]),
                 voltage=float(data.get("voltage", 0)),
                 current=float(data.get("current", 0)),
@@ -56,8 +66,20 @@ def process_sensor_data(device_id, data):
                 power_reading.energy_consumed = float(data["energy"])
 
             db.session.add(power_reading)
+            db.session.flush()
+            update_rollups([(device.id, power_reading.timestamp, power_reading.power_usage)])
 
+        db.session.execute(update(Device).where(Device.id == device.id).values(**changes))
         db.session.commit()
+
+        if "current_power" in changes:
+            device_state_store.update(device.id, changes["current_power"], changes["last_updated"])
+
+        from app.africastalking.snapshots import ussd_snapshots
+        ussd_snapshots.apply([dict(changes, id=device.id)])
+
+        from app.iot.events import EVENT_DEVICE, publish_event
+        publish_event(device.user_id, EVENT_DEVICE, dict(changes, id=device.id))
         return True
 
     except Exception as e:
@@ -68,6 +90,13 @@ def get_device_power_stats(device_id, period="day"):
     """
     Get power statistics for a device
 
+    Statistics are computed from the rollup tier matching the period (minute
+    buckets for a day, hour buckets for a week or month). Raw readings are
+    only read for the partial bucket at the start of the range, so results
+    match integrating every raw reading. Readings from before the device's
+    first rollup bucket, i.e. written before rollups were maintained and not
+    yet backfilled with `flask rebuild-rollups`, are read raw as well.
+
     Args:
         device_id (int): Device ID in database
         period (str): Time period - "day", "week", or "month"
@@ -87,16 +116,59 @@ def get_device_power_stats(device_id, period="day"):
         else:
             start_time = now - timedelta(days=1)
 
-        # Query power readings
-        readings = PowerReading.query.filter(
+        resolution = ROLLUP_MINUTE if period not in ("week", "month") else ROLLUP_HOUR
+
+        # First full bucket inside the range
+        boundary = bucket_start(start_time, resolution)
+        if boundary < start_time:
+            boundary += timedelta(seconds=resolution)
+
+        rollups = PowerReadingRollup.query.filter(
+            PowerReadingRollup.device_id == device_id,
+            PowerReadingRollup.resolution == resolution,
+            PowerReadingRollup.bucket_start >= boundary
+        ).order_by(PowerReadingRollup.bucket_start).all()
+
+        # Raw readings for the partial bucket before the first full one, and
+        # for any history older than the first rollup bucket
+        head = db.session.query(PowerReading.timestamp, PowerReading.power_usage).filter(
             PowerReading.device_id == device_id,
             PowerReading.timestamp >= start_time
-        ).order_by(PowerReading.timestamp).all()
+        )
+        if rollups:
+            head = head.filter(PowerReading.timestamp < rollups[0].bucket_start)
+        head = head.order_by(PowerReading.timestamp).all()
+
+        total = Aggregate()
+        formatted_readings = []
+
+        for timestamp, power in head:
+            sample = Aggregate()
+            apply_sample(sample, timestamp, power)
+            merge_aggregate(total, sample)
+            formatted_readings.append({
+                "timestamp": timestamp.isoformat(),
+                "power": power,
+                "min_power": power,
+                "max_power": power,
+                "samples": 1
+            })
 
-        if not readings:
+        for rollup in rollups:
+            merge_aggregate(total, rollup)
+            formatted_readings.append({
+                "timestamp": rollup.bucket_start.isoformat(),
+                "power": rollup.power_sum / rollup.sample_count,
+                "min_power": rollup.power_min,
+                "max_power": rollup.power_max,
+                "samples": rollup.sample_count
+            })
+
+        if not total.sample_count:
             return {
                 "device_id": device_id,
                 "period": period,
+                "resolution": resolution,
                 "total_readings": 0,
                 "average_power": 0,
                 "max_power": 0,
@@ -105,41 +177,15 @@ def get_device_power_stats(device_id, period="day"):
                 "readings": []
             }
 
-        # Calculate statistics
-        power_values = [r.power_usage for r in readings]
-        avg_power = sum(power_values) / len(power_values)
-        max_power = max(power_values)
-        min_power = min(power_values)
-
-        # Calculate total energy (kWh) - simple method
-        total_energy = 0
-        for i in range(1, len(readings)):
-            # Time difference in hours
-            time_diff = (readings[i].timestamp - readings[i-1].timestamp).total_seconds() / 3600
-            # Average power between readings
-            avg_power_between = (readings[i].power_usage + readings[i-1].power_usage) / 2
-            # Energy in kWh = power (W) * time (h) / 1000
-            energy = (avg_power_between * time_diff) / 1000
-            total_energy += energy
-
-        # Format readings for response
-        formatted_readings = []
-        for reading in readings:
-            formatted_readings.append({
-                "timestamp": reading.timestamp.isoformat(),
-                "power": reading.power_usage,
-                "voltage": reading.voltage,
-                "current": reading.current
-            })
-
         return {
             "device_id": device_id,
             "period": period,
-            "total_readings": len(readings),
-            "average_power": avg_power,
-            "max_power": max_power,
-            "min_power": min_power,
-            "total_energy": total_energy,
+            "resolution": resolution,
+            "total_readings": total.sample_count,
+            "average_power": total.power_sum / total.sample_count,
+            "max_power": total.power_max,
+            "min_power": total.power_min,
+            "total_energy": total.energy,
             "readings": formatted_readings
         }
 
@@ -149,96 +195,216 @@ def get_device_power_stats(device_id, period="day"):
             "error": str(e)
         }
 
-def generate_daily_power_summary():
+def supports_window_functions():
+    """Check whether the database can run the window-function summary query"""
+    if db.engine.dialect.name == "sqlite":
+        return sqlite3.sqlite_version_info >= (3, 25, 0)
+    return db.engine.dialect.name in ("postgresql", "mysql")
+
+def seconds_between(later, earlier):
+    """SQL expression for the number of seconds between two timestamps"""
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        return func.extract("epoch", later - earlier)
+    if dialect == "mysql":
+        return func.timestampdiff(literal_column("MICROSECOND"), earlier, later) / 1000000.0
+    return (func.julianday(later) - func.julianday(earlier)) * 86400.0
+
+def daily_device_aggregates(start_date, end_date):
+    """
+    Compute per-device daily energy, peak and average power
+
+    Uses a single grouped query with LAG() for the trapezoidal integration,
+    falling back to one streamed pass in Python when the database has no
+    window functions.
+
+    Args:
+        start_date (datetime.date): First day
+        end_date (datetime.date): Last day (inclusive)
+
+    Returns:
+        list: Dicts with device_id, date, total_energy, peak_power, average_power
+    """
+    start_time = datetime.combine(start_date, datetime.min.time())
+    end_time = datetime.combine(end_date + timedelta(days=1), datetime.min.time())
+
+    if not supports_window_functions():
+        return daily_device_aggregates_python(start_time, end_time)
+
+    day = func.date(PowerReading.timestamp)
+    window = {"partition_by": (PowerReading.device_id, day), "order_by": PowerReading.timestamp}
+
+    ordered = select(
+        PowerReading.device_id,
+        day.label("day"),
+        PowerReading.timestamp,
+        PowerReading.power_usage,
+        func.lag(PowerReading.timestamp).over(**window).label("prev_timestamp"),
+        func.lag(PowerReading.power_usage).over(**window).label("prev_power")
+    ).where(
+        PowerReading.timestamp >= start_time,
+        PowerReading.timestamp < end_time
+    ).subquery()
+
+    # Energy in kWh = average power (W) * time (s) / 3600 / 1000
+    segment_energy = (ordered.c.power_usage + ordered.c.prev_power) / 2 \
+        * seconds_between(ordered.c.timestamp, ordered.c.prev_timestamp) / 3600000.0
+
+    query = select(
+        ordered.c.device_id,
+        ordered.c.day,
+        func.coalesce(func.sum(segment_energy), 0.0),
+        func.max(ordered.c.power_usage),
+        func.avg(ordered.c.power_usage)
+    ).group_by(ordered.c.device_id, ordered.c.day)
+
+    results = []
+    for device_id, day_value, total_energy, peak_power, avg_power in db.session.execute(query):
+        results.append({
+            "device_id": device_id,
+            "date": date.fromisoformat(day_value) if isinstance(day_value, str) else day_value,
+            "total_energy": float(total_energy),
+            "peak_power": peak_power,
+            "average_power": float(avg_power)
+        })
+
+    return results
+
+def daily_device_aggregates_python(start_time, end_time, devices_per_query=100):
+    """Compute daily aggregates with the vectorized analytics engine, a batch of devices at a time"""
+    device_ids = [row[0] for row in db.session.query(PowerReading.device_id).filter(
+        PowerReading.timestamp >= start_time,
+        PowerReading.timestamp < end_time
+    ).distinct()]
+
+    results = []
+    for i in range(0, len(device_ids), devices_per_query):
+        data = fetch_array(select(
+            PowerReading.device_id,
+            epoch_seconds(PowerReading.timestamp),
+            PowerReading.power_usage
+        ).where(
+            PowerReading.device_id.in_(device_ids[i:i + devices_per_query]),
+            PowerReading.timestamp >= start_time,
+            PowerReading.timestamp < end_time
+        ).order_by(PowerReading.device_id, PowerReading.timestamp), 3)
+
+        if not len(data):
+            continue
+
+        # Group by (device, day); rows are already sorted that way
+        days = np.floor(data[:, 1] / 86400).astype(np.int64)
+        keys = data[:, 0].astype(np.int64) * 1000000 + days
+
+        group_keys, energy, peak, average, _ = grouped_energy(keys, data[:, 1], data[:, 2])
+
+        for key, total_energy, peak_power, avg_power in zip(group_keys, energy, peak, average):
+            results.append({
+                "device_id": int(key // 1000000),
+                "date": date(1970, 1, 1) + timedelta(days=int(key % 1000000)),
+                "total_energy": float(total_energy),
+                "peak_power": float(peak_power),
+                "average_power": float(avg_power)
+            })
+
+    return results
+
+def energy_rate_for(rates, day):
+    """Get the rate per kWh valid on a day from a list of EnergyRate"""
+    day_start = datetime.combine(day, datetime.min.time())
+    for rate in rates:
+        if rate.valid_from <= day_start and (rate.valid_to is None or rate.valid_to >= day_start):
+            return rate.rate_per_kwh
+    return 0.15  # Default to $0.15/kWh
+
+def summarize_days(start_date, end_date):
+    """
+    Write daily device and farm-wide summaries for a date range
+
+    Existing daily summaries in the range are replaced, so running it twice
+    for the same days gives the same rows.
+
+    Args:
+        start_date (datetime.date): First day
+        end_date (datetime.date): Last day (inclusive)
+
+    Returns:
+        int: Number of summary rows written
+    """
+    aggregates = daily_device_aggregates(start_date, end_date)
+
+    # Load the energy rates covering the range once
+    rates = EnergyRate.query.filter(
+        EnergyRate.valid_from <= datetime.combine(end_date, datetime.min.time()),
+        (EnergyRate.valid_to == None) | (EnergyRate.valid_to >= datetime.combine(start_date, datetime.min.time()))
+    ).order_by(EnergyRate.valid_from).all()
+
+    rows = []
+    farm_totals = {}
+    day = start_date
+    while day <= end_date:
+        farm_totals[day] = {"total_energy": 0, "peak_power": 0, "cost_estimate": 0}
+        day += timedelta(days=1)
+
+    for aggregate in aggregates:
+        cost_estimate = aggregate["total_energy"] * energy_rate_for(rates, aggregate["date"])
+        rows.append({
+            "summary_type": "daily",
+            "date": aggregate["date"],
+            "total_energy": aggregate["total_energy"],
+            "peak_power": aggregate["peak_power"],
+            "average_power": aggregate["average_power"],
+            "cost_estimate": cost_estimate,
+            "device_id": aggregate["device_id"]
+        })
+
+        # Update farm totals
+        farm = farm_totals[aggregate["date"]]
+        farm["total_energy"] += aggregate["total_energy"]
+        farm["peak_power"] = max(farm["peak_power"], aggregate["peak_power"])
+        farm["cost_estimate"] += cost_estimate
+
+    for day, farm in farm_totals.items():
+        rows.append({
+            "summary_type": "daily",
+            "date": day,
+            "total_energy": farm["total_energy"],
+            "peak_power": farm["peak_power"],
+            "average_power": 0,  # Not meaningful for farm-wide
+            "cost_estimate": farm["cost_estimate"],
+            "device_id": None  # No specific device
+        })
+
+    # Replace existing summaries for the range in the same transaction
+    PowerSummary.query.filter(
+        PowerSummary.summary_type == "daily",
+        PowerSummary.date >= start_date,
+        PowerSummary.date <= end_date
+    ).delete(synchronize_session=False)
+
+    db.session.execute(insert(PowerSummary), rows)
+    db.session.commit()
+
+    return len(rows)
+
+def generate_daily_power_summary(summary_date=None):
     """
     Generate daily power summaries for all devices and farm-wide
     Should be run at the end of each day via scheduled task
 
+    Args:
+        summary_date (datetime.date): Day to summarize, defaults to yesterday
+
     Returns:
         bool: Success or failure
     """
     try:
         # Get yesterday's date
-        yesterday = datetime.utcnow().date() - timedelta(days=1)
-
-        # Get all devices
-        devices = Device.query.all()
-        farm_total_energy = 0
-        farm_peak_power = 0
-        farm_cost_estimate = 0
-
-        # Get current energy rate
-        energy_rate = EnergyRate.query.filter(
-            EnergyRate.valid_from <= yesterday,
-            (EnergyRate.valid_to == None) | (EnergyRate.valid_to >= yesterday)
-        ).first()
-
-        rate_per_kwh = energy_rate.rate_per_kwh if energy_rate else 0.15  # Default to $0.15/kWh
-
-        # Process each device
-        for device in devices:
-            # Get power readings for yesterday
-            start_time = datetime.combine(yesterday, datetime.min.time())
-            end_time = datetime.combine(yesterday, datetime.max.time())
-
-            readings = PowerReading.query.filter(
-                PowerReading.device_id == device.id,
-                PowerReading.timestamp >= start_time,
-                PowerReading.timestamp <= end_time
-            ).all()
-
-            if not readings:
-                continue
-
-            # Calculate total energy and peak power
-            power_values = [r.power_usage for r in readings]
-            peak_power = max(power_values)
-            avg_power = sum(power_values) / len(power_values)
-
-            # Calculate total energy (kWh)
-            total_energy = 0
-            for i in range(1, len(readings)):
-                # Time difference in hours
-                time_diff = (readings[i].timestamp - readings[i-1].timestamp).total_seconds() / 3600
-                # Average power between readings
-                avg_power_between = (readings[i].power_usage + readings[i-1].power_usage) / 2
-                # Energy in kWh = power (W) * time (h) / 1000
-                energy = (avg_power_between * time_diff) / 1000
-                total_energy += energy
-
-            # Calculate cost
-            cost_estimate = total_energy * rate_per_kwh
-
-            # Create device summary
-            device_summary = PowerSummary(
-                summary_type='daily',
-                date=yesterday,
-                total_energy=total_energy,
-                peak_power=peak_power,
-                average_power=avg_power,
-                cost_estimate=cost_estimate,
-                device_id=device.id
-            )
-            db.session.add(device_summary)
-
-            # Update farm totals
-            farm_total_energy += total_energy
-            farm_peak_power = max(farm_peak_power, peak_power)
-            farm_cost_estimate += cost_estimate
-
-        # Create farm-wide summary
-        farm_summary = PowerSummary(
-            summary_type='daily',
-            date=yesterday,
-            total_energy=farm_total_energy,
-            peak_power=farm_peak_power,
-            average_power=0,  # Not meaningful for farm-wide
-            cost_estimate=farm_cost_estimate,
-            device_id=None  # No specific device
-        )
-        db.session.add(farm_summary)
+        summary_date = summary_date or datetime.utcnow().date() - timedelta(days=1)
+        summarize_days(summary_date, summary_date)
 
-        db.session.commit()
+        from app.africastalking.snapshots import ussd_snapshots
+        ussd_snapshots.expire_summaries()
         return True
 
     except Exception as e:
@@ -246,6 +412,48 @@ def generate_daily_power_summary():
         db.session.rollback()
         return False
 
+def backfill_daily_power_summaries(start_date, end_date, chunk_days=7, workers=4):
+    """
+    Generate daily summaries for a date range in parallel chunks
+
+    Args:
+        start_date (datetime.date): First day
+        end_date (datetime.date): Last day (inclusive)
+        chunk_days (int): Days per chunk
+        workers (int): Number of chunks processed concurrently
+
+    Returns:
+        int: Number of summary rows written
+    """
+    app = current_app._get_current_object()
+
+    # SQLite serializes writers, so parallel chunks only add lock contention
+    if db.engine.dialect.name == "sqlite":
+        workers = 1
+
+    chunks = []
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        chunk_end = min(chunk_start + timedelta(days=chunk_days - 1), end_date)
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end + timedelta(days=1)
+
+    def run_chunk(chunk):
+        with app.app_context():
+            try:
+                return summarize_days(*chunk)
+            except Exception:
+                db.session.rollback()
+                raise
+            finally:
+                db.session.remove()
+
+    if workers <= 1:
+        return sum(summarize_days(*chunk) for chunk in chunks)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(run_chunk, chunks))
+
 def get_farm_power_summary(user_id, period="day", start_date=None, end_date=None):
     """
     Get farm-wide power usage summary
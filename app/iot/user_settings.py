@@ -0,0 +1,178 @@
+import threading
+import time
+import logging
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Cached notification settings and contact details of a user
+UserSettings = namedtuple('UserSettings', [
+    'user_id',
+    'phone_number',
+    'has_settings',                 # False if the user has no notification_settings row
+    'power_threshold_warning',      # watts
+    'power_threshold_critical',     # watts
+    'alert_on_high_power',
+    'alert_on_device_offline',
+    'alert_on_schedule_failure',
+    'receive_sms',
+    'receive_email',
+    'receive_push',
+    'quiet_hours_start',            # datetime.time or None
+    'quiet_hours_end'               # datetime.time or None
+])
+
+class UserSettingsCache:
+    """
+    Bounded LRU cache of per-user notification settings for the ingest path
+
+    Entries are invalidated when a user edits their profile or notification
+    settings. Processes that do not serve those requests pick changes up
+    when the entry expires.
+    """
+
+    def __init__(self, max_size=10000, ttl=600):
+        """
+        Args:
+            max_size (int): Maximum number of cached users
+            ttl (float): Seconds an entry stays cached
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # user_id -> (UserSettings or None, expires_at)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def init_app(self, app):
+        """Configure the cache from app settings"""
+        self.max_size = app.config.get('SETTINGS_CACHE_SIZE', self.max_size)
+        self.ttl = app.config.get('SETTINGS_CACHE_TTL', self.ttl)
+        self.clear()
+
+    def get(self, user_id):
+        """
+        Get the settings of a user
+
+        Args:
+            user_id (int): User ID
+
+        Returns:
+            UserSettings: Cached settings, or None if the user does not exist
+        """
+        return self.get_many([user_id]).get(user_id)
+
+    def get_many(self, user_ids):
+        """
+        Get the settings of several users, loading all misses with one query
+
+        Args:
+            user_ids (iterable): User IDs
+
+        Returns:
+            dict: User ID to UserSettings for the existing users
+        """
+        found = {}
+        missing = []
+        now = time.monotonic()
+
+        with self._lock:
+            for user_id in set(user_ids):
+                cached = self._entries.get(user_id)
+                if cached and cached[1] > now:
+                    self._entries.move_to_end(user_id)
+                    self.hits += 1
+                    if cached[0] is not None:
+                        found[user_id] = cached[0]
+                else:
+                    self.misses += 1
+                    missing.append(user_id)
+
+        if missing:
+            loaded = self._load(missing)
+            with self._lock:
+                for user_id in missing:
+                    self._store(user_id, loaded.get(user_id), now + self.ttl)
+            found.update(loaded)
+
+        return found
+
+    def preload(self, limit=None):
+        """
+        Load settings for all users, up to the cache size, with one query
+
+        Returns:
+            int: Number of users loaded
+        """
+        loaded = self._load(limit=limit or self.max_size)
+        expires_at = time.monotonic() + self.ttl
+
+        with self._lock:
+            for user_id, settings in loaded.items():
+                self._store(user_id, settings, expires_at)
+
+        logger.info(f"Preloaded notification settings for {len(loaded)} users")
+        return len(loaded)
+
+    def invalidate(self, user_id):
+        """Drop a user from the cache so the next lookup reloads it"""
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        """Drop all cached entries"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Get cache counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+    def _store(self, user_id, settings, expires_at):
+        """Store an entry, evicting the least recently used ones past max_size"""
+        self._entries[user_id] = (settings, expires_at)
+        self._entries.move_to_end(user_id)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _load(self, user_ids=None, limit=None):
+        """Load users joined with their notification settings from the database"""
+        from app.models.user import User
+        from app.models.notification import NotificationSetting
+        from app import db
+
+        query = db.session.query(
+            User.id, User.phone_number, NotificationSetting.id,
+            NotificationSetting.power_threshold_warning, NotificationSetting.power_threshold_critical,
+            NotificationSetting.alert_on_high_power, NotificationSetting.alert_on_device_offline,
+            NotificationSetting.alert_on_schedule_failure, NotificationSetting.receive_sms,
+            NotificationSetting.receive_email, NotificationSetting.receive_push,
+            NotificationSetting.quiet_hours_start, NotificationSetting.quiet_hours_end
+        ).outerjoin(NotificationSetting, NotificationSetting.user_id == User.id)
+
+        if user_ids is not None:
+            query = query.filter(User.id.in_(user_ids))
+        if limit:
+            query = query.order_by(User.id).limit(limit)
+
+        return {row[0]: UserSettings(row[0], row[1], row[2] is not None, *row[3:]) for row in query}
+
+# Global user settings cache
+settings_cache = UserSettingsCache()
@@ -0,0 +1,441 @@
+import bisect
+import math
+import threading
+import time
+import weakref
+import logging
+
+from flask import Blueprint, Response, current_app, g, request
+
+logger = logging.getLogger(__name__)
+
+metrics_bp = Blueprint('metrics', __name__)
+
+# Upper bounds of the default latency buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Blueprints whose requests are timed
+TIMED_BLUEPRINTS = ('api', 'dashboard')
+
+class Registry:
+    """
+    Metrics registry with per-thread aggregation
+
+    Counters and histograms are written to a shard owned by the calling
+    thread, so recording takes no lock and threads never contend. Shards are
+    merged only when the metrics are collected. A shard is folded into the
+    retired totals when its thread is garbage collected, so short-lived
+    request threads do not accumulate.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._shards = []
+        self._retired = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add a metric; names must be unique"""
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+
+    def get(self, name):
+        """Get a registered metric by name"""
+        return self._metrics.get(name)
+
+    def register_collector(self, collector):
+        """
+        Add a function called at collection time
+
+        Args:
+            collector (callable): Returns an iterable of (name, type, help, samples)
+                where samples are (labels dict, value) pairs
+        """
+        with self._lock:
+            if collector not in self._collectors:
+                self._collectors.append(collector)
+
+    def shard(self):
+        """Get the calling thread's shard: (metric name, label values) -> value"""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+            weakref.finalize(threading.current_thread(), self._retire, shard)
+            return shard
+
+    def merged(self):
+        """Sum the values of all shards, including those of finished threads"""
+        with self._lock:
+            shards = list(self._shards)
+            totals = {key: merge(None, value) for key, value in self._retired.items()}
+
+        for shard in shards:
+            for key, value in list(shard.items()):
+                totals[key] = merge(totals.get(key), value)
+        return totals
+
+    def collect(self):
+        """
+        Render all metrics in the Prometheus text exposition format
+
+        Returns:
+            str: Metrics text
+        """
+        totals = self.merged()
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render(totals))
+
+        for collector in collectors:
+            try:
+                for name, metric_type, help_text, samples in collector():
+                    lines.append(f"# HELP {name} {help_text}")
+                    lines.append(f"# TYPE {name} {metric_type}")
+                    lines.extend(f"{name}{format_labels(labels)} {format_value(value)}" for labels, value in samples)
+            except Exception as e:
+                logger.error(f"Metrics collector error: {str(e)}")
+
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """Zero all counters and histograms"""
+        with self._lock:
+            for shard in self._shards:
+                shard.clear()
+            self._retired.clear()
+
+    def _retire(self, shard):
+        with self._lock:
+            for key, value in shard.items():
+                self._retired[key] = merge(self._retired.get(key), value)
+            self._shards.remove(shard)
+
+def merge(total, value):
+    """Add a shard value (a number, or [bucket counts, sum] for histograms) to a total"""
+    if isinstance(value, list):
+        if total is None:
+            return [list(value[0]), value[1]]
+        total[0] = [a + b for a, b in zip(total[0], value[0])]
+        total[1] += value[1]
+        return total
+    return (total or 0) + value
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels.items()) + "}"
+
+def format_value(value):
+    if value is None:
+        return "NaN"
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """Base class of named metrics with optional labels"""
+
+    metric_type = None
+
+    def __init__(self, name, help_text, labelnames=(), registry=None):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.registry = registry or default_registry
+        self.registry.register(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.metric_type}"]
+
+    def samples(self, totals):
+        """(label values, value) pairs of this metric from the merged totals"""
+        return sorted(
+            ((key[1], value) for key, value in totals.items() if key[0] == self.name),
+            key=lambda sample: sample[0]
+        )
+
+    def labels_for(self, values):
+        return dict(zip(self.labelnames, values))
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+
+    metric_type = 'counter'
+
+    def header(self):
+        return [f"# HELP {self.name}_total {self.help}", f"# TYPE {self.name}_total counter"]
+
+    def inc(self, amount=1, labels=()):
+        """
+        Increment the counter
+
+        Args:
+            amount (float): Amount to add
+            labels (tuple): Label values, in the order of labelnames
+        """
+        shard = self.registry.shard()
+        key = (self.name, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def render(self, totals):
+        lines = self.header()
+        for values, value in self.samples(totals):
+            lines.append(f"{self.name}_total{format_labels(self.labels_for(values))} {format_value(value)}")
+        return lines
+
+class Gauge(Metric):
+    """
+    Value that goes up and down
+
+    Either set explicitly, or read from function at collection time, which
+    costs the instrumented code nothing. function returns a number, or a dict
+    of label value tuples to numbers.
+    """
+
+    metric_type = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), registry=None, function=None):
+        super().__init__(name, help_text, labelnames, registry)
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self, totals):
+        if self.function is None:
+            with self._lock:
+                values = sorted(self._values.items())
+        else:
+            try:
+                result = self.function()
+            except Exception as e:
+                logger.error(f"Error reading gauge {self.name}: {str(e)}")
+                return []
+            if result is None:
+                return []
+            values = sorted(result.items()) if isinstance(result, dict) else [((), result)]
+
+        lines = self.header()
+        for label_values, value in values:
+            lines.append(f"{self.name}{format_labels(self.labels_for(label_values))} {format_value(value)}")
+        return lines
+
+class Histogram(Metric):
+    """Distribution of observations in cumulative buckets"""
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), registry=None, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        """
+        Record an observation
+
+        Args:
+            value (float): Observed value, in seconds for latencies
+            labels (tuple): Label values, in the order of labelnames
+        """
+        shard = self.registry.shard()
+        key = (self.name, labels)
+        entry = shard.get(key)
+        if entry is None:
+            entry = shard[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def time(self, labels=()):
+        """Context manager observing the seconds spent in its block"""
+        return Timer(self, labels)
+
+    def latency_summary(self):
+        """
+        Summarize a latency histogram over all its label values
+
+        Quantiles are estimated as the upper bound of the bucket containing
+        them, like histogram_quantile would.
+
+        Returns:
+            dict: count, avg_ms, p50_ms, p95_ms and p99_ms
+        """
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        for _, (bucket_counts, value_sum) in self.samples(self.registry.merged()):
+            counts = [a + b for a, b in zip(counts, bucket_counts)]
+            total += value_sum
+
+        count = sum(counts)
+
+        def quantile(q):
+            if not count:
+                return None
+            seen = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                seen += bucket_count
+                if seen >= q * count:
+                    return bound * 1000
+            return float('inf')
+
+        return {
+            "count": count,
+            "avg_ms": round(total / count * 1000, 3) if count else None,
+            "p50_ms": quantile(0.5),
+            "p95_ms": quantile(0.95),
+            "p99_ms": quantile(0.99)
+        }
+
+    def render(self, totals):
+        lines = self.header()
+        for values, (counts, total) in self.samples(totals):
+            labels = self.labels_for(values)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = "+Inf" if math.isinf(bound) else repr(bound)
+                lines.append(f"{self.name}_bucket{format_labels(dict(labels, le=le))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {cumulative}")
+        return lines
+
+class Timer:
+    """Times a block into a histogram"""
+
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, self.labels)
+        return False
+
+# Global registry
+default_registry = Registry()
+
+def counter(name, help_text, labelnames=()):
+    """Get or create a counter in the global registry"""
+    return default_registry.get(name) or Counter(name, help_text, labelnames)
+
+def gauge(name, help_text, labelnames=(), function=None):
+    """Get or create a gauge in the global registry"""
+    return default_registry.get(name) or Gauge(name, help_text, labelnames, function=function)
+
+def histogram(name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+    """Get or create a histogram in the global registry"""
+    return default_registry.get(name) or Histogram(name, help_text, labelnames, buckets=buckets)
+
+# Hot-path metrics
+MQTT_MESSAGES = counter('smart_farm_mqtt_messages', 'MQTT messages received', ('kind',))
+MQTT_CALLBACK_SECONDS = histogram(
+    'smart_farm_mqtt_callback_seconds', 'Time spent in the MQTT on_message callback', ('kind',)
+)
+INGEST_FLUSH_SECONDS = histogram('smart_farm_ingest_flush_seconds', 'Time to write one telemetry batch')
+INGEST_FLUSHED_SAMPLES = counter('smart_farm_ingest_samples', 'Telemetry samples written or failed', ('outcome',))
+HTTP_REQUEST_SECONDS = histogram(
+    'smart_farm_http_request_seconds', 'API and dashboard request latency', ('blueprint', 'endpoint', 'method', 'status')
+)
+SMS_SEND_SECONDS = histogram(
+    'smart_farm_sms_send_seconds', "Africa's Talking SMS API call latency", ('outcome',),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+SMS_MESSAGES = counter('smart_farm_sms_messages', 'Outbox messages by delivery outcome', ('outcome',))
+USSD_CALLBACK_SECONDS = histogram('smart_farm_ussd_callback_seconds', 'USSD callback latency', ('state',))
+
+def component_stats():
+    """Gauges read from the stats() of the running background components"""
+    from app.iot import dispatcher, ingest
+    from app.iot import events
+    from app.africastalking import outbox, sessions
+    from app.africastalking.snapshots import ussd_snapshots
+    from app.iot.device_registry import device_registry
+    from app.iot.user_settings import settings_cache
+
+    queue_depths = {}
+    if ingest.telemetry_ingestor:
+        queue_depths['ingest'] = ingest.telemetry_ingestor.stats()['queue_depth']
+    if dispatcher.message_dispatcher:
+        queue_depths['mqtt_dispatch'] = dispatcher.message_dispatcher.stats()['queue_depth']
+    if queue_depths:
+        yield ('smart_farm_queue_depth', 'gauge', 'Items waiting in background queues',
+               [({'queue': name}, depth) for name, depth in queue_depths.items()])
+
+    caches = {'device_registry': device_registry, 'user_settings': settings_cache, 'ussd_snapshots': ussd_snapshots}
+    sizes = []
+    hit_rates = []
+    for name, cache in caches.items():
+        stats = cache.stats()
+        sizes.append(({'cache': name}, stats['size']))
+        if stats.get('hit_rate') is not None:
+            hit_rates.append(({'cache': name}, stats['hit_rate']))
+    yield ('smart_farm_cache_entries', 'gauge', 'Entries in in-process caches', sizes)
+    if hit_rates:
+        yield ('smart_farm_cache_hit_rate', 'gauge', 'Hit rate of in-process caches since start', hit_rates)
+
+    if events.event_broker:
+        yield ('smart_farm_event_subscribers', 'gauge', 'Open live dashboard streams in this process',
+               [({}, events.event_broker.subscriber_count())])
+
+    if sessions.session_store:
+        stats = sessions.session_store.stats()
+        if 'sessions' in stats:
+            yield ('smart_farm_ussd_sessions', 'gauge', 'USSD sessions held in memory', [({}, stats['sessions'])])
+
+    if outbox.sms_sender:
+        stats = outbox.sms_sender.stats()
+        yield ('smart_farm_sms_api_errors_total', 'counter', "Failed Africa's Talking API calls",
+               [({}, stats['api_errors'])])
+
+def record_request_start():
+    if request.blueprint in TIMED_BLUEPRINTS:
+        g.metrics_started = time.perf_counter()
+
+def record_request_end(response):
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            (request.blueprint, request.endpoint or 'unknown', request.method, str(response.status_code))
+        )
+    return response
+
+@metrics_bp.route('/metrics')
+def metrics():
+    """Metrics in the Prometheus text format, optionally protected by METRICS_TOKEN"""
+    token = current_app.config.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        return Response("Unauthorized\n", status=401, mimetype='text/plain')
+
+    return Response(default_registry.collect(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+def setup_metrics(app):
+    """Expose /metrics and time API and dashboard requests"""
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+
+    app.register_blueprint(metrics_bp)
+    app.before_request(record_request_start)
+    app.after_request(record_request_end)
+    default_registry.register_collector(component_stats)
@@ -20,10 +20,11 @@ class Device(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     # Foreign Keys
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
 
     # Relationships
     power_readings = db.relationship('PowerReading', backref='device', lazy='dynamic', cascade='all, delete-orphan')
+    power_rollups = db.relationship('PowerReadingRollup', backref='device', lazy='dynamic', cascade='all, delete-orphan')
     schedules = db.relationship('Schedule', backref='device', lazy='dynamic', cascade='all, delete-orphan')
 
     def __repr__(self):
@@ -48,6 +49,7 @@ class Device(db.Model):
         self.power_state = state
         self.last_updated = datetime.utcnow()
         db.session.commit()
+        self._update_ussd_snapshot(power_state=state)
         return self.power_state
 
     def update_status(self, status):
@@ -55,8 +57,14 @@ class Device(db.Model):
         self.status = status
         self.last_updated = datetime.utcnow()
         db.session.commit()
+        self._update_ussd_snapshot(status=status)
         return self.status
 
+    def _update_ussd_snapshot(self, **changes):
+        """Apply a saved change to the owner's cached USSD snapshot"""
+        from app.africastalking.snapshots import ussd_snapshots
+        ussd_snapshots.apply([dict(changes, id=self.id, last_updated=self.last_updated)])
+
 class DeviceType(db.Model):
     """Device type categorization"""
     __tablename__ = 'device_types'
@@ -4,6 +4,16 @@ from app import db
 class Notification(db.Model):
     """Model for system notifications and alerts"""
     __tablename__ = 'notifications'
+    __table_args__ = (
+        # Keyset pagination of a user's notifications, newest first
+        db.Index('ix_notifications_user_timestamp_id', 'user_id', 'timestamp', 'id'),
+        # Unread listings and counts
+        db.Index('ix_notifications_user_read_timestamp', 'user_id', 'is_read', 'timestamp'),
+        # Recent alerts of a type for a device (alert cooldowns)
+        db.Index('ix_notifications_device_type_timestamp', 'device_id', 'notification_type', 'timestamp'),
+        # Notifications waiting for their SMS digest
+        db.Index('ix_notifications_sms_pending', 'sms_message_id', 'send_sms', 'sms_sent', 'timestamp'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
@@ -21,6 +31,9 @@ class Notification(db.Model):
     sms_sent = db.Column(db.Boolean, default=False)
     email_sent = db.Column(db.Boolean, default=False)
 
+    # Outbox message carrying this notification, possibly as part of a digest
+    sms_message_id = db.Column(db.Integer, db.ForeignKey('sms_outbox.id'), nullable=True)
+
     # Foreign Keys
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     device_id = db.Column(db.Integer, db.ForeignKey('devices.id'), nullable=True)
@@ -74,4 +87,30 @@ class NotificationSetting(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, unique=True)
 
     def __repr__(self):
-        return f'<NotificationSetting for user_id: {self.user_id}>'
\ No newline at end of file
+        return f'<NotificationSetting for user_id: {self.user_id}>'
+
+class SMSMessage(db.Model):
+    """Model for the SMS outbox, sent in the background by the SMS sender"""
+    __tablename__ = 'sms_outbox'
+    __table_args__ = (
+        # Due messages, oldest first
+        db.Index('ix_sms_outbox_status_next_attempt', 'status', 'next_attempt_at', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(20), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), default='pending', nullable=False)  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    sent_at = db.Column(db.DateTime)
+    last_error = db.Column(db.String(200))
+    provider_message_id = db.Column(db.String(100))
+
+    # Sender round that claimed the message, see SMSOutboxSender._claim
+    claimed_at = db.Column(db.DateTime)
+    claim_token = db.Column(db.String(32))
+
+    def __repr__(self):
+        return f'<SMSMessage {self.id} to {self.recipient}: {self.status}>'
@@ -4,6 +4,10 @@ from app import db
 class PowerReading(db.Model):
     """Model for power readings from devices"""
     __tablename__ = 'power_readings'
+    __table_args__ = (
+        # Per-device time range scans and keyset pagination
+        db.Index('ix_power_readings_device_timestamp_id', 'device_id', 'timestamp', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
@@ -31,9 +35,40 @@ class PowerReading(db.Model):
             'device_id': self.device_id
         }
 
+class PowerReadingRollup(db.Model):
+    """Model for per-device power reading aggregates over fixed time buckets"""
+    __tablename__ = 'power_reading_rollups'
+    __table_args__ = (
+        db.UniqueConstraint('device_id', 'resolution', 'bucket_start', name='uq_rollup_bucket'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    resolution = db.Column(db.Integer, nullable=False)  # bucket size in seconds
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    sample_count = db.Column(db.Integer, nullable=False, default=0)
+    power_sum = db.Column(db.Float, nullable=False, default=0.0)  # sum of power samples in watts
+    power_min = db.Column(db.Float)
+    power_max = db.Column(db.Float)
+    energy = db.Column(db.Float, nullable=False, default=0.0)  # trapezoidal energy between samples in kWh
+
+    # First and last sample, used to integrate across bucket boundaries
+    first_timestamp = db.Column(db.DateTime)
+    first_power = db.Column(db.Float)
+    last_timestamp = db.Column(db.DateTime)
+    last_power = db.Column(db.Float)
+
+    # Foreign Key
+    device_id = db.Column(db.Integer, db.ForeignKey('devices.id'), nullable=False)
+
+    def __repr__(self):
+        return f'<PowerReadingRollup {self.device_id} {self.bucket_start} ({self.resolution}s)>'
+
 class PowerSummary(db.Model):
     """Model for daily, weekly, and monthly power usage summaries"""
     __tablename__ = 'power_summaries'
+    __table_args__ = (
+        db.Index('ix_power_summaries_type_date_device', 'summary_type', 'date', 'device_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     summary_type = db.Column(db.String(10), nullable=False)  # daily, weekly, monthly
@@ -25,7 +25,7 @@ class Schedule(db.Model):
     condition_value = db.Column(db.String(50))  # Threshold or condition value
 
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     # Foreign Keys
     device_id = db.Column(db.Integer, db.ForeignKey('devices.id'), nullable=False)
@@ -1,9 +1,22 @@
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
+from sqlalchemy.orm import validates
 
 from app import db, login_manager
 
+def normalize_phone(phone_number):
+    """
+    Normalize a phone number for lookups
+
+    Keeps only the digits and drops an international '00' prefix, so
+    '+256 700-000001', '00256700000001' and '256700000001' all match.
+    """
+    if not phone_number:
+        return None
+    digits = ''.join(c for c in phone_number if c.isdigit())
+    return digits[2:] if digits.startswith('00') else digits
+
 class User(UserMixin, db.Model):
     """User model for authentication and profile data"""
     __tablename__ = 'users'
@@ -14,6 +27,7 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(128), nullable=False)
     full_name = db.Column(db.String(100))
     phone_number = db.Column(db.String(15), nullable=False)
+    phone_key = db.Column(db.String(20), index=True)  # normalized phone_number, see normalize_phone
     farm_name = db.Column(db.String(100))
     is_admin = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -24,6 +38,11 @@ class User(UserMixin, db.Model):
     notifications = db.relationship('Notification', backref='user', lazy='dynamic')
     schedules = db.relationship('Schedule', backref='user', lazy='dynamic')
 
+    @validates('phone_number')
+    def validate_phone_number(self, key, phone_number):
+        self.phone_key = normalize_phone(phone_number)
+        return phone_number
+
     @property
     def password(self):
         raise AttributeError('password is not a readable attribute')
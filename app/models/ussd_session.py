@@ -0,0 +1,14 @@
+from datetime import datetime
+from app import db
+
+class USSDSessionRecord(db.Model):
+    """Model for USSD sessions shared between processes (database session store)"""
+    __tablename__ = 'ussd_sessions'
+
+    session_id = db.Column(db.String(100), primary_key=True)
+    data = db.Column(db.Text, nullable=False)  # JSON encoded session
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<USSDSessionRecord {self.session_id}>'
@@ -242,6 +242,9 @@ def settings():
         db.session.add(notification_settings)
         db.session.commit()
 
+        from app.iot.user_settings import settings_cache
+        settings_cache.invalidate(current_user.id)
+
     return render_template(
         'dashboard/settings.html',
         notification_settings=notification_settings
@@ -270,6 +273,13 @@ def schedules():
     )
 
 # AJAX routes for dashboard
+@dashboard_bp.route('/api/events')
+@login_required
+def events():
+    """Live events for the logged-in user's dashboard, replacing polling"""
+    from app.api.event_routes import event_stream_response
+    return event_stream_response(current_user.id)
+
 @dashboard_bp.route('/api/device/<int:device_id>/control', methods=['POST'])
 @login_required
 def device_control(device_id):
@@ -288,13 +298,20 @@ def device_control(device_id):
     command = data['command']
     value = data.get('value')
 
-    # Send command to device via MQTT
-    from app.iot.mqtt_client import send_device_control
-    success = send_device_control(device.device_id, command, value)
+    # Send command to device via MQTT, optionally waiting for confirmation
+    from app.iot.commands import requested_wait, send_command
+    wait = requested_wait(data)
+    success, pending = send_command(device.device_id, command, value, device.power_state)
 
     if not success:
         return jsonify({'error': 'Failed to send command to device'}), 500
 
+    if wait is not None and pending and not pending.wait(wait):
+        return jsonify({
+            'error': 'Device did not confirm the command in time',
+            'command': pending.to_dict()
+        }), 504
+
     # If the command is to turn power on/off, update the device state
     if command == 'power':
         if isinstance(value, bool):
@@ -302,6 +319,9 @@ def device_control(device_id):
         elif value in ['on', 'off']:
             device.update_power_state(value == 'on')
 
+        from app.api.power_routes import dashboard_cache
+        dashboard_cache.invalidate(current_user.id)
+
     return jsonify({
         'message': f'Command {command} sent successfully to device',
         'device_id': device_id,
@@ -0,0 +1,117 @@
+"""
+Benchmark the vectorized analytics engine against ORM loading and per-row loops
+
+Seeds an SQLite database with one device's readings, then compares the old
+approach (ORM objects plus a Python loop per pair of readings) with
+load_series() plus series_stats().
+
+Usage:
+    python benchmarks/bench_analytics.py [--samples 1000000] [--database sqlite://]
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def orm_loop_stats(device_id, start_time):
+    """The per-row computation previously done over ORM objects"""
+    from app.models.power_usage import PowerReading
+
+    readings = PowerReading.query.filter(
+        PowerReading.device_id == device_id,
+        PowerReading.timestamp >= start_time
+    ).order_by(PowerReading.timestamp).all()
+
+    power_values = [r.power_usage for r in readings]
+    avg_power = sum(power_values) / len(power_values)
+
+    total_energy = 0
+    for i in range(1, len(readings)):
+        time_diff = (readings[i].timestamp - readings[i - 1].timestamp).total_seconds() / 3600
+        avg_power_between = (readings[i].power_usage + readings[i - 1].power_usage) / 2
+        total_energy += (avg_power_between * time_diff) / 1000
+
+    return {"average_power": avg_power, "max_power": max(power_values), "total_energy": total_energy}
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def seed(samples, start_time):
+    from sqlalchemy import insert
+    from app import db
+    from app.models.device import Device
+    from app.models.power_usage import PowerReading
+
+    device = Device(name='Benchmark Pump', device_type='pump', device_id='bench-1')
+    db.session.add(device)
+    db.session.commit()
+
+    rng = np.random.default_rng(42)
+    offsets = np.cumsum(rng.uniform(4, 6, samples))
+    power = rng.uniform(0, 1500, samples)
+
+    chunk = 100000
+    for i in range(0, samples, chunk):
+        db.session.execute(insert(PowerReading), [{
+            "device_id": device.id,
+            "timestamp": start_time + timedelta(seconds=float(offsets[j])),
+            "power_usage": float(power[j]),
+            "voltage": 230.0,
+            "current": float(power[j]) / 230.0
+        } for j in range(i, min(i + chunk, samples))])
+    db.session.commit()
+
+    return device.id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--samples', type=int, default=1000000)
+    parser.add_argument('--database', default='sqlite://', help='SQLAlchemy URL of a scratch database')
+    args = parser.parse_args()
+
+    os.environ['TEST_DATABASE_URL'] = args.database
+
+    from app import create_app, db
+    from app.iot.analytics import load_series, series_stats
+
+    app = create_app('testing')
+    start_time = datetime(2026, 1, 1)
+
+    with app.app_context():
+        db.create_all()
+        try:
+            device_id, seed_time = timed(seed, args.samples, start_time)
+
+            loop_result, loop_time = timed(orm_loop_stats, device_id, start_time)
+            db.session.expunge_all()
+
+            series, load_time = timed(load_series, device_id, start_time)
+            stats, numpy_time = timed(series_stats, series)
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+    assert abs(stats["total_energy"] - loop_result["total_energy"]) <= 1e-6 * loop_result["total_energy"]
+
+    vectorized_time = load_time + numpy_time
+    print(f"samples:               {args.samples}  (seeded in {seed_time:.1f} s)")
+    print(f"ORM load + loop:       {loop_time * 1000:9.1f} ms  (energy {loop_result['total_energy']:.3f} kWh)")
+    print(f"cursor -> arrays:      {load_time * 1000:9.1f} ms")
+    print(f"vectorized stats:      {numpy_time * 1000:9.1f} ms  (energy {stats['total_energy']:.3f} kWh, "
+          f"plus percentiles, duty cycle and gaps)")
+    print(f"speedup:               {loop_time / vectorized_time:9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
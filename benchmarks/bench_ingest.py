@@ -0,0 +1,347 @@
+"""
+Benchmark end-to-end telemetry ingestion through the real MQTT callbacks
+
+Seeds devices, then starts the MQTT pipeline exactly as setup_mqtt_client()
+does (dispatcher workers, batching ingestor, alert engine) but with a fake
+paho client, and replays synthetic telemetry for N devices into on_message
+at a target rate for a fixed duration. A share of devices runs above the
+power thresholds so check_power_thresholds() raises alerts, and a share of
+messages are device status reports.
+
+Measures the sustained message rate, end-to-end lag from on_message to the
+committed batch (sampled from the ingestor's flush counter), database rows
+per second and RSS, and writes a JSON report. With --baseline, the run is
+compared against an earlier report and exits with status 1 on a regression.
+
+Usage:
+    python benchmarks/bench_ingest.py [--devices 1000] [--rate 2000] [--duration 10]
+        [--database sqlite:///scratch.db] [--json report.json] [--baseline previous.json]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Report fields compared with --baseline: name -> True if higher is better
+REGRESSION_METRICS = {
+    'sustained_msgs_per_second': True,
+    'rows_per_second': True,
+    'lag_ms.p99': False,
+    'rss_peak_mb': False,
+}
+
+
+class FakeMQTTClient:
+    """Stands in for paho.mqtt.client.Client: no network, records what would be sent"""
+
+    def __init__(self, client_id='', clean_session=None, userdata=None, protocol=None, **kwargs):
+        self._userdata = userdata
+        self.subscriptions = []
+        self.published = 0
+        self.on_connect = self.on_message = self.on_disconnect = None
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def tls_set(self, *args, **kwargs):
+        pass
+
+    def connect(self, host, port=1883, keepalive=60, **kwargs):
+        self.on_connect(self, self._userdata, {}, 0)
+        return 0
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.append(topic)
+        return 0, len(self.subscriptions)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        import paho.mqtt.client as mqtt
+
+        self.published += 1
+        info = mqtt.MQTTMessageInfo(self.published)
+        info.rc = mqtt.MQTT_ERR_SUCCESS
+        info._set_as_published()
+        return info
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+def rss_mb():
+    """Current resident set size in MiB"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def seed(devices, users, rng):
+    """Insert users and devices, returning the IoT device IDs"""
+    from sqlalchemy import insert
+    from app import db
+    from app.models.device import Device
+    from app.models.user import User
+
+    db.session.execute(insert(User), [{
+        'username': f'farmer{i}', 'email': f'farmer{i}@example.com', 'password_hash': 'x',
+        'phone_number': f'2567{i:08d}', 'phone_key': f'2567{i:08d}'
+    } for i in range(users)])
+    user_ids = [row[0] for row in db.session.query(User.id)]
+
+    device_ids = [f'sensor-{i}' for i in range(devices)]
+    db.session.execute(insert(Device), [{
+        'name': f'Device {i}', 'device_type': rng.choice(('pump', 'fan', 'heater', 'light')),
+        'device_id': device_id, 'max_power': 2000.0, 'status': 'online', 'user_id': user_ids[i % len(user_ids)]
+    } for i, device_id in enumerate(device_ids)])
+    db.session.commit()
+    return device_ids
+
+
+def payloads(device_ids, hot_share, status_share, rng):
+    """Yield (topic, payload, is_telemetry) forever, cycling through the devices"""
+    from app.iot.mqtt_client import DEVICE_TOPIC, TELEMETRY_TOPIC
+
+    hot = set(rng.sample(device_ids, int(len(device_ids) * hot_share)))
+    energy = dict.fromkeys(device_ids, 0.0)
+    while True:
+        for device_id in device_ids:
+            if rng.random() < status_share:
+                yield f'{DEVICE_TOPIC}{device_id}/status', json.dumps({'status': 'online'}).encode(), False
+                continue
+
+            power = rng.uniform(900, 1500) if device_id in hot else rng.uniform(0, 700)
+            energy[device_id] += power / 3600000
+            yield f'{TELEMETRY_TOPIC}{device_id}', json.dumps({
+                'power': round(power, 2), 'voltage': round(rng.uniform(225, 235), 1),
+                'current': round(power / 230, 3), 'power_factor': 0.95, 'energy': round(energy[device_id], 6)
+            }).encode(), True
+
+
+def replay(client, messages, rate, duration, send_times):
+    """
+    Feed messages to on_message at rate per second (0 for as fast as the pipeline accepts)
+
+    Returns:
+        tuple: (messages sent, seconds spent sending)
+    """
+    import paho.mqtt.client as mqtt
+
+    sent = 0
+    started = time.monotonic()
+    deadline = started + duration
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            break
+
+        due = int((now - started) * rate) if rate else sent + 100
+        if sent >= due:
+            time.sleep(min(0.001, deadline - now))
+            continue
+
+        for _ in range(due - sent):
+            topic, payload, is_telemetry = next(messages)
+            msg = mqtt.MQTTMessage(topic=topic.encode())
+            msg.payload = payload
+            if is_telemetry:
+                send_times.append(time.monotonic())
+            client.on_message(client, client._userdata, msg)
+            sent += 1
+
+    return sent, time.monotonic() - started
+
+
+def monitor(ingestor, send_times, stop, checkpoints, interval=0.02):
+    """Sample (time, samples written) so the lag of the newest written sample can be estimated"""
+    while not stop.wait(interval):
+        stats = ingestor.stats()
+        checkpoints.append((time.monotonic(), stats['flushed'] + stats['failed'], len(send_times)))
+
+
+def lag_percentiles(checkpoints, send_times):
+    """Lag of the newest written sample at each checkpoint, as p50/p95/p99/max in milliseconds"""
+    lags = [(at - send_times[written - 1]) * 1000 for at, written, _ in checkpoints
+            if 0 < written <= len(send_times)]
+    if not lags:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+    p50, p95, p99 = np.percentile(lags, [50, 95, 99])
+    return {'p50': round(float(p50), 1), 'p95': round(float(p95), 1), 'p99': round(float(p99), 1),
+            'max': round(max(lags), 1)}
+
+
+def metric(report, name):
+    value = report
+    for key in name.split('.'):
+        value = (value or {}).get(key)
+    return value
+
+
+def compare(report, baseline, tolerance):
+    """List the metrics that got worse than the baseline by more than tolerance"""
+    regressions = []
+    for name, higher_is_better in REGRESSION_METRICS.items():
+        current, previous = metric(report, name), metric(baseline, name)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        if (change < -tolerance) if higher_is_better else (change > tolerance):
+            regressions.append(f'{name}: {previous} -> {current} ({change:+.1%})')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=2000, help='Messages per second, 0 for unthrottled')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds of traffic')
+    parser.add_argument('--hot-share', type=float, default=0.05, help='Share of devices above the thresholds')
+    parser.add_argument('--status-share', type=float, default=0.01, help='Share of messages that are status reports')
+    parser.add_argument('--workers', type=int, help='MQTT_DISPATCH_WORKERS')
+    parser.add_argument('--flush-size', type=int, help='INGEST_FLUSH_SIZE')
+    parser.add_argument('--flush-interval', type=float, help='INGEST_FLUSH_INTERVAL')
+    parser.add_argument('--database', help='SQLAlchemy URL of a scratch database (default: temporary SQLite file)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='Write the report to this file')
+    parser.add_argument('--baseline', help='Earlier JSON report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='Allowed relative regression')
+    args = parser.parse_args()
+
+    scratch = None
+    if not args.database:
+        # A file rather than sqlite:// so the worker threads get their own connections
+        scratch = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        scratch.close()
+        args.database = f'sqlite:///{scratch.name}'
+    os.environ['TEST_DATABASE_URL'] = args.database
+
+    from app import create_app, db
+    from app.iot import alerts, commands, dispatcher, ingest, mqtt_client
+    from app.models.notification import Notification
+    from app.models.power_usage import PowerReading
+
+    app = create_app('testing')
+    for key, value in (('MQTT_DISPATCH_WORKERS', args.workers), ('INGEST_FLUSH_SIZE', args.flush_size),
+                       ('INGEST_FLUSH_INTERVAL', args.flush_interval)):
+        if value is not None:
+            app.config[key] = value
+    logging.getLogger('app').setLevel(logging.ERROR)
+
+    rng = random.Random(args.seed)
+    ctx = app.app_context()
+    ctx.push()
+    try:
+        db.create_all()
+        device_ids = seed(args.devices, args.users, rng)
+        db.session.remove()
+
+        # The real setup, with the fake client in place of paho's
+        mqtt_client.mqtt.Client, real_client = FakeMQTTClient, mqtt_client.mqtt.Client
+        try:
+            client = mqtt_client.setup_mqtt_client(start_loop=False)
+        finally:
+            mqtt_client.mqtt.Client = real_client
+
+        rss_before = rss_mb()
+        send_times = []
+        checkpoints = []
+        stop = threading.Event()
+        watcher = threading.Thread(target=monitor, args=(ingest.telemetry_ingestor, send_times, stop, checkpoints),
+                                   daemon=True)
+        watcher.start()
+
+        messages = payloads(device_ids, args.hot_share, args.status_share, rng)
+        sent, send_seconds = replay(client, messages, args.rate, args.duration, send_times)
+        backlog = dispatcher.message_dispatcher.stats()['queue_depth'] + ingest.telemetry_ingestor.stats()['queue_depth']
+
+        # Drain: workers finish their queues, then the ingestor writes what it buffered
+        dispatcher.message_dispatcher.stop(timeout=300)
+        ingest.telemetry_ingestor.stop(timeout=300)
+        alerts.alert_engine.stop()
+        commands.command_tracker.stop()
+        drained = time.monotonic()
+        stop.set()
+        watcher.join()
+        checkpoints.append((drained, ingest.telemetry_ingestor.stats()['flushed'], len(send_times)))
+        elapsed = drained - (send_times[0] if send_times else drained)
+
+        rows = db.session.query(db.func.count(PowerReading.id)).scalar()
+        notifications = db.session.query(db.func.count(Notification.id)).scalar()
+        dispatch_stats = dispatcher.message_dispatcher.stats()
+        ingest_stats = ingest.telemetry_ingestor.stats()
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        rss_after = rss_mb()
+    finally:
+        db.session.remove()
+        db.drop_all()
+        ctx.pop()
+        if scratch:
+            os.unlink(scratch.name)
+
+    report = {
+        'generated_at': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('json', 'baseline')},
+        'offered_msgs_per_second': args.rate or None,
+        'sent': sent,
+        'send_seconds': round(send_seconds, 3),
+        'sustained_msgs_per_second': round(sent / elapsed, 1) if elapsed else None,
+        'fell_behind': bool(args.rate) and sent < 0.95 * args.rate * args.duration,
+        'backlog_at_end_of_send': backlog,
+        'drain_seconds': round(drained - (send_times[0] + send_seconds) if send_times else 0.0, 3),
+        'lag_ms': lag_percentiles(checkpoints, send_times),
+        'rows': rows,
+        'rows_per_second': round(rows / elapsed, 1) if elapsed else None,
+        'notifications': notifications,
+        'dispatcher': {key: dispatch_stats[key] for key in ('dispatched', 'processed', 'dropped', 'failed', 'latency_ms')},
+        'ingestor': {key: ingest_stats[key] for key in ('queued', 'flushed', 'dropped', 'failed', 'flushes')},
+        'rss_start_mb': round(rss_before, 1),
+        'rss_end_mb': round(rss_after, 1),
+        'rss_peak_mb': round(rss_peak, 1),
+    }
+
+    lag = report['lag_ms']
+    print(f"offered:    {args.rate or 'unthrottled'} msg/s for {args.duration:g} s to {args.devices} devices")
+    print(f"sustained:  {report['sustained_msgs_per_second']} msg/s ({sent} sent, backlog {backlog} at end of send, "
+          f"drained {report['drain_seconds']} s later){'  FELL BEHIND' if report['fell_behind'] else ''}")
+    print(f"lag:        p50 {lag['p50']} ms, p95 {lag['p95']} ms, p99 {lag['p99']} ms, max {lag['max']} ms")
+    print(f"database:   {rows} readings ({report['rows_per_second']} rows/s) in {ingest_stats['flushes']} flushes, "
+          f"{notifications} notifications")
+    print(f"dropped:    {dispatch_stats['dropped']} by the dispatcher, {ingest_stats['dropped']} by the ingestor, "
+          f"{dispatch_stats['failed'] + ingest_stats['failed']} failed")
+    print(f"RSS:        {report['rss_start_mb']} -> {report['rss_end_mb']} MiB (peak {report['rss_peak_mb']} MiB)")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+"""
+Load-test the USSD callback with concurrent multi-hop sessions
+
+Seeds a database with users, devices and today's summaries, then replays
+Africa's Talking style traffic: each session dials in and walks one of the
+menu flows below, sending the cumulative text ('', '2', '2*3', '2*3*1') on
+every hop. Sessions run concurrently through the Flask test client, or over
+HTTP against a local threaded WSGI server with --server. A share of sessions
+is abandoned mid-menu, as phones time out, so their state stays in the
+session store until it expires.
+
+Reports throughput, p50/p95/p99 latency per menu state and the growth of
+the session store.
+
+Usage:
+    python benchmarks/bench_ussd.py [--users 1000] [--sessions 5000] [--concurrency 32]
+        [--backend memory|database] [--server] [--json report.json]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Menu flows as (menu state the hop is answered in, input); '{n}' is a device number
+FLOWS = (
+    (('welcome', ''), ('main_menu', '1'), ('power_summary', '1*0'), ('main_menu', '1*0*3')),
+    (('welcome', ''), ('main_menu', '2'), ('device_list', '2*{n}'), ('device_control', '2*{n}*2')),
+    (('welcome', ''), ('main_menu', '2'), ('device_list', '2*{n}'), ('device_control', '2*{n}*1')),
+    (('welcome', ''), ('main_menu', '2'), ('device_list', '2*{n}'), ('device_control', '2*{n}*0'),
+     ('device_list', '2*{n}*0*0'), ('main_menu', '2*{n}*0*0*3')),
+    (('welcome', ''), ('main_menu', '3')),
+)
+
+
+def seed(users, devices_per_user, rng):
+    """Insert users with normalized phone numbers, their devices and today's summaries"""
+    from sqlalchemy import insert
+    from app import db
+    from app.models.device import Device
+    from app.models.power_usage import PowerSummary
+    from app.models.user import User, normalize_phone
+
+    phones = [f'+2567{i:08d}' for i in range(users)]
+    db.session.execute(insert(User), [{
+        'username': f'farmer{i}', 'email': f'farmer{i}@example.com', 'password_hash': 'x',
+        'full_name': f'Farmer {i}', 'phone_number': phone[1:], 'phone_key': normalize_phone(phone)
+    } for i, phone in enumerate(phones)])
+    user_ids = [row[0] for row in db.session.query(User.id).order_by(User.id)]
+
+    db.session.execute(insert(Device), [{
+        'name': f'{kind.title()} {j + 1}', 'device_type': kind, 'device_id': f'bench-{user_id}-{j}',
+        'location': f'Field {j % 4 + 1}', 'status': 'online', 'power_state': rng.random() < 0.5,
+        'current_power': rng.uniform(0, 1500), 'max_power': 1500.0, 'user_id': user_id,
+        'last_updated': datetime.utcnow()
+    } for user_id in user_ids for j, kind in enumerate(
+        rng.choice(('pump', 'fan', 'heater', 'light')) for _ in range(rng.randint(1, devices_per_user)))])
+
+    today = datetime.utcnow().date()
+    db.session.execute(insert(PowerSummary), [{
+        'summary_type': 'daily', 'date': today, 'device_id': row[0], 'total_energy': rng.uniform(0, 20),
+        'peak_power': rng.uniform(0, 1500), 'average_power': rng.uniform(0, 800), 'cost_estimate': rng.uniform(0, 3)
+    } for row in db.session.query(Device.id)])
+    db.session.commit()
+
+    device_counts = dict(db.session.query(Device.user_id, db.func.count(Device.id)).group_by(Device.user_id).all())
+    return [(phone, device_counts.get(user_id, 0)) for phone, user_id in zip(phones, user_ids)]
+
+
+def plan_sessions(subscribers, count, abandon, rng):
+    """Pick a subscriber, flow and device for every session; abandoned sessions stop mid-menu"""
+    sessions = []
+    for i in range(count):
+        phone, devices = rng.choice(subscribers)
+        flow = rng.choice(FLOWS if devices else FLOWS[:1] + FLOWS[-1:])
+        n = rng.randint(1, max(devices, 1))
+        hops = [(state, text.format(n=n)) for state, text in flow]
+        if len(hops) > 2 and rng.random() < abandon:
+            hops = hops[:rng.randint(1, len(hops) - 1)]
+        sessions.append((f'ATUid_bench_{i}', phone, hops))
+    return sessions
+
+
+def client_sender(app):
+    """Send callbacks through a Flask test client per thread"""
+    local = threading.local()
+
+    def send(form):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        response = local.client.post('/ussd/callback', data=form)
+        return response.status_code, response.get_data(as_text=True)
+
+    return send, lambda: None
+
+
+def server_sender(app):
+    """Send callbacks over HTTP to a local threaded WSGI server"""
+    from werkzeug.serving import make_server
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f'http://127.0.0.1:{server.server_port}/ussd/callback'
+
+    def send(form):
+        request = urllib.request.Request(url, data=urllib.parse.urlencode(form).encode())
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status, response.read().decode()
+
+    return send, server.shutdown
+
+
+def run_session(send, session_id, phone, hops, samples, errors):
+    """Walk one session's hops in order, recording (state, seconds) per hop"""
+    for state, text in hops:
+        form = {'sessionId': session_id, 'serviceCode': '*384*123#', 'phoneNumber': phone, 'text': text}
+        started = time.perf_counter()
+        try:
+            status, body = send(form)
+        except Exception as e:
+            errors.append(f'{state}: {e}')
+            return
+        samples.append((state, time.perf_counter() - started))
+
+        if status != 200 or not body.startswith(('CON ', 'END ')):
+            errors.append(f'{state}: HTTP {status} {body[:60]!r}')
+            return
+        if body.startswith('END '):
+            return
+
+
+def latency_table(samples):
+    """p50/p95/p99 in milliseconds per menu state and overall"""
+    by_state = {}
+    for state, seconds in samples:
+        by_state.setdefault(state, []).append(seconds * 1000)
+    by_state['all'] = [seconds * 1000 for _, seconds in samples]
+
+    table = {}
+    for state, values in by_state.items():
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        table[state] = {'hops': len(values), 'p50_ms': round(float(p50), 3), 'p95_ms': round(float(p95), 3),
+                        'p99_ms': round(float(p99), 3), 'max_ms': round(max(values), 3)}
+    return table
+
+
+def store_memory():
+    """Bytes currently allocated from within the session store module"""
+    if not tracemalloc.is_tracing():
+        return None
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(True, '*africastalking/sessions.py', all_frames=True)]
+    )
+    return sum(stat.size for stat in snapshot.statistics('filename'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--devices-per-user', type=int, default=6)
+    parser.add_argument('--sessions', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=32, help='Sessions in flight at once')
+    parser.add_argument('--abandon', type=float, default=0.2, help='Share of sessions left unfinished')
+    parser.add_argument('--backend', choices=('memory', 'database'), default='memory',
+                        help='USSD session store backend')
+    parser.add_argument('--server', action='store_true', help='Drive a local WSGI server over HTTP')
+    parser.add_argument('--database', help='SQLAlchemy URL of a scratch database (default: temporary SQLite file)')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Attribute allocations to the session store with tracemalloc '
+                             '(much slower, latencies are not comparable)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='Write the report to this file')
+    args = parser.parse_args()
+
+    scratch = None
+    if not args.database:
+        # A file rather than sqlite:// so concurrent requests get their own connections
+        scratch = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        scratch.close()
+        args.database = f'sqlite:///{scratch.name}'
+
+    # Read by Config when the app package is imported
+    os.environ['TEST_DATABASE_URL'] = args.database
+    os.environ['USSD_SESSION_BACKEND'] = args.backend
+
+    from app import create_app, db
+    from app.africastalking import sessions
+    from app.africastalking.snapshots import ussd_snapshots
+    from app.metrics import USSD_CALLBACK_SECONDS
+
+    app = create_app('testing')
+    # Every hop is timed here, per-hop log lines would only slow it down
+    logging.getLogger('app').setLevel(logging.ERROR)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    rng = random.Random(args.seed)
+    ctx = app.app_context()
+    ctx.push()
+    try:
+        db.create_all()
+        started = time.perf_counter()
+        subscribers = seed(args.users, args.devices_per_user, rng)
+        seed_time = time.perf_counter() - started
+        db.session.remove()
+
+        planned = plan_sessions(subscribers, args.sessions, args.abandon, rng)
+        send, shutdown = (server_sender if args.server else client_sender)(app)
+
+        if args.trace_memory:
+            tracemalloc.start(25)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        store_before = sessions.session_store.stats()
+        memory_before = store_memory()
+
+        samples = []
+        errors = []
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            for session_id, phone, hops in planned:
+                pool.submit(run_session, send, session_id, phone, hops, samples, errors)
+        elapsed = time.perf_counter() - started
+        shutdown()
+
+        store_after = sessions.session_store.stats()
+        memory_after = store_memory()
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        server_latency = USSD_CALLBACK_SECONDS.latency_summary()
+        snapshot_stats = ussd_snapshots.stats()
+    finally:
+        db.session.remove()
+        db.drop_all()
+        ctx.pop()
+        if scratch:
+            os.unlink(scratch.name)
+
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'json'},
+        'seed_seconds': round(seed_time, 2),
+        'sessions': len(planned),
+        'hops': len(samples),
+        'errors': len(errors),
+        'elapsed_seconds': round(elapsed, 3),
+        'hops_per_second': round(len(samples) / elapsed, 1),
+        'sessions_per_second': round(len(planned) / elapsed, 1),
+        'latency': latency_table(samples),
+        'server_latency': server_latency,
+        'snapshots': snapshot_stats,
+        'session_store': {
+            'before': store_before,
+            'after': store_after,
+            'traced_bytes': memory_after - memory_before if memory_after is not None else None,
+        },
+        'rss_growth_kb': rss_after - rss_before,
+    }
+
+    print(f"sessions:   {report['sessions']} ({report['hops']} hops, {len(errors)} errors) "
+          f"in {elapsed:.2f} s with {args.concurrency} concurrent, seeded {args.users} users in {seed_time:.1f} s")
+    print(f"throughput: {report['hops_per_second']} hops/s, {report['sessions_per_second']} sessions/s")
+    print(f"{'state':<16}{'hops':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for state, row in report['latency'].items():
+        print(f"{state:<16}{row['hops']:>8}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}"
+              f"{row['p99_ms']:>10.2f}{row['max_ms']:>10.2f}")
+    print(f"server p99: {report['server_latency']['p99_ms']} ms (histogram bucket bound)")
+    print(f"store:      {store_after} (before: {store_before})")
+    if report['session_store']['traced_bytes'] is not None:
+        print(f"store heap: {report['session_store']['traced_bytes'] / 1024:.1f} KiB retained by the session store")
+    print(f"RSS growth: {report['rss_growth_kb'] / 1024:.1f} MiB")
+    for error in errors[:5]:
+        print(f"error:      {error}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+
+
+if __name__ == '__main__':
+    main()
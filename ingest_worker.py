@@ -0,0 +1,23 @@
+import os
+import logging
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+from app import create_app
+from app.iot.mqtt_client import run_ingest_worker
+
+# Run the web tier with MQTT_INGEST_MODE=publish_only and scale these workers
+# independently; they split telemetry through an MQTT v5 shared subscription
+app = create_app(os.environ.get('FLASK_CONFIG', 'default'), start_mqtt=False)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+    # Deliver the alert SMS this worker queues
+    if app.config.get('SMS_SENDER_ENABLED', True):
+        from app.africastalking.outbox import setup_sms_sender
+        setup_sms_sender(app)
+
+    with app.app_context():
+        run_ingest_worker()
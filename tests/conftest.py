@@ -0,0 +1,134 @@
+import os
+
+# Use an in-memory database for tests
+os.environ.setdefault('TEST_DATABASE_URL', 'sqlite://')
+
+import pytest
+
+from app import create_app, db
+
+
+@pytest.fixture
+def app():
+    from app.api.notification_routes import notification_counts
+    from app.api.power_routes import dashboard_cache
+    from app.iot.conditions import device_state_store
+
+    app = create_app('testing')
+    notification_counts.clear()
+    dashboard_cache.clear()
+    device_state_store.clear()
+
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def user(app):
+    from app.models.user import User
+
+    user = User(
+        username='farmer',
+        email='farmer@example.com',
+        full_name='Test Farmer',
+        phone_number='256700000001',
+        password='secret'
+    )
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+@pytest.fixture
+def device(app, user):
+    from app.models.device import Device
+
+    device = Device(
+        name='Irrigation Pump',
+        device_type='pump',
+        device_id='pump-1',
+        max_power=1500.0,
+        user_id=user.id
+    )
+    db.session.add(device)
+    db.session.commit()
+    return device
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def auth_headers(app, user):
+    import datetime
+    import jwt
+
+    token = jwt.encode(
+        {'user_id': user.id, 'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1)},
+        app.config['SECRET_KEY'],
+        algorithm="HS256"
+    )
+    return {'Authorization': f'Bearer {token}'}
+
+
+class FakeATSMS:
+    """Local stand-in for the africastalking SMS client"""
+
+    def __init__(self):
+        self.calls = []
+        self.statuses = {}   # number -> (statusCode, status) for numbers that should not succeed
+        self.errors = []     # exceptions raised by the next calls
+
+    def send(self, message, recipients):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.calls.append((message, list(recipients)))
+        results = []
+        for number in recipients:
+            code, status = self.statuses.get(number, (101, 'Success'))
+            results.append({'number': number, 'statusCode': code, 'status': status,
+                            'messageId': f'ATXid_{len(self.calls)}_{number}', 'cost': 'UGX 30.0000'})
+        return {'SMSMessageData': {'Message': f'Sent to {len(results)}', 'Recipients': results}}
+
+
+@pytest.fixture
+def fake_sms(monkeypatch):
+    """Replace the africastalking SDK with FakeATSMS, counting initializations"""
+    import africastalking
+
+    fake = FakeATSMS()
+    fake.initialized = 0
+
+    def initialize(username, api_key):
+        fake.initialized += 1
+
+    monkeypatch.setattr(africastalking, 'initialize', initialize)
+    monkeypatch.setattr(africastalking, 'SMS', fake, raising=False)
+    return fake
+
+
+class FakeRedis:
+    """Local stand-in for the Redis commands used by the session store"""
+
+    def __init__(self):
+        self.values = {}
+        self.now = 0.0   # advanced by tests instead of sleeping
+
+    def get(self, key):
+        value = self.values.get(key)
+        if value is None or value[1] <= self.now:
+            self.values.pop(key, None)
+            return None
+        return value[0].encode()
+
+    def setex(self, key, seconds, value):
+        self.values[key] = (value, self.now + seconds)
+        return True
+
+    def delete(self, key):
+        return 1 if self.values.pop(key, None) is not None else 0
@@ -0,0 +1,522 @@
+import csv
+import gzip
+import io
+import json
+from datetime import datetime, timedelta
+
+from app.iot.ingest import build_sample, write_telemetry_batch
+
+
+def test_device_power_analytics(client, auth_headers, device):
+    start = datetime.utcnow() - timedelta(hours=1)
+    write_telemetry_batch([
+        build_sample('pump-1', {"power": power, "voltage": 230, "current": power / 230}, start + timedelta(seconds=s))
+        for power, s in ((0, 0), (400, 60), (400, 120), (0, 1000))
+    ])
+
+    response = client.get(f'/api/power/devices/{device.id}/analytics?max_gap=600', headers=auth_headers)
+
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data["total_readings"] == 4
+    assert data["max_power"] == 400
+    assert len(data["gaps"]) == 1
+    assert 0 < data["duty_cycle"] < 1
+
+
+def test_device_power_analytics_requires_ownership(client, auth_headers):
+    response = client.get('/api/power/devices/999/analytics', headers=auth_headers)
+    assert response.status_code == 404
+
+
+def seed_readings(count, start=None):
+    start = start or datetime.utcnow() - timedelta(hours=1)
+    # Pairs of readings share a timestamp so the id tie-breaker is exercised
+    write_telemetry_batch([
+        build_sample('pump-1', {"power": float(i), "voltage": 230, "current": 1}, start + timedelta(seconds=i // 2))
+        for i in range(count)
+    ])
+
+
+def test_export_readings_resumes_from_cursor(client, auth_headers, device):
+    seed_readings(25)
+
+    rows = []
+    after = ''
+    for _ in range(5):
+        response = client.get(f'/api/power/readings/export?limit=10&after={after}', headers=auth_headers)
+        assert response.status_code == 200
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        if lines and 'next_cursor' in lines[-1]:
+            after = lines.pop()['next_cursor']
+            rows.extend(lines)
+        else:
+            rows.extend(lines)
+            break
+
+    assert [row['power_usage'] for row in rows] == [float(i) for i in range(25)]
+    assert len({row['id'] for row in rows}) == 25
+
+
+def test_export_readings_csv_gzip(client, auth_headers, device):
+    seed_readings(5)
+
+    response = client.get('/api/power/readings/export?format=csv&gzip=true', headers=auth_headers)
+
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    text = gzip.decompress(response.get_data()).decode('utf-8')
+    rows = list(csv.DictReader(io.StringIO(text)))
+    assert len(rows) == 5
+    assert rows[0]['device_id'] == str(device.id)
+
+
+def test_export_readings_rejects_bad_cursor(client, auth_headers, device):
+    response = client.get('/api/power/readings/export?after=bogus', headers=auth_headers)
+    assert response.status_code == 400
+
+
+def test_readings_cursor_pagination(client, auth_headers, device):
+    seed_readings(7)
+
+    seen = []
+    url = '/api/power/readings?limit=3'
+    while url:
+        data = client.get(url, headers=auth_headers).get_json()
+        seen.extend(reading['power_usage'] for reading in data['readings'])
+        url = f"/api/power/readings?limit=3&after={data['next_cursor']}" if data['next_cursor'] else None
+
+    assert seen == [float(i) for i in reversed(range(7))]
+
+
+def test_notifications_cursor_pagination_and_counts(app, client, auth_headers, user):
+    from app import db
+    from app.models.notification import Notification
+
+    now = datetime.utcnow()
+    db.session.add_all([
+        Notification(title=f'n{i}', message='m', notification_type='info', user_id=user.id,
+                     is_read=i % 2 == 0, timestamp=now - timedelta(minutes=i // 2))
+        for i in range(5)
+    ])
+    db.session.commit()
+
+    first = client.get('/api/notifications?limit=2', headers=auth_headers).get_json()
+    assert first['total_count'] == 5
+    assert first['unread_count'] == 2
+
+    titles = [n['title'] for n in first['notifications']]
+    after = first['next_cursor']
+    while after:
+        page = client.get(f'/api/notifications?limit=2&count=none&after={after}', headers=auth_headers).get_json()
+        assert page['total_count'] is None
+        titles.extend(n['title'] for n in page['notifications'])
+        after = page['next_cursor']
+    assert sorted(titles) == [f'n{i}' for i in range(5)]
+
+    # Approximate counts are served from the cache until it is invalidated
+    db.session.add(Notification(title='late', message='m', notification_type='info', user_id=user.id))
+    db.session.commit()
+    assert client.get('/api/notifications?count=approx', headers=auth_headers).get_json()['total_count'] == 5
+    client.post('/api/notifications/read-all', headers=auth_headers)
+    approx = client.get('/api/notifications?count=approx', headers=auth_headers).get_json()
+    assert approx['total_count'] == 6
+    assert approx['unread_count'] == 0
+
+
+def test_notifications_offset_pagination(client, auth_headers, user):
+    from app import db
+    from app.models.notification import Notification
+
+    now = datetime.utcnow()
+    db.session.add_all([
+        Notification(title=f'n{i}', message='m', notification_type='info', user_id=user.id,
+                     timestamp=now - timedelta(minutes=i))
+        for i in range(5)
+    ])
+    db.session.commit()
+
+    response = client.get('/api/notifications?limit=2&offset=1', headers=auth_headers)
+    assert response.status_code == 200
+    page = response.get_json()
+    assert [n['title'] for n in page['notifications']] == ['n1', 'n2']
+    assert page['next_cursor'] is not None
+
+    last = client.get('/api/notifications?limit=2&offset=4', headers=auth_headers).get_json()
+    assert [n['title'] for n in last['notifications']] == ['n4']
+    assert last['next_cursor'] is None
+
+
+class FakePublishInfo:
+    def __init__(self, publisher):
+        self.publisher = publisher
+        self.rc = 0
+        self.published = False
+
+    def wait_for_publish(self, timeout=None):
+        if not self.published:
+            self.published = True
+            self.publisher.in_flight -= 1
+
+    def is_published(self):
+        return self.published
+
+
+class FakePublisher:
+    """MQTT client stand-in that tracks unacknowledged publishes"""
+
+    def __init__(self, fail_topics=()):
+        self.fail_topics = set(fail_topics)
+        self.messages = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def publish(self, topic, payload, qos=0):
+        if topic in self.fail_topics:
+            raise OSError('connection lost')
+        self.messages.append((topic, json.loads(payload)))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return FakePublishInfo(self)
+
+
+def test_bulk_control_by_selector_limits_in_flight(app, client, auth_headers, user, monkeypatch):
+    from app import db
+    from app.iot import mqtt_client
+    from app.models.device import Device
+
+    db.session.add_all([
+        Device(name=f'pump-{i}', device_type='pump' if i < 12 else 'fan', device_id=f'dev-{i}', user_id=user.id)
+        for i in range(15)
+    ])
+    db.session.commit()
+
+    publisher = FakePublisher(fail_topics={'smart-farm/control/dev-3'})
+    monkeypatch.setattr(mqtt_client, 'mqtt_client', publisher)
+    app.config['MQTT_CONTROL_MAX_IN_FLIGHT'] = 5
+
+    response = client.post('/api/devices/control', headers=auth_headers, json={
+        'command': 'power', 'value': 'off', 'selector': {'device_type': 'pump'}
+    })
+
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['succeeded'] == 11
+    assert data['failed'] == 1
+    assert len(publisher.messages) == 11
+    assert publisher.max_in_flight <= 5
+
+    states = dict(db.session.query(Device.device_id, Device.power_state))
+    assert states['dev-3'] is not True
+    assert not any(states[f'dev-{i}'] for i in range(12))
+
+
+def test_bulk_control_only_reaches_own_devices(client, auth_headers, device, monkeypatch):
+    from app.iot import mqtt_client
+
+    monkeypatch.setattr(mqtt_client, 'mqtt_client', FakePublisher())
+
+    response = client.post('/api/devices/control', headers=auth_headers, json={
+        'command': 'power', 'value': True, 'device_ids': [device.id, 999]
+    })
+
+    results = response.get_json()['results']
+    assert results[str(device.id)]['success'] is True
+    assert results['999'] == {'device_id': None, 'success': False, 'error': 'Device not found'}
+
+    response = client.post('/api/devices/control', headers=auth_headers, json={
+        'command': 'power', 'value': True, 'selector': {'user_id': device.user_id + 1}
+    })
+    assert response.status_code == 403
+
+
+def test_bulk_control_rejects_malformed_targets(client, auth_headers, device):
+    for body in ({'selector': ['device_type']}, {'selector': 'pump'}, {'selector': {'name': 'x'}},
+                 {'selector': {'location': ['Field 1']}}, {'selector': {'user_id': True}},
+                 {'device_ids': [True]}, {'device_ids': ['1']}, {'device_ids': 1}):
+        response = client.post('/api/devices/control', headers=auth_headers,
+                               json=dict(body, command='power', value=True))
+        assert response.status_code == 400, body
+
+
+def test_control_waits_for_device_confirmation(app, client, auth_headers, device, monkeypatch):
+    import threading
+    from app.iot import commands, mqtt_client
+    from app.iot.commands import CommandTracker
+
+    tracker = CommandTracker(app, ack_timeout=5.0)
+    monkeypatch.setattr(commands, 'command_tracker', tracker)
+
+    class AckingPublisher(FakePublisher):
+        """Device that reports its new state shortly after each command"""
+
+        def publish(self, topic, payload, qos=0):
+            cid = json.loads(payload)["cid"]
+            threading.Timer(0.05, tracker.acknowledge, ('pump-1', {"cid": cid, "power_state": True})).start()
+            return super().publish(topic, payload, qos)
+
+    publisher = AckingPublisher()
+    monkeypatch.setattr(mqtt_client, 'mqtt_client', publisher)
+
+    response = client.post(f'/api/devices/{device.id}/control', headers=auth_headers,
+                           json={'command': 'power', 'value': 'on', 'wait': True, 'timeout': 2})
+    assert response.status_code == 200
+    assert response.get_json()['command']['status'] == 'confirmed'
+
+    # No acknowledgement within the deadline
+    monkeypatch.setattr(mqtt_client, 'mqtt_client', FakePublisher())
+    response = client.post(f'/api/devices/{device.id}/control', headers=auth_headers,
+                           json={'command': 'power', 'value': 'off', 'wait': True, 'timeout': 0.1})
+    assert response.status_code == 504
+    assert response.get_json()['command']['status'] == 'pending'
+
+
+def test_settings_updates_invalidate_settings_cache(client, auth_headers, user):
+    from app.iot.user_settings import settings_cache
+
+    assert settings_cache.get(user.id).has_settings is False
+    invalidations = settings_cache.stats()["invalidations"]
+
+    response = client.put('/api/user/notification-settings', json={'power_threshold_warning': 650},
+                          headers=auth_headers)
+    assert response.status_code == 200
+    assert settings_cache.get(user.id).power_threshold_warning == 650
+
+    response = client.put('/api/user/profile', json={'phone_number': '256700000009'}, headers=auth_headers)
+    assert response.status_code == 200
+    assert settings_cache.get(user.id).phone_number == '256700000009'
+    assert settings_cache.stats()["invalidations"] == invalidations + 2
+
+
+def test_event_stream_pushes_ingested_power_and_notifications(app, client, auth_headers, device):
+    app.config['EVENTS_KEEPALIVE'] = 0.05
+    app.config['EVENTS_STREAM_TIMEOUT'] = 5
+
+    response = client.get('/api/events', headers=auth_headers, buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+
+    frames = iter(response.response)
+    assert next(frames).decode().startswith('retry:')
+
+    # 1500W crosses the default critical threshold, so an alert is written too
+    write_telemetry_batch([build_sample('pump-1', {"power": 1500, "voltage": 230, "current": 6.5})])
+
+    frame = next(frames).decode()
+    assert frame.startswith('event: power\n')
+    power = json.loads(frame.split('data: ', 1)[1])
+    assert power["data"]["devices"][0]["id"] == device.id
+    assert power["data"]["devices"][0]["current_power"] == 1500
+
+    frame = next(frames).decode()
+    assert frame.startswith('event: notification\n')
+    notification = json.loads(frame.split('data: ', 1)[1])["data"]["notifications"][0]
+    assert notification["notification_type"] == "alert"
+    assert notification["device_id"] == device.id
+
+    assert next(frames).decode() == ': keepalive\n\n'
+    response.close()
+
+
+def test_power_dashboard_sums_user_summaries_and_supports_etag(client, auth_headers, user, device):
+    from app import db
+    from app.models.device import Device
+    from app.models.power_usage import PowerSummary
+
+    other = Device(name='Neighbour Pump', device_type='pump', device_id='other-1', user_id=user.id + 1)
+    db.session.add(other)
+    db.session.flush()
+
+    today = datetime.utcnow().date()
+    for device_pk, energy in ((device.id, 2.0), (other.id, 50.0), (None, 99.0)):
+        for day in (1, 3):
+            db.session.add(PowerSummary(summary_type='daily', date=today - timedelta(days=day), device_id=device_pk,
+                                        total_energy=energy, peak_power=100.0, average_power=50.0, cost_estimate=0.3))
+    db.session.commit()
+
+    # Today is not summarized yet, so yesterday's figures are shown
+    response = client.get('/api/power/dashboard', headers=auth_headers)
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['today']['total_energy'] == 2.0
+    assert [day['date'] for day in data['last_7_days']] == [
+        (today - timedelta(days=1)).isoformat(), (today - timedelta(days=3)).isoformat()
+    ]
+    assert [d['name'] for d in data['current_power']['devices']] == ['Irrigation Pump']
+
+    etag = response.headers['ETag']
+    cached = client.get('/api/power/dashboard', headers=dict(auth_headers, **{'If-None-Match': etag}))
+    assert cached.status_code == 304
+
+    # Device changes invalidate the cached dashboard
+    client.put(f'/api/devices/{device.id}', json={'name': 'Main Pump'}, headers=auth_headers)
+    changed = client.get('/api/power/dashboard', headers=dict(auth_headers, **{'If-None-Match': etag}))
+    assert changed.status_code == 200
+    assert changed.get_json()['current_power']['devices'][0]['name'] == 'Main Pump'
+
+
+def test_dashboard_device_control_invalidates_power_dashboard(client, auth_headers, user, device, monkeypatch):
+    from app.iot import mqtt_client
+
+    monkeypatch.setattr(mqtt_client, 'mqtt_client', FakePublisher())
+    first = client.get('/api/power/dashboard', headers=auth_headers)
+    assert first.get_json()['current_power']['devices'][0]['power_state'] is False
+
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+    response = client.post(f'/dashboard/api/device/{device.id}/control', json={'command': 'power', 'value': 'on'})
+    assert response.status_code == 200
+
+    changed = client.get('/api/power/dashboard', headers=dict(auth_headers, **{'If-None-Match': first.headers['ETag']}))
+    assert changed.status_code == 200
+    assert changed.get_json()['current_power']['devices'][0]['power_state'] is True
+
+
+def ussd(client, session_id, text):
+    response = client.post('/ussd/callback', data={
+        'sessionId': session_id, 'serviceCode': '*123#', 'phoneNumber': '+256700000001', 'text': text
+    })
+    assert response.status_code == 200
+    return response.get_data(as_text=True)
+
+
+def test_ussd_session_survives_across_workers_with_database_store(app, client, device, monkeypatch):
+    from app.africastalking import sessions
+    from app.models.ussd_session import USSDSessionRecord
+
+    # Each hop is served by a "worker" with its own store instance over the shared table
+    def next_worker():
+        monkeypatch.setattr(sessions, 'session_store', sessions.DatabaseSessionStore(ttl=180))
+
+    next_worker()
+    assert ussd(client, 'ATUid_1', '').startswith('CON Welcome to Smart Farm Power Control, Test Farmer')
+    next_worker()
+    assert 'Irrigation Pump [OFF]' in ussd(client, 'ATUid_1', '2')
+    next_worker()
+    assert ussd(client, 'ATUid_1', '2*1').startswith('CON Device: Irrigation Pump')
+    next_worker()
+    assert ussd(client, 'ATUid_1', '2*1*1') == "END Device 'Irrigation Pump' has been turned ON."
+
+    # Ended sessions are removed
+    assert USSDSessionRecord.query.count() == 0
+
+
+def test_session_stores_expire_and_stay_bounded(app, monkeypatch):
+    from app.africastalking import sessions
+    from tests.conftest import FakeRedis
+
+    clock = [1000.0]
+    monkeypatch.setattr(sessions.time, 'monotonic', lambda: clock[0])
+
+    memory = sessions.MemorySessionStore(ttl=60, max_size=3)
+    for i in range(5):
+        memory.set(f's{i}', {'state': 'welcome', 'hop': i})
+    assert memory.get('s0') is None and memory.get('s4') == {'state': 'welcome', 'hop': 4}
+    assert memory.stats()['sessions'] == 3 and memory.stats()['evicted'] == 2
+
+    clock[0] += 30
+    memory.set('s2', {'state': 'main_menu'})
+    clock[0] += 31
+    assert memory.sweep() == 2
+    assert memory.get('s2') == {'state': 'main_menu'}
+
+    database = sessions.DatabaseSessionStore(ttl=60)
+    database.set('d1', {'state': 'device_list'})
+    assert database.get('d1') == {'state': 'device_list'}
+    assert database.delete('d1') and database.get('d1') is None
+
+    fake = FakeRedis()
+    redis_store = sessions.RedisSessionStore(fake, ttl=60)
+    redis_store.set('r1', {'state': 'device_control', 'selected_device': 7})
+    assert redis_store.get('r1') == {'state': 'device_control', 'selected_device': 7}
+    fake.now += 61
+    assert redis_store.get('r1') is None
+
+
+def test_ussd_hops_are_served_from_the_snapshot(app, client, device):
+    from sqlalchemy import event
+    from app.africastalking.snapshots import ussd_snapshots
+    from app.metrics import USSD_CALLBACK_SECONDS
+    from app.iot.ingest import build_sample, write_telemetry_batch
+    from app.models.power_usage import PowerSummary
+    from app.models.user import normalize_phone
+    from app import db
+
+    assert normalize_phone('+256 700-000001') == normalize_phone('00256700000001') == '256700000001'
+
+    db.session.add(PowerSummary(summary_type='daily', date=datetime.utcnow().date(), device_id=device.id,
+                                total_energy=4.5, peak_power=900.0, average_power=300.0, cost_estimate=0.68))
+    db.session.commit()
+
+    # The first hop resolves the number and loads the snapshot
+    assert ussd(client, 'ATUid_2', '').startswith('CON Welcome to Smart Farm Power Control, Test Farmer')
+    assert ussd(client, 'ATUid_3', '').startswith('CON Welcome')
+    count = USSD_CALLBACK_SECONDS.latency_summary()["count"]
+
+    # Telemetry is applied to the cached snapshot
+    write_telemetry_batch([build_sample('pump-1', {'power': 420.0, 'voltage': 230.0, 'current': 1.8})])
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        assert 'Total Usage: 4.50 kWh' in ussd(client, 'ATUid_2', '1')
+        assert 'Irrigation Pump [OFF]' in ussd(client, 'ATUid_3', '2')
+        assert 'Current Power: 420.00 W' in ussd(client, 'ATUid_3', '2*1')
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    assert statements == []
+
+    # Toggling writes the state once and updates the snapshot
+    assert ussd(client, 'ATUid_3', '2*1*1') == "END Device 'Irrigation Pump' has been turned ON."
+    assert ussd_snapshots.get(device.user_id).devices[0].power_state is True
+    db.session.refresh(device)
+    assert device.power_state is True
+
+    assert USSD_CALLBACK_SECONDS.latency_summary()["count"] == count + 4
+    assert USSD_CALLBACK_SECONDS.latency_summary()["p99_ms"] is not None
+
+
+def test_ussd_finds_users_created_before_phone_key(app, client, device):
+    from sqlalchemy import update
+    from app.models.user import User
+    from app import db
+
+    # Rows written before the phone_key column existed
+    db.session.execute(update(User).values(phone_key=None))
+    db.session.commit()
+
+    assert ussd(client, 'ATUid_legacy', '').startswith('CON Welcome to Smart Farm Power Control, Test Farmer')
+    assert db.session.get(User, device.user_id).phone_key == '256700000001'
+
+    db.session.execute(update(User).values(phone_key=None))
+    db.session.commit()
+    result = app.test_cli_runner().invoke(args=['backfill-phone-keys'])
+    assert result.exit_code == 0 and 'Updated 1 users' in result.output
+    assert User.query.filter(User.phone_key.is_(None)).count() == 0
+
+
+def test_metrics_endpoint_exposes_request_and_ussd_latency(app, client, auth_headers, device):
+    client.get('/api/devices', headers=auth_headers)
+    ussd(client, 'ATUid_metrics', '')
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+
+    assert '# TYPE smart_farm_http_request_seconds histogram' in text
+    assert ('smart_farm_http_request_seconds_count{blueprint="api",endpoint="api.get_devices",'
+            'method="GET",status="200"}') in text
+    assert 'smart_farm_ussd_callback_seconds_count{state="welcome"}' in text
+    assert 'smart_farm_cache_entries{cache="ussd_snapshots"} 1' in text
+
+    # USSD and the metrics endpoint itself are not timed as API requests
+    assert 'endpoint="metrics.metrics"' not in text
+
+    app.config['METRICS_TOKEN'] = 'scrape-secret'
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer scrape-secret'}).status_code == 200
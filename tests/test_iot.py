@@ -0,0 +1,1113 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import db
+from app.iot.ingest import TelemetryIngestor, build_sample, write_telemetry_batch
+from app.models.device import Device
+from app.models.power_usage import PowerReading
+
+
+def telemetry(power, voltage=230.0, current=None):
+    return {"power": power, "voltage": voltage, "current": current if current is not None else power / voltage}
+
+
+def test_build_sample_requires_power():
+    assert build_sample('pump-1', {"voltage": 230}) is None
+
+    sample = build_sample('pump-1', {"power": 100})
+    assert sample.power == 100.0
+    assert not sample.is_reading
+
+
+def test_write_batch_inserts_readings_and_coalesces_device_power(app, device):
+    start = datetime.utcnow()
+    samples = [
+        build_sample('pump-1', telemetry(100), start),
+        build_sample('pump-1', telemetry(300), start + timedelta(seconds=5)),
+        build_sample('pump-1', telemetry(200), start + timedelta(seconds=10)),
+        build_sample('unknown', telemetry(50), start),
+    ]
+
+    assert write_telemetry_batch(samples) == 3
+
+    readings = PowerReading.query.order_by(PowerReading.timestamp).all()
+    assert [r.power_usage for r in readings] == [100, 300, 200]
+    assert db.session.get(Device, device.id).current_power == 200
+
+
+def test_ingestor_flushes_on_size_and_counts(app, device):
+    ingestor = TelemetryIngestor(app, flush_size=2, flush_interval=0.01)
+
+    for power in (10, 20, 30):
+        assert ingestor.submit(build_sample('pump-1', telemetry(power)))
+
+    ingestor.drain()
+
+    stats = ingestor.stats()
+    assert stats["queued"] == 3
+    assert stats["flushed"] == 3
+    assert stats["flushes"] == 2
+    assert stats["dropped"] == 0
+    assert PowerReading.query.count() == 3
+
+
+def test_ingestor_drops_when_queue_full(app, device):
+    ingestor = TelemetryIngestor(app, max_queue_size=2, enqueue_timeout=0)
+
+    results = [ingestor.submit(build_sample('pump-1', telemetry(p))) for p in (1, 2, 3)]
+
+    assert results == [True, True, False]
+    assert ingestor.stats()["dropped"] == 1
+
+
+def test_ingestor_background_flush_on_interval(app, device):
+    ingestor = TelemetryIngestor(app, flush_size=100, flush_interval=0.05)
+    ingestor.start()
+    try:
+        ingestor.submit(build_sample('pump-1', telemetry(42)))
+
+        deadline = time.time() + 2
+        while ingestor.stats()["flushed"] < 1 and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        ingestor.stop()
+
+    assert ingestor.stats()["flushed"] == 1
+    assert PowerReading.query.count() == 1
+
+
+def test_ingestor_retries_failed_writes_and_ignores_post_commit_errors(app, device, monkeypatch):
+    from sqlalchemy.exc import OperationalError
+    from app.iot import ingest, mqtt_client
+
+    store = ingest.store_telemetry_batch
+    attempts = []
+
+    def locked_once(samples):
+        attempts.append(len(samples))
+        if len(attempts) == 1:
+            raise OperationalError('INSERT', {}, Exception('database is locked'))
+        return store(samples)
+
+    def broken_thresholds(device, power_usage):
+        raise RuntimeError('alert engine down')
+
+    monkeypatch.setattr(ingest, 'store_telemetry_batch', locked_once)
+    monkeypatch.setattr(mqtt_client, 'check_power_thresholds', broken_thresholds)
+
+    ingestor = TelemetryIngestor(app, flush_size=10, retry_backoff=0)
+    for power in (1500, 1600):
+        ingestor.submit(build_sample('pump-1', telemetry(power)))
+    ingestor.drain()
+
+    stats = ingestor.stats()
+    assert attempts == [2, 2]
+    assert (stats["flushed"], stats["failed"], stats["retries"]) == (2, 0, 1)
+    assert PowerReading.query.count() == 2
+
+
+def test_registry_caches_known_and_unknown_devices(app, device):
+    from app.iot.device_registry import DeviceRegistry
+
+    registry = DeviceRegistry()
+
+    entry = registry.get('pump-1')
+    assert entry.id == device.id
+    assert entry.user_id == device.user_id
+    assert registry.get('pump-1') is entry
+
+    assert registry.get('rogue') is None
+    assert registry.get('rogue') is None
+
+    stats = registry.stats()
+    assert stats["misses"] == 2
+    assert stats["hits"] == 1
+    assert stats["negative_hits"] == 1
+
+
+def test_registry_expires_and_evicts(app, device):
+    from app.iot.device_registry import DeviceRegistry
+
+    registry = DeviceRegistry(max_size=2, ttl=0.05, negative_ttl=0.05)
+    registry.get('pump-1')
+    registry.get('a')
+    registry.get('b')
+
+    assert registry.stats()["size"] == 2
+    assert registry.stats()["evictions"] == 1
+
+    time.sleep(0.06)
+    registry.get('b')
+    assert registry.stats()["misses"] == 4
+
+
+def test_registry_invalidate_picks_up_new_device(app, user):
+    from app.iot.device_registry import DeviceRegistry
+
+    registry = DeviceRegistry()
+    assert registry.get('fan-1') is None
+
+    db.session.add(Device(name='Fan', device_type='fan', device_id='fan-1', user_id=user.id))
+    db.session.commit()
+    assert registry.get('fan-1') is None
+
+    registry.invalidate('fan-1')
+    assert registry.get('fan-1').name == 'Fan'
+
+
+def test_dispatcher_keeps_per_device_order_with_app_context(app):
+    import threading
+    from flask import has_app_context
+    from app.iot.dispatcher import MessageDispatcher
+
+    handled = []
+
+    def handler(topic, data):
+        assert has_app_context()
+        handled.append((data["device"], data["seq"], threading.current_thread().name))
+
+    dispatcher = MessageDispatcher(app, handler, workers=3)
+    dispatcher.start()
+    try:
+        for seq in range(50):
+            for device_id in ('pump-1', 'fan-1', 'light-1'):
+                payload = f'{{"device": "{device_id}", "seq": {seq}}}'.encode()
+                assert dispatcher.dispatch(device_id, f"smart-farm/telemetry/{device_id}", payload)
+    finally:
+        dispatcher.stop()
+
+    for device_id in ('pump-1', 'fan-1', 'light-1'):
+        seqs = [seq for device, seq, _ in handled if device == device_id]
+        threads = {thread for device, _, thread in handled if device == device_id}
+        assert seqs == list(range(50))
+        assert threads == {f"mqtt-worker-{dispatcher.worker_for(device_id)}"}
+
+    stats = dispatcher.stats()
+    assert stats["processed"] == 150
+    assert stats["queue_depth"] == 0
+    assert set(stats["latency_ms"]) == {"queue", "decode", "handle"}
+
+
+def test_device_id_from_topic():
+    from app.iot.mqtt_client import device_id_from_topic
+
+    assert device_id_from_topic("smart-farm/telemetry/pump-1") == "pump-1"
+    assert device_id_from_topic("smart-farm/devices/pump-1/status") == "pump-1"
+
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class FakeBroker:
+    """Local broker stand-in with MQTT v5 shared subscription delivery"""
+
+    def __init__(self):
+        self.subscriptions = []
+        self.next_member = {}
+
+    def connect(self, topics):
+        from app.iot.mqtt_client import on_connect, on_message
+
+        client = FakeClient(self, on_message)
+        on_connect(client, {"topics": topics}, {}, 0)
+        return client
+
+    def publish(self, topic, payload):
+        import paho.mqtt.client as mqtt
+
+        groups = {}
+        for client, topic_filter in self.subscriptions:
+            if topic_filter.startswith("$share/"):
+                _, group, shared_filter = topic_filter.split("/", 2)
+                if mqtt.topic_matches_sub(shared_filter, topic):
+                    groups.setdefault((group, shared_filter), []).append(client)
+            elif mqtt.topic_matches_sub(topic_filter, topic):
+                client.deliver(topic, payload)
+
+        # Each shared group gets one copy, delivered round robin
+        for key, members in groups.items():
+            index = self.next_member.get(key, 0)
+            self.next_member[key] = index + 1
+            members[index % len(members)].deliver(topic, payload)
+
+
+class FakeClient:
+    def __init__(self, broker, on_message):
+        self.broker = broker
+        self.on_message = on_message
+        self.received = 0
+
+    def subscribe(self, topic, qos=0):
+        self.broker.subscriptions.append((self, topic))
+
+    def deliver(self, topic, payload):
+        self.received += 1
+        self.on_message(self, None, FakeMessage(topic, payload))
+
+
+def publish_telemetry(broker, count):
+    for i in range(count):
+        broker.publish("smart-farm/telemetry/pump-1", f'{{"power": {i}, "voltage": 230, "current": 1}}'.encode())
+
+
+def test_shared_subscription_persists_each_message_once(app, device):
+    from app.iot.mqtt_client import INGEST_SHARED, subscription_topics
+
+    broker = FakeBroker()
+    workers = [broker.connect(subscription_topics(INGEST_SHARED, "ingest")) for _ in range(3)]
+
+    publish_telemetry(broker, 30)
+
+    assert PowerReading.query.count() == 30
+    assert [worker.received for worker in workers] == [10, 10, 10]
+
+
+def test_plain_subscription_duplicates_across_workers(app, device):
+    from app.iot.mqtt_client import INGEST_EMBEDDED, INGEST_PUBLISH_ONLY, subscription_topics
+
+    broker = FakeBroker()
+    broker.connect(subscription_topics(INGEST_EMBEDDED))
+    broker.connect(subscription_topics(INGEST_EMBEDDED))
+    broker.connect(subscription_topics(INGEST_PUBLISH_ONLY))
+
+    publish_telemetry(broker, 5)
+
+    assert PowerReading.query.count() == 10
+
+
+def raw_power_stats(device_id, start_time):
+    readings = PowerReading.query.filter(
+        PowerReading.device_id == device_id,
+        PowerReading.timestamp >= start_time
+    ).order_by(PowerReading.timestamp).all()
+
+    power = [r.power_usage for r in readings]
+    energy = 0
+    for i in range(1, len(readings)):
+        hours = (readings[i].timestamp - readings[i - 1].timestamp).total_seconds() / 3600
+        energy += (readings[i].power_usage + readings[i - 1].power_usage) / 2 * hours / 1000
+
+    return len(power), sum(power) / len(power), max(power), min(power), energy
+
+
+def seed_telemetry(start, count, step_seconds=37):
+    import random
+
+    rng = random.Random(7)
+    samples = [
+        build_sample('pump-1', telemetry(rng.uniform(50, 900)), start + timedelta(seconds=i * step_seconds))
+        for i in range(count)
+    ]
+    # Deliver in batches, like the ingestor does
+    for i in range(0, count, 100):
+        write_telemetry_batch(samples[i:i + 100])
+
+
+def assert_stats_match_raw(stats, device_id, start_time):
+    import pytest
+
+    count, average, peak, low, energy = raw_power_stats(device_id, start_time)
+    assert stats["total_readings"] == count
+    assert stats["average_power"] == pytest.approx(average)
+    assert stats["max_power"] == peak
+    assert stats["min_power"] == low
+    assert stats["total_energy"] == pytest.approx(energy, rel=1e-9)
+
+
+def test_power_stats_from_rollups_match_raw_readings(app, device, monkeypatch):
+    from app.iot import sensor_data
+    from app.iot.sensor_data import get_device_power_stats
+
+    now = datetime(2026, 3, 10, 12, 0, 17)
+    seed_telemetry(now - timedelta(days=8), 10000, step_seconds=70)
+
+    class FrozenDatetime(datetime):
+        @classmethod
+        def utcnow(cls):
+            return now
+
+    monkeypatch.setattr(sensor_data, 'datetime', FrozenDatetime)
+
+    day = get_device_power_stats(device.id, "day")
+    assert day["resolution"] == 60
+    assert_stats_match_raw(day, device.id, now - timedelta(days=1))
+
+    week = get_device_power_stats(device.id, "week")
+    assert week["resolution"] == 3600
+    assert_stats_match_raw(week, device.id, now - timedelta(weeks=1))
+
+
+def test_power_stats_read_raw_history_until_backfilled(app, device, monkeypatch):
+    from app.iot import rollups, sensor_data
+    from app.iot.sensor_data import get_device_power_stats
+    from app.models.power_usage import PowerReadingRollup
+
+    now = datetime(2026, 3, 10, 12, 0, 17)
+    seed_telemetry(now - timedelta(days=3), 4000, step_seconds=70)
+
+    # Readings from before rollups were maintained: only the last hours have buckets
+    PowerReadingRollup.query.filter(PowerReadingRollup.bucket_start < now - timedelta(hours=5)).delete()
+    db.session.commit()
+
+    class FrozenDatetime(datetime):
+        @classmethod
+        def utcnow(cls):
+            return now
+
+    monkeypatch.setattr(sensor_data, 'datetime', FrozenDatetime)
+    monkeypatch.setattr(rollups, 'datetime', FrozenDatetime)
+    assert_stats_match_raw(get_device_power_stats(device.id, "day"), device.id, now - timedelta(days=1))
+    assert_stats_match_raw(get_device_power_stats(device.id, "week"), device.id, now - timedelta(weeks=1))
+
+    result = app.test_cli_runner().invoke(args=['rebuild-rollups', '--days', '4'])
+    assert result.exit_code == 0 and "Rolled up 4000 readings" in result.output
+    week = get_device_power_stats(device.id, "week")
+    assert len(week["readings"]) < 100
+    assert_stats_match_raw(week, device.id, now - timedelta(weeks=1))
+
+
+def test_late_sample_rebuilds_bucket_and_backfill_matches(app, device):
+    from app.iot.rollups import rebuild_rollups
+    from app.models.power_usage import PowerReadingRollup
+
+    start = datetime(2026, 3, 10, 8, 0, 0)
+    write_telemetry_batch([build_sample('pump-1', telemetry(p), start + timedelta(seconds=s))
+                           for p, s in ((100, 0), (300, 20), (200, 40))])
+    write_telemetry_batch([build_sample('pump-1', telemetry(500), start + timedelta(seconds=10))])
+
+    def snapshot():
+        return [(r.resolution, r.bucket_start, r.sample_count, r.power_max, round(r.energy, 12))
+                for r in PowerReadingRollup.query.order_by(PowerReadingRollup.resolution)]
+
+    incremental = snapshot()
+    assert incremental[0][2] == 4
+    assert incremental[0][3] == 500
+
+    assert rebuild_rollups(start, start) == 4
+    assert snapshot() == incremental
+
+
+def test_rollup_upsert_merges_concurrent_writers(app, device, monkeypatch):
+    from app.iot import rollups
+    from app.models.power_usage import PowerReadingRollup
+
+    start = datetime(2026, 3, 10, 8, 0, 0)
+    write_telemetry_batch([build_sample('pump-1', telemetry(p), start + timedelta(seconds=s))
+                           for p, s in ((100, 0), (300, 20))])
+
+    # A second writer that read the buckets before the first one committed
+    read_buckets = rollups.load_buckets
+    calls = []
+
+    def stale_read(resolution, keys):
+        calls.append(resolution)
+        return {} if len(calls) % 2 else read_buckets(resolution, keys)
+
+    monkeypatch.setattr(rollups, 'load_buckets', stale_read)
+    write_telemetry_batch([build_sample('pump-1', telemetry(p), start + timedelta(seconds=s))
+                           for p, s in ((200, 40), (400, 50))])
+    monkeypatch.undo()
+
+    def snapshot():
+        return [(r.resolution, r.sample_count, r.power_sum, r.power_min, r.power_max, round(r.energy, 12),
+                 r.first_timestamp, r.last_timestamp)
+                for r in PowerReadingRollup.query.order_by(PowerReadingRollup.resolution)]
+
+    merged = snapshot()
+    assert [row[1:5] for row in merged] == [(4, 1000.0, 100.0, 400.0)] * 2
+    assert rollups.rebuild_rollups(start, start) == 4
+    assert snapshot() == merged
+
+
+def seed_two_devices_over_days(user, start, days):
+    import random
+
+    fan = Device(name='Fan', device_type='fan', device_id='fan-1', user_id=user.id)
+    db.session.add(fan)
+    db.session.commit()
+
+    rng = random.Random(11)
+    samples = []
+    for device_id, step in (('pump-1', 300), ('fan-1', 450)):
+        for i in range(days * 86400 // step):
+            timestamp = start + timedelta(seconds=i * step + rng.randint(0, 30))
+            samples.append(build_sample(device_id, telemetry(rng.uniform(10, 700)), timestamp))
+    write_telemetry_batch(samples)
+
+
+def reference_daily(device_id, day):
+    readings = PowerReading.query.filter(
+        PowerReading.device_id == device_id,
+        PowerReading.timestamp >= datetime.combine(day, datetime.min.time()),
+        PowerReading.timestamp < datetime.combine(day + timedelta(days=1), datetime.min.time())
+    ).order_by(PowerReading.timestamp).all()
+
+    energy = 0
+    for i in range(1, len(readings)):
+        hours = (readings[i].timestamp - readings[i - 1].timestamp).total_seconds() / 3600
+        energy += (readings[i].power_usage + readings[i - 1].power_usage) / 2 * hours / 1000
+    return energy, max(r.power_usage for r in readings)
+
+
+def check_daily_summaries(start_day, days):
+    import pytest
+    from app.models.power_usage import PowerSummary
+
+    summaries = PowerSummary.query.filter(PowerSummary.device_id != None).all()
+    assert len(summaries) == 2 * days
+
+    for summary in summaries:
+        energy, peak = reference_daily(summary.device_id, summary.date)
+        assert summary.total_energy == pytest.approx(energy, rel=1e-6)
+        assert summary.peak_power == peak
+        assert summary.cost_estimate == pytest.approx(energy * 0.15, rel=1e-6)
+
+    farm = PowerSummary.query.filter(PowerSummary.device_id == None).order_by(PowerSummary.date).all()
+    assert [f.date for f in farm] == [start_day + timedelta(days=i) for i in range(days)]
+
+
+def test_daily_summary_backfill_is_set_based_and_idempotent(app, user, device):
+    from app.iot.sensor_data import backfill_daily_power_summaries, generate_daily_power_summary
+    from app.models.power_usage import PowerSummary
+
+    start = datetime(2026, 3, 1)
+    seed_two_devices_over_days(user, start, 3)
+
+    assert backfill_daily_power_summaries(start.date(), start.date() + timedelta(days=2), chunk_days=2) == 9
+    check_daily_summaries(start.date(), 3)
+
+    assert generate_daily_power_summary(start.date() + timedelta(days=1))
+    assert PowerSummary.query.count() == 9
+
+
+def test_daily_summary_python_fallback_matches(app, user, device, monkeypatch):
+    from app.iot import sensor_data
+
+    start = datetime(2026, 3, 1)
+    seed_two_devices_over_days(user, start, 2)
+
+    monkeypatch.setattr(sensor_data, 'supports_window_functions', lambda: False)
+    sensor_data.summarize_days(start.date(), start.date() + timedelta(days=1))
+    check_daily_summaries(start.date(), 2)
+
+
+def test_analytics_engine_matches_python_loop():
+    import numpy as np
+    import pytest
+    from app.iot.analytics import ReadingSeries, duty_cycle, energy_kwh, find_gaps, grouped_energy, series_stats
+
+    timestamps = np.array([0, 10, 20, 50, 400, 410], dtype=np.float64)
+    power = np.array([100, 200, 0, 0, 300, 300], dtype=np.float64)
+
+    expected = sum((power[i] + power[i - 1]) / 2 * (timestamps[i] - timestamps[i - 1]) / 3600 / 1000
+                   for i in range(1, len(power)))
+    assert energy_kwh(timestamps, power) == pytest.approx(expected)
+
+    # On for 0-20 and 400-410 out of 410 seconds
+    assert duty_cycle(timestamps, power, on_threshold=1) == pytest.approx(30 / 410)
+    assert find_gaps(timestamps, max_gap=300) == [(50.0, 400.0)]
+
+    stats = series_stats(ReadingSeries(timestamps, power, np.full(6, 230.0), np.full(6, np.nan)))
+    assert stats["total_readings"] == 6
+    assert stats["percentiles"]["p50"] == 150
+    assert stats["average_voltage"] == 230
+    assert stats["average_current"] is None
+
+    keys = np.array([1, 1, 1, 2, 2, 2])
+    group_keys, energy, peak, average, counts = grouped_energy(keys, timestamps, power)
+    assert list(group_keys) == [1, 2]
+    assert energy[0] == pytest.approx(energy_kwh(timestamps[:3], power[:3]))
+    assert energy[1] == pytest.approx(energy_kwh(timestamps[3:], power[3:]))
+    assert list(peak) == [200, 300]
+    assert list(counts) == [3, 3]
+
+
+def test_next_fire_handles_weekdays_overnight_and_one_time():
+    from datetime import date, time as dtime
+    from app.iot.scheduler import ScheduleSpec, next_fire, EDGE_START, EDGE_END
+
+    monday = datetime(2024, 1, 1, 12, 0)  # a Monday
+    spec = ScheduleSpec(1, 1, 'pump-1', dtime(22, 0), dtime(6, 0), frozenset({0}), None, 'turn_on', None)
+
+    assert next_fire(spec, monday) == (datetime(2024, 1, 1, 22, 0), EDGE_START)
+    assert next_fire(spec, datetime(2024, 1, 1, 22, 0)) == (datetime(2024, 1, 2, 6, 0), EDGE_END)
+    assert next_fire(spec, datetime(2024, 1, 2, 6, 0)) == (datetime(2024, 1, 8, 22, 0), EDGE_START)
+
+    once = spec._replace(days=frozenset(), one_time_date=date(2024, 1, 3), end_time=dtime(22, 0))
+    assert next_fire(once, monday) == (datetime(2024, 1, 3, 22, 0), EDGE_START)
+    assert next_fire(once, datetime(2024, 1, 3, 22, 0)) is None
+
+
+def test_schedule_runner_fires_edges_and_syncs_changes(app, device, monkeypatch):
+    from datetime import time as dtime
+    from app.iot import mqtt_client
+    from app.iot.scheduler import ScheduleRunner
+    from app.models.schedule import Schedule, ScheduleExecution
+
+    sent = []
+    monkeypatch.setattr(mqtt_client, 'send_device_control',
+                        lambda device_id, command, value=None: sent.append((device_id, command, value)) or True)
+
+    schedule = Schedule(name='irrigate', start_time=dtime(6, 0), end_time=dtime(7, 0), action='turn_on',
+                        device_id=device.id, user_id=device.user_id)
+    db.session.add(schedule)
+    db.session.commit()
+
+    runner = ScheduleRunner(app, batch_size=10)
+    day = datetime(2024, 1, 1)
+    runner.sync(now=day)
+
+    assert runner.run_due(day + timedelta(hours=5)) == 0
+    assert runner.run_due(day + timedelta(hours=6, seconds=1)) == 1
+    assert runner.run_due(day + timedelta(hours=7)) == 1
+    assert sent == [('pump-1', 'power', True), ('pump-1', 'power', False)]
+
+    runner.flush()
+    assert [e.status for e in ScheduleExecution.query.all()] == ['success', 'success']
+    assert db.session.get(Device, device.id).power_state is False
+
+    # Edits are picked up incrementally, a disabled schedule no longer fires
+    schedule.start_time = dtime(8, 0)
+    db.session.commit()
+    runner.sync(now=day + timedelta(hours=7))
+    assert runner.run_due(day + timedelta(hours=8)) == 1
+
+    schedule.is_active = False
+    db.session.commit()
+    runner.sync(now=day + timedelta(hours=8))
+    assert runner.run_due(day + timedelta(days=2)) == 0
+    assert runner.stats()['schedules'] == 0
+
+
+def test_compiled_conditions_evaluate_live_state():
+    from app.iot.conditions import (
+        StaticWeatherProvider, compile_condition, device_state_store, evaluate,
+        set_weather_provider
+    )
+
+    now = datetime(2024, 1, 1, 20, 30)
+    device_state_store.clear()
+    device_state_store.update(1, 650.0, now - timedelta(seconds=10))
+    device_state_store.update(1, 900.0, now - timedelta(seconds=60))  # older sample is ignored
+
+    assert compile_condition('power_threshold', '>500') is compile_condition('power_threshold', '>500')
+    assert evaluate(compile_condition('power_threshold', '>500'), 1, now=now) == (True, None)
+    assert evaluate(compile_condition('power_threshold', '<= 100W'), 1, now=now)[0] is False
+    assert evaluate(compile_condition('power_threshold', '>500'), 2, now=now) == (False, 'no recent telemetry')
+
+    assert evaluate(compile_condition('time_of_day', '18:00-06:00'), 1, now=now)[0] is True
+    assert evaluate(compile_condition('time_of_day', '06:00-18:00'), 1, now=now)[0] is False
+
+    set_weather_provider(StaticWeatherProvider(locations={'north': {'condition': 'rain', 'temperature': 21}}))
+    assert evaluate(compile_condition('weather', 'rain'), 1, 'north', now)[0] is True
+    assert evaluate(compile_condition('weather', 'not rain'), 1, 'north', now)[0] is False
+    assert evaluate(compile_condition('weather', 'temperature>30'), 1, 'north', now)[0] is False
+    assert evaluate(compile_condition('weather', 'rain'), 1, 'south', now) == (False, 'weather unavailable')
+    set_weather_provider(StaticWeatherProvider())
+
+    for bad in (('power_threshold', 'lots'), ('time_of_day', '25:00-26:00'), ('humidity', '>5')):
+        with pytest.raises(ValueError):
+            compile_condition(*bad)
+
+    # Thousands of evaluations per second without touching the database
+    predicate = compile_condition('power_threshold', '>500')
+    started = time.perf_counter()
+    for _ in range(10000):
+        evaluate(predicate, 1, now=now)
+    assert time.perf_counter() - started < 1.0
+
+
+def test_conditional_schedule_skips_until_telemetry_meets_threshold(app, device, monkeypatch):
+    from datetime import time as dtime
+    from app.iot import mqtt_client
+    from app.iot.scheduler import ScheduleRunner
+    from app.models.schedule import Schedule, ScheduleExecution
+
+    sent = []
+    monkeypatch.setattr(mqtt_client, 'send_device_control',
+                        lambda device_id, command, value=None: sent.append(value) or True)
+
+    db.session.add(Schedule(name='shed load', start_time=dtime(12, 0), end_time=dtime(12, 0), action='turn_off',
+                            conditional=True, condition_type='power_threshold', condition_value='>1000',
+                            device_id=device.id, user_id=device.user_id))
+    db.session.commit()
+
+    runner = ScheduleRunner(app)
+    day = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    runner.sync(now=day)
+
+    write_telemetry_batch([build_sample('pump-1', telemetry(400.0), day + timedelta(hours=12))])
+    runner.run_due(day + timedelta(hours=12))
+
+    write_telemetry_batch([build_sample('pump-1', telemetry(1400.0), day + timedelta(days=1, hours=12))])
+    runner.run_due(day + timedelta(days=1, hours=12))
+    runner.flush()
+
+    assert sent == [False]
+    executions = ScheduleExecution.query.order_by(ScheduleExecution.id).all()
+    assert [e.status for e in executions] == ['skipped', 'success']
+    assert 'power 400.0W' in executions[0].result_message
+
+
+class RecordingPublisher:
+    """MQTT client stand-in recording control payloads"""
+
+    def __init__(self, on_publish=None):
+        self.payloads = []
+        self.on_publish = on_publish
+
+    def publish(self, topic, payload, qos=0):
+        import json
+
+        self.payloads.append(json.loads(payload))
+        if self.on_publish:
+            self.on_publish(topic, self.payloads[-1])
+
+        class Info:
+            rc = 0
+
+            def wait_for_publish(self, timeout=None):
+                pass
+
+            def is_published(self):
+                return True
+
+        return Info()
+
+
+def test_command_confirmed_by_correlation_id(app, device, monkeypatch):
+    from app.iot import mqtt_client
+    from app.iot.commands import CommandTracker, COMMAND_CONFIRMED
+    from app.iot.mqtt_client import process_device_message
+
+    publisher = RecordingPublisher()
+    monkeypatch.setattr(mqtt_client, 'mqtt_client', publisher)
+    tracker = CommandTracker(app)
+
+    pending = tracker.send('pump-1', 'power', 'on', previous_state=False)
+    assert publisher.payloads == [{"command": "power", "value": "on", "cid": pending.cid}]
+
+    # A report for another command's cid does not confirm this one
+    assert tracker.acknowledge('pump-1', {"cid": "other"}) is None
+
+    monkeypatch.setattr('app.iot.commands.command_tracker', tracker)
+    process_device_message('smart-farm/devices/pump-1/status', {"power_state": True, "cid": pending.cid})
+
+    assert pending.wait(0) is True
+    assert pending.status == COMMAND_CONFIRMED
+    stats = tracker.stats()
+    assert stats["confirmed"] == 1 and stats["pending"] == 0
+    assert stats["latency"]["pump"]["count"] == 1
+
+
+def test_command_retries_with_backoff_then_restores_state(app, device, monkeypatch):
+    from app.iot import mqtt_client
+    from app.iot.commands import CommandTracker, COMMAND_TIMEOUT
+
+    publisher = RecordingPublisher()
+    monkeypatch.setattr(mqtt_client, 'mqtt_client', publisher)
+    tracker = CommandTracker(app, ack_timeout=1.0, max_retries=2, backoff_base=1.0)
+
+    # The route optimistically switched the device on
+    device.power_state = True
+    db.session.commit()
+    pending = tracker.send('pump-1', 'power', True, previous_state=False)
+    t0 = pending.first_sent
+
+    tracker.tick(t0 + 1.0)   # attempt 1 timed out, back off 1s
+    assert len(publisher.payloads) == 1
+    tracker.tick(t0 + 2.0)   # retry 1
+    tracker.tick(t0 + 3.0)   # attempt 2 timed out, back off 2s
+    tracker.tick(t0 + 4.0)
+    assert len(publisher.payloads) == 2
+    tracker.tick(t0 + 5.0)   # retry 2
+    assert {p["cid"] for p in publisher.payloads} == {pending.cid}
+    tracker.tick(t0 + 6.0)   # out of retries
+
+    assert len(publisher.payloads) == 3
+    assert pending.status == COMMAND_TIMEOUT
+    db.session.expire_all()
+    assert db.session.get(Device, device.id).power_state is False
+
+
+def test_command_confirmed_from_device_row(app, device, monkeypatch):
+    from app.iot import mqtt_client
+    from app.iot.commands import CommandTracker
+
+    monkeypatch.setattr(mqtt_client, 'mqtt_client', RecordingPublisher())
+    tracker = CommandTracker(app, confirm_from_db=True)
+    pending = tracker.send('pump-1', 'power', 'on')
+
+    assert tracker.confirm_from_devices() == 0
+
+    # Another process handled the device's report
+    device.power_state = True
+    device.last_updated = datetime.utcnow()
+    db.session.commit()
+
+    assert tracker.confirm_from_devices() == 1
+    assert pending.wait(0) is True
+
+
+def test_alert_engine_suppresses_stuck_device_and_uses_hysteresis(app, device):
+    from app.iot.alerts import AlertEngine, LEVEL_CRITICAL
+    from app.iot.device_registry import device_registry
+
+    entry = device_registry.get('pump-1')
+    engine = AlertEngine(app, critical_cooldown=900, max_cooldown=3600, escalate_after=0)
+    start = datetime(2024, 1, 1)
+
+    # A device stuck at 1500W reporting every 2s for an hour
+    fired = []
+    for i in range(1800):
+        fired += engine.check(entry, 1500.0, 800.0, 1200.0, send_sms=True, now=start + timedelta(seconds=2 * i))
+
+    # First alert, then reminders after 15 and a further 30 minutes
+    assert [a["timestamp"] - start for a in fired] == [timedelta(0), timedelta(minutes=15), timedelta(minutes=45)]
+    assert all(a["notification_type"] == LEVEL_CRITICAL for a in fired)
+    assert engine.stats()["suppressed"] > 1700
+
+    # Hovering just under the threshold does not clear it, dropping below the band does
+    later = start + timedelta(hours=1)
+    assert engine.check(entry, 1190.0, 800.0, 1200.0, now=later) == []
+    assert engine.check(entry, 1250.0, 800.0, 1200.0, now=later + timedelta(seconds=2)) == []
+    assert engine.check(entry, 1000.0, 800.0, 1200.0, now=later + timedelta(seconds=4)) == []
+    assert len(engine.check(entry, 1250.0, 800.0, 1200.0, now=later + timedelta(minutes=20))) == 1
+
+
+def test_alert_engine_escalates_sustained_warning(app, device):
+    from app.iot.alerts import AlertEngine
+    from app.iot.device_registry import device_registry
+
+    entry = device_registry.get('pump-1')
+    engine = AlertEngine(app, escalate_after=1800)
+    start = datetime(2024, 1, 1)
+
+    first = engine.check(entry, 900.0, 800.0, 1200.0, send_sms=True, now=start)
+    assert [a["notification_type"] for a in first] == ["warning"]
+    assert engine.check(entry, 900.0, 800.0, 1200.0, send_sms=True, now=start + timedelta(minutes=20)) == []
+
+    escalated = engine.check(entry, 900.0, 800.0, 1200.0, send_sms=True, now=start + timedelta(minutes=31))
+    assert len(escalated) == 1
+    assert escalated[0]["notification_type"] == "warning" and escalated[0]["send_sms"]
+    assert engine.check(entry, 900.0, 800.0, 1200.0, send_sms=True, now=start + timedelta(minutes=40)) == []
+
+
+def test_alert_cooldowns_restore_from_threshold_alerts_only(app, device):
+    from app.iot.alerts import AlertEngine
+    from app.iot.device_registry import device_registry
+    from app.iot.mqtt_client import send_device_error_notification
+    from app.models.notification import Notification
+
+    entry = device_registry.get('pump-1')
+    now = datetime.utcnow()
+
+    # A device error is an 'alert' notification but not a threshold alert
+    send_device_error_notification(device)
+    engine = AlertEngine(app)
+    engine.load_recent()
+    assert [a["notification_type"] for a in engine.check(entry, 1500.0, 800.0, 1200.0, now=now)] == ["alert"]
+
+    db.session.add(Notification(title='Critical Power Usage: Irrigation Pump', message='m', notification_type='alert',
+                                user_id=device.user_id, device_id=device.id, timestamp=now))
+    db.session.commit()
+    restarted = AlertEngine(app)
+    restarted.load_recent()
+    assert restarted.check(entry, 1500.0, 800.0, 1200.0, now=now + timedelta(minutes=1)) == []
+
+
+def test_threshold_alerts_written_behind_with_sms(app, device, fake_sms):
+    from app.africastalking.outbox import SMSOutboxSender
+    from app.models.notification import Notification, NotificationSetting, SMSMessage
+
+    db.session.add(NotificationSetting(user_id=device.user_id, power_threshold_warning=800,
+                                       power_threshold_critical=1200, receive_sms=True))
+    db.session.commit()
+
+    start = datetime.utcnow()
+    for i in range(20):
+        write_telemetry_batch([build_sample('pump-1', telemetry(1500.0), start + timedelta(seconds=2 * i))])
+
+    # Ingestion only wrote the notification, the sender turns it into an SMS after the digest window
+    notifications = Notification.query.all()
+    assert len(notifications) == 1
+    assert notifications[0].notification_type == "alert"
+    assert notifications[0].sms_sent is False
+    assert fake_sms.calls == []
+
+    sender = SMSOutboxSender(app, rate_limit=1000, digest_window=60)
+    assert sender.release(start + timedelta(seconds=30)) == 0
+    assert sender.release(start + timedelta(seconds=61)) == 1
+    assert SMSMessage.query.one().recipient == '256700000001'
+
+    assert sender.dispatch() == 1
+    assert len(fake_sms.calls) == 1
+    assert fake_sms.calls[0][1] == ['+256700000001']
+    assert fake_sms.calls[0][0].startswith("ALERT: Device 'Irrigation Pump' is consuming 1500.00W")
+    assert SMSMessage.query.one().status == 'sent'
+    assert db.session.get(Notification, notifications[0].id).sms_sent is True
+
+
+def test_sms_sender_groups_identical_text_and_retries(app, user, fake_sms):
+    from app.africastalking.outbox import SMSOutboxSender, queue_sms
+    from app.models.notification import SMSMessage
+
+    queue_sms(['256700000001', '256700000002', '256700000003', '256700000004'], 'Rain expected tonight')
+    queue_sms(['256700000001'], 'Pump 2 is offline')
+    queue_sms(['256700000009'], 'Bad number')
+    db.session.commit()
+
+    fake_sms.statuses['+256700000003'] = (500, 'InternalServerError')
+    fake_sms.statuses['+256700000009'] = (403, 'InvalidPhoneNumber')
+    sender = SMSOutboxSender(app, max_recipients=3, rate_limit=1000, backoff_base=60, max_attempts=2)
+    now = datetime.utcnow()
+
+    assert sender.dispatch(now) == 6
+    # One call per text, the four-recipient text split by max_recipients, and the SDK initialized once
+    assert sorted(len(recipients) for _, recipients in fake_sms.calls) == [1, 1, 1, 3]
+    assert fake_sms.initialized == 1
+
+    statuses = {row.recipient: row.status for row in SMSMessage.query.filter_by(message='Rain expected tonight')}
+    assert statuses['256700000003'] == 'pending'
+    assert SMSMessage.query.filter_by(recipient='256700000009').one().status == 'failed'
+
+    # The retry waits for its backoff, then gives up after max_attempts
+    assert sender.dispatch(now + timedelta(seconds=30)) == 0
+    assert sender.dispatch(now + timedelta(seconds=61)) == 1
+    retried = SMSMessage.query.filter_by(recipient='256700000003').one()
+    assert retried.status == 'failed' and retried.attempts == 2
+
+    # An API error leaves the whole group pending for a later attempt
+    queue_sms(['256700000005'], 'Later')
+    db.session.commit()
+    fake_sms.errors.append(RuntimeError('429 Too Many Requests'))
+    assert sender.dispatch(now + timedelta(seconds=62)) == 1
+    later = SMSMessage.query.filter_by(recipient='256700000005').one()
+    assert later.status == 'pending' and later.attempts == 1 and '429' in later.last_error
+    assert sender.stats()["api_errors"] == 1
+
+
+def test_sms_senders_in_several_processes_send_each_message_once(app, user, fake_sms):
+    from app.africastalking.outbox import SMSOutboxSender, queue_sms
+    from app.models.notification import SMSMessage
+
+    queue_sms(['256700000001', '256700000002'], 'Grid power restored')
+    db.session.commit()
+
+    first = SMSOutboxSender(app, rate_limit=1000, claim_timeout=600)
+    second = SMSOutboxSender(app, rate_limit=1000, claim_timeout=600)
+    now = datetime.utcnow()
+
+    # The first sender claims the batch and dies before sending it
+    assert len(first._claim(now)) == 2
+    assert second.dispatch(now) == 0
+    assert fake_sms.calls == []
+    assert {row.status for row in SMSMessage.query} == {'sending'}
+
+    # Once the claim times out the messages are sent exactly once
+    assert second.dispatch(now + timedelta(seconds=601)) == 2
+    assert first.dispatch(now + timedelta(seconds=602)) == 0
+    assert len(fake_sms.calls) == 1
+    assert {row.status for row in SMSMessage.query} == {'sent'}
+
+
+def test_settings_cache_serves_thresholds_without_queries(app, device):
+    from sqlalchemy import event
+    from app.iot.device_registry import device_registry
+    from app.iot.mqtt_client import check_power_thresholds
+    from app.iot.user_settings import settings_cache
+    from app.models.notification import Notification, NotificationSetting
+
+    db.session.add(NotificationSetting(user_id=device.user_id, power_threshold_warning=600,
+                                       power_threshold_critical=1000, receive_sms=False))
+    db.session.commit()
+    assert settings_cache.preload() == 1
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    entry = device_registry.get('pump-1')
+    before = settings_cache.stats()
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        for _ in range(50):
+            check_power_thresholds(entry, 500.0)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+    assert statements == []
+    after = settings_cache.stats()
+    assert after["hits"] - before["hits"] == 50
+    assert after["misses"] == before["misses"]
+
+    # Thresholds come from the cached settings, not the app defaults
+    check_power_thresholds(entry, 700.0)
+    assert [n.notification_type for n in Notification.query.all()] == ["warning"]
+
+
+def test_sms_digest_coalesces_bursts_and_respects_quiet_hours(app, user, fake_sms):
+    from datetime import time as dt_time
+    from app.africastalking.outbox import SMSOutboxSender
+    from app.models.notification import Notification, NotificationSetting
+
+    db.session.add(NotificationSetting(user_id=user.id, quiet_hours_start=dt_time(22, 0), quiet_hours_end=dt_time(6, 0)))
+    devices = [Device(name=f'Pump {i}', device_type='pump', device_id=f'pump-{i}', user_id=user.id) for i in range(40)]
+    db.session.add_all(devices)
+    db.session.commit()
+
+    def notify(device, notification_type, at):
+        kind = 'Critical Power Usage' if notification_type == 'alert' else 'Sustained High Power Usage'
+        db.session.add(Notification(title=f'{kind}: {device.name}', message='m', notification_type=notification_type,
+                                    user_id=user.id, device_id=device.id, send_sms=True, timestamp=at))
+
+    sender = SMSOutboxSender(app, rate_limit=1000, digest_window=60)
+
+    # A grid event at noon: 40 critical alerts within a minute go out as one SMS
+    noon = datetime(2024, 1, 1, 12, 0)
+    for i, device in enumerate(devices):
+        notify(device, 'alert', noon + timedelta(seconds=i))
+    db.session.commit()
+
+    assert sender.release(noon + timedelta(seconds=90)) == 1
+    sender.dispatch()
+    assert len(fake_sms.calls) == 1
+    assert fake_sms.calls[0][0].startswith('Farm Alerts: 40 new (40 critical). Critical Power Usage: Pump 0, Pump 1, Pump 2 +37 more.')
+    assert Notification.query.filter_by(sms_sent=True).count() == 40
+
+    # At night warnings are held until quiet hours end, even when a critical alert goes out
+    night = datetime(2024, 1, 1, 23, 0)
+    notify(devices[0], 'warning', night)
+    notify(devices[1], 'warning', night + timedelta(minutes=5))
+    db.session.commit()
+    assert sender.release(night + timedelta(hours=1)) == 0
+
+    notify(devices[2], 'alert', night + timedelta(hours=2))
+    db.session.commit()
+    assert sender.release(night + timedelta(hours=2, seconds=30)) == 0
+    assert sender.release(night + timedelta(hours=2, minutes=1)) == 1
+    sender.dispatch()
+    assert Notification.query.filter_by(sms_message_id=None).count() == 2
+
+    notify(devices[3], 'warning', night + timedelta(hours=3))
+    db.session.commit()
+    assert sender.release(night + timedelta(hours=6, minutes=59)) == 0
+    assert sender.release(night + timedelta(hours=7)) == 1
+    sender.dispatch()
+    assert fake_sms.calls[-1][0].startswith('Farm Alerts: 3 new (0 critical).')
+    assert sender.stats()["coalesced"] == 44
+
+
+def test_quiet_hours_digest_sends_the_critical_alert_without_held_warnings(app, user):
+    from datetime import time as dt_time
+    from app.africastalking.digest import release_digests
+    from app.models.notification import Notification, NotificationSetting, SMSMessage
+
+    db.session.add(NotificationSetting(user_id=user.id, quiet_hours_start=dt_time(22, 0), quiet_hours_end=dt_time(6, 0)))
+    night = datetime(2024, 1, 1, 23, 0)
+    warning = Notification(title='Sustained High Power Usage: Pump', message='warn', notification_type='warning',
+                           user_id=user.id, send_sms=True, timestamp=night)
+    alert = Notification(title='Critical Power Usage: Pump', message='crit', notification_type='alert',
+                         user_id=user.id, send_sms=True, timestamp=night + timedelta(minutes=5))
+    db.session.add_all([warning, alert])
+    db.session.commit()
+
+    assert release_digests(night + timedelta(minutes=10)) == (1, 1)
+    assert alert.sms_message_id is not None
+    assert warning.sms_message_id is None
+    assert 'crit' in SMSMessage.query.one().message
+
+
+def test_digest_claims_each_notification_once(app, user):
+    from app.africastalking.digest import claim_notifications
+    from app.africastalking.outbox import queue_sms
+    from app.models.notification import Notification, SMSMessage
+
+    notifications = [Notification(title=f'Alert {i}', message='m', notification_type='alert',
+                                  user_id=user.id, send_sms=True) for i in range(3)]
+    db.session.add_all(notifications)
+    db.session.commit()
+
+    # Another process released a digest carrying the first notification in the meantime
+    other = queue_sms([user.phone_number], 'other digest')[0]
+    assert claim_notifications(other, notifications[:1]) == notifications[:1]
+
+    mine = queue_sms([user.phone_number], '')[0]
+    assert claim_notifications(mine, notifications) == notifications[1:]
+    assert claim_notifications(queue_sms([user.phone_number], '')[0], notifications) == []
+    db.session.commit()
+
+    carriers = {n.id: n.sms_message_id for n in Notification.query}
+    assert carriers == {notifications[0].id: other.id, notifications[1].id: mine.id, notifications[2].id: mine.id}
+    assert SMSMessage.query.count() == 3
+
+
+def test_local_broker_fans_out_per_user_and_flags_overflow():
+    from app.iot.events import LocalBroker, user_channel
+
+    broker = LocalBroker(queue_size=2)
+    first = broker.subscribe(user_channel(1))
+    second = broker.subscribe(user_channel(1))
+    other = broker.subscribe(user_channel(2))
+
+    assert broker.publish(user_channel(1), 'a') == 2
+    assert broker.publish(user_channel(3), 'nobody') == 0
+    assert not broker.wants(user_channel(3))
+    assert first.get(0) == 'a' and second.get(0) == 'a'
+    assert other.get(0) is None
+
+    # A slow subscriber keeps the newest events and is told to resync
+    for message in ('b', 'c', 'd'):
+        broker.publish(user_channel(1), message)
+    assert first.take_dropped() == 1
+    assert [first.get(0), first.get(0)] == ['c', 'd']
+
+    for subscription in (first, second, other):
+        subscription.close()
+    assert broker.subscriber_count() == 0
+
+
+def test_metrics_registry_aggregates_per_thread_shards(app, device):
+    import threading
+    from app.metrics import MQTT_MESSAGES, Counter, Histogram, Registry, default_registry
+    from app.iot.mqtt_client import on_message
+
+    registry = Registry()
+    requests = Counter('requests', 'Requests', ('route',), registry=registry)
+    latency = Histogram('latency_seconds', 'Latency', registry=registry, buckets=(0.1, 1.0))
+
+    def work():
+        for _ in range(1000):
+            requests.inc(1, ('a',))
+        latency.observe(0.05)
+        latency.observe(2.0)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    del threads, thread
+    requests.inc(5, ('b',))
+
+    text = registry.collect()
+    assert 'requests_total{route="a"} 4000' in text
+    assert 'requests_total{route="b"} 5' in text
+    assert 'latency_seconds_bucket{le="0.1"} 4' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 8' in text
+    assert 'latency_seconds_count 8' in text
+
+    # Shards of finished threads are folded into the retired totals
+    assert len(registry._shards) == 1
+    assert 'requests_total{route="a"} 4000' in registry.collect()
+
+    # The MQTT callback counts and times each message
+    before = default_registry.merged().get((MQTT_MESSAGES.name, ('telemetry',)), 0)
+    on_message(None, None, FakeMessage("smart-farm/telemetry/pump-1", b'{"power": 5, "voltage": 230, "current": 1}'))
+    assert default_registry.merged()[(MQTT_MESSAGES.name, ('telemetry',))] == before + 1
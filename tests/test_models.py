@@ -0,0 +1,152 @@
+import random
+import re
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event, insert
+
+from app import db
+
+# Tables large enough in production that a full scan is a regression
+HOT_TABLES = ('power_readings', 'power_reading_rollups', 'power_summaries', 'notifications', 'devices', 'users')
+FULL_SCAN = re.compile(r'^SCAN (%s)\b' % '|'.join(HOT_TABLES))
+
+
+@contextmanager
+def captured_queries():
+    """Record the SELECT/UPDATE/DELETE statements executed inside the block"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'WITH')):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+
+def query_plan(statement, parameters):
+    rows = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+    return [row[-1] for row in rows]
+
+
+def assert_indexed(statements):
+    assert statements
+    for statement, parameters in statements:
+        plan = query_plan(statement, parameters)
+        scans = [detail for detail in plan if FULL_SCAN.match(detail)]
+        assert not scans, f"Full scan in:\n{statement}\nplan: {plan}"
+
+
+@pytest.fixture
+def seeded(app, user, device):
+    """Seed enough users, devices, readings, notifications and summaries for the planner to prefer indexes"""
+    from app.models.device import Device
+    from app.models.notification import Notification
+    from app.models.power_usage import PowerReading, PowerSummary
+    from app.models.user import User
+
+    rng = random.Random(7)
+    now = datetime.utcnow()
+    today = now.date()
+
+    db.session.execute(insert(User), [
+        {'username': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': 'x',
+         'phone_number': f'2567{i:08d}', 'phone_key': f'2567{i:08d}'}
+        for i in range(50)
+    ])
+    user_ids = [user.id] + [row[0] for row in db.session.query(User.id).filter(User.id != user.id)]
+
+    db.session.execute(insert(Device), [
+        {'name': f'device-{i}', 'device_type': 'pump', 'device_id': f'dev-{i}', 'user_id': user_ids[i % len(user_ids)]}
+        for i in range(250)
+    ])
+    device_ids = [row[0] for row in db.session.query(Device.id)]
+
+    db.session.execute(insert(PowerReading), [
+        {'device_id': device_id, 'timestamp': now - timedelta(minutes=30 * i), 'power_usage': rng.uniform(0, 2000)}
+        for device_id in device_ids for i in range(80)
+    ])
+
+    db.session.execute(insert(Notification), [
+        {'title': 't', 'message': 'm', 'user_id': rng.choice(user_ids), 'device_id': rng.choice(device_ids),
+         'notification_type': rng.choice(('alert', 'warning', 'info')), 'is_read': rng.random() < 0.8,
+         'timestamp': now - timedelta(minutes=i)}
+        for i in range(20000)
+    ])
+
+    db.session.execute(insert(PowerSummary), [
+        {'summary_type': 'daily', 'date': today - timedelta(days=day), 'device_id': device_id, 'total_energy': 1.0,
+         'peak_power': 100.0, 'average_power': 50.0, 'cost_estimate': 0.15}
+        for device_id in device_ids + [None] for day in range(40)
+    ])
+    db.session.commit()
+    db.session.execute(db.text('ANALYZE'))
+
+    return device
+
+
+def test_sensor_data_queries_use_indexes(seeded):
+    from app.iot.sensor_data import get_device_power_stats, get_farm_power_summary, generate_daily_power_summary
+
+    with captured_queries() as statements:
+        get_device_power_stats(seeded.id, 'day')
+        get_device_power_stats(seeded.id, 'week')
+        get_farm_power_summary(seeded.user_id, 'month')
+        generate_daily_power_summary(datetime.utcnow().date() - timedelta(days=1))
+
+    assert_indexed(statements)
+
+
+def test_mqtt_client_queries_use_indexes(app, seeded):
+    from app.iot.device_registry import device_registry
+    from app.iot.mqtt_client import check_power_thresholds, process_device_message
+
+    entry = device_registry.get(seeded.device_id)
+    app.config['POWER_WARNING_THRESHOLD'] = 100
+    app.config['POWER_CRITICAL_THRESHOLD'] = 10000
+
+    with captured_queries() as statements:
+        process_device_message(seeded.device_id, {"status": "online", "power_state": True})
+        check_power_thresholds(entry, 500)
+
+    assert_indexed(statements)
+
+
+def test_power_route_queries_use_indexes(client, auth_headers, seeded):
+    with captured_queries() as statements:
+        readings = client.get(f'/api/power/readings?device_id={seeded.id}&limit=10', headers=auth_headers)
+        client.get(f"/api/power/readings?limit=10&after={readings.get_json()['next_cursor']}", headers=auth_headers)
+        since = (datetime.utcnow() - timedelta(days=1)).isoformat()
+        client.get(f'/api/power/readings/export?limit=100&start_time={since}', headers=auth_headers).get_data()
+        client.get(f'/api/power/devices/{seeded.id}', headers=auth_headers)
+        client.get('/api/power/summary?period=week', headers=auth_headers)
+        client.get('/api/power/dashboard', headers=auth_headers)
+
+    assert_indexed(statements)
+
+
+def test_notification_route_queries_use_indexes(client, auth_headers, seeded):
+    with captured_queries() as statements:
+        page = client.get('/api/notifications?limit=5', headers=auth_headers)
+        client.get(f"/api/notifications?limit=5&after={page.get_json()['next_cursor']}", headers=auth_headers)
+        client.get('/api/notifications?unread_only=true', headers=auth_headers)
+        client.get('/api/notifications/unread-count', headers=auth_headers)
+        client.post('/api/notifications/read-all', headers=auth_headers)
+
+    assert_indexed(statements)
+
+
+def test_ussd_queries_use_indexes(client, seeded):
+    with captured_queries() as statements:
+        for text in ('', '1'):
+            client.post('/ussd/callback', data={
+                'sessionId': 'ATUid_plan', 'serviceCode': '*123#', 'phoneNumber': '+256700000001', 'text': text
+            })
+
+    assert any('phone_key' in statement for statement, _ in statements)
+    assert_indexed(statements)